@@ -4,9 +4,10 @@ backend/app/dispatcher.py
 """
 import logging
 import asyncio
-from app.pipelines import pipe_a_rembg, pipe_b_comfyui, pipe_c_api, pipe_e_photoshop
+from app.pipelines import pipe_a_rembg, pipe_b_comfyui, pipe_c_api, pipe_d_gemini_local, pipe_e_photoshop
 from app.websocket_manager import manager
 from app.schemas import WSMessage
+from app.utils.asset_gc import collector as gc_collector # [新增] 素材垃圾回收 (引用追踪)
 
 logger = logging.getLogger("backend.dispatcher")
 
@@ -15,6 +16,9 @@ async def dispatch(task, task_id: str, process_pool):
     根据 task.task_type 分发任务到对应的处理管道
     """
     logger.info(f"🔄 Dispatching task {task_id} | Type: {task.task_type}")
+    # [新增] 任务输入中引用的素材在任务进行期间 (及之后的宽限期内) 不会被回收
+    project_id = task.payload.get("project_id")
+    gc_collector.touch(task.payload, project_id=project_id)
     
     try:
         result = None
@@ -41,10 +45,11 @@ async def dispatch(task, task_id: str, process_pool):
                 WSMessage(
                     type="status",
                     task_id=task_id,
-                    data={"message": "正在提交 ComfyUI 任务..."}
+                    # [新增] 附带预估耗时 (eta 秒) 与预计使用的节点
+                    data={"message": "正在提交 ComfyUI 任务...", **(pipe_b_comfyui.estimate(task.payload) or {})}
                 )
             )
-            result = await pipe_b_comfyui.run(task.payload)
+            result = await pipe_b_comfyui.run(task.payload, task_id=task_id, client_id=task.client_id)
         
         elif task.task_type == "external_api":
             # 1. 发送一个“处理中”的状态给前端
@@ -57,7 +62,19 @@ async def dispatch(task, task_id: str, process_pool):
                 )
             )
             # 2. 调用你已经写好的 Pipe C
-            result = await pipe_c_api.run(task.payload)
+            result = await pipe_c_api.run(task.payload, client_id=task.client_id, task_id=task_id)
+
+        elif task.task_type == "gemini_local":
+            # [新增] 本地 Gemini 服务：单并发排队执行，排队位置由管道自行推送
+            await manager.send_to_client(
+                task.client_id,
+                WSMessage(
+                    type="status",
+                    task_id=task_id,
+                    data={"message": "正在提交到本地 Gemini 服务..."}
+                )
+            )
+            result = await pipe_d_gemini_local.run(task.payload, task_id=task_id, client_id=task.client_id)
 
         elif task.task_type == "photoshop_import":
             # 1. 发送一个“处理中”的状态给前端
@@ -107,6 +124,7 @@ async def dispatch(task, task_id: str, process_pool):
 
         # --- 处理结果 ---
         if result:
+            gc_collector.touch(result, project_id=project_id)
             if result.get("status") == "error":
                 # Pipeline 返回了错误
                 await _send_error(task.client_id, task_id, result.get("message"))
@@ -74,7 +74,14 @@ def _run_rembg_sync(payload: Dict[str, Any]) -> Dict[str, Any]:
         input_image = None
 
         # --- [核心修改] 智能读取图片 (支持 URL 或 Base64) ---
-        if image_input.startswith("http"):
+        if image_input.startswith("blob://"):
+            # [新增] 情况 0: 二进制上传的 Blob 句柄，直接打开本地文件
+            blob_path = storage.resolve_workspace_path(image_input)
+            if blob_path is None:
+                return {"status": "error", "message": f"Blob not found or expired: {image_input}"}
+            input_image = Image.open(blob_path)
+
+        elif image_input.startswith("http"):
             # 情况 A: 如果是 URL (已上传到 workspace/inputs 的图片)
             try:
                 # 直接通过网络流读取，不保存临时文件
@@ -93,7 +100,7 @@ def _run_rembg_sync(payload: Dict[str, Any]) -> Dict[str, Any]:
             except Exception as e:
                 return {"status": "error", "message": f"Invalid Base64 data: {e}"}
         else:
-            return {"status": "error", "message": "Unknown image format (must be URL or Base64)"}
+            return {"status": "error", "message": "Unknown image format (must be URL, blob:// or Base64)"}
 
         # 2. 执行 RemBg (核心计算)
         session = _get_session(model_name)
@@ -10,8 +10,20 @@ import httpx
 import websockets
 import base64
 import asyncio
-from typing import Dict, Any, List, Union
+import time
+import os
+import shutil
+import socket
+import hashlib
+import mimetypes
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple, Union
 from app.utils import storage
+from app.utils import comfy_pool # [新增] 多后端负载均衡
+from app.utils import workflow_registry # [新增] 服务端工作流模板缓存
+from app.utils.comfy_stats import stats as comfy_stats, workflow_key # [新增] 耗时统计与 ETA
+from app.websocket_manager import manager
+from app.schemas import WSMessage
 
 # 尝试导入配置，如果失败则使用默认值
 try:
@@ -23,9 +35,10 @@ except ImportError:
 
 logger = logging.getLogger("backend.pipe_b_comfyui")
 
-async def upload_image(image_data_b64: str, filename_prefix: str = "upload_") -> str:
+async def upload_image(image_data_b64: str, filename_prefix: str = "upload_", base_url: str = None) -> str:
     """
     上传 Base64 图片到 ComfyUI 并返回文件名
+    base_url: 目标 ComfyUI 节点地址 (默认 settings.COMFY_URL)
     """
     try:
         # 1. 处理 Base64 头部
@@ -36,17 +49,25 @@ async def upload_image(image_data_b64: str, filename_prefix: str = "upload_") ->
         
         # 2. 解码
         img_bytes = base64.b64decode(encoded)
-        
-        # 3. 准备上传
-        # 生成随机文件名避免冲突
-        filename = f"{filename_prefix}{uuid.uuid4()}.png"
-        
+    except Exception as e:
+        logger.error(f"Image decode exception: {e}")
+        raise e
+
+    # 3. 生成随机文件名避免冲突
+    filename = f"{filename_prefix}{uuid.uuid4()}.png"
+    return await upload_image_bytes(img_bytes, filename, base_url)
+
+async def upload_image_bytes(img_bytes: bytes, filename: str, base_url: str = None) -> str:
+    """[新增] 通过 /upload/image 上传原始图片字节，返回 ComfyUI 中的文件名"""
+    base_url = base_url or settings.COMFY_URL
+    try:
         # ComfyUI upload api expects multipart/form-data
-        files = {"image": (filename, img_bytes, "image/png")}
+        mime_type = mimetypes.guess_type(filename)[0] or "image/png"
+        files = {"image": (filename, img_bytes, mime_type)}
         data = {"overwrite": "true"}
         
         async with httpx.AsyncClient(trust_env=False) as client:
-            resp = await client.post(f"{settings.COMFY_URL}/upload/image", files=files, data=data)
+            resp = await client.post(f"{base_url}/upload/image", files=files, data=data)
             
             if resp.status_code == 200:
                 resp_json = resp.json()
@@ -59,14 +80,210 @@ async def upload_image(image_data_b64: str, filename_prefix: str = "upload_") ->
         logger.error(f"Image upload exception: {e}")
         raise e
 
-async def run(payload: Dict[str, Any]) -> Dict[str, Any]:
+# --- [新增] 共享文件系统输入模式 ---
+# ComfyUI 与后端在同一台机器或共享卷上时，直接把文件放进 ComfyUI 的 input 目录，
+# 省去 浏览器 Base64 -> HTTP 上传 的往返。远程节点自动回退为 HTTP 上传。
+SHARED_SUBFOLDER = "hp_canvas"
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1", "0.0.0.0")
+
+def _shared_input_dir(backend_url: str) -> Optional[Path]:
+    """返回该节点可直接写入的 input 目录，不可用时返回 None (即走 HTTP 上传)"""
+    if settings.COMFY_INPUT_MODE == "upload":
+        return None
+    shared_dirs = getattr(settings, "COMFY_SHARED_INPUT_DIRS", {}) or {}
+    input_dir = shared_dirs.get(backend_url) or shared_dirs.get(backend_url.rstrip("/"))
+    if not input_dir:
+        host = urllib.parse.urlparse(backend_url).hostname or ""
+        if host in LOCAL_HOSTS or host == socket.gethostname():
+            input_dir = getattr(settings, "COMFY_INPUT_DIR", None)
+    if input_dir and Path(input_dir).is_dir():
+        return Path(input_dir)
+    return None
+
+def _stage_file(src: Path, input_dir: Path) -> str:
+    """
+    把本地文件放入 ComfyUI input 目录，返回 LoadImage 可用的相对文件名
+    - 已经位于 input 目录内: 原地引用
+    - 否则: 优先硬链接，跨设备等情况回退为复制
+    """
+    input_root = input_dir.resolve()
+    try:
+        return src.resolve().relative_to(input_root).as_posix()
+    except ValueError:
+        pass
+
+    stat = src.stat()
+    # 文件名包含大小和修改时间，内容变化后不会误用旧文件
+    dest = input_root / SHARED_SUBFOLDER / f"{stat.st_size:x}{int(stat.st_mtime):x}_{src.name}"
+    if not dest.exists():
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+    return dest.relative_to(input_root).as_posix()
+
+def _stage_bytes(img_bytes: bytes, input_dir: Path, filename: str) -> str:
+    """把已解码的图片字节直接写入 ComfyUI input 目录"""
+    dest = input_dir.resolve() / SHARED_SUBFOLDER / filename
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    dest.write_bytes(img_bytes)
+    return f"{SHARED_SUBFOLDER}/{filename}"
+
+async def _prepare_image_input(value: str, backend_url: str) -> Optional[str]:
+    """
+    处理图片类输入，返回 ComfyUI 中的文件名
+    value 不是图片输入 (普通文本或工作区外的路径) 时返回 None
+    """
+    input_dir = _shared_input_dir(backend_url)
+
+    if value.startswith("data:image"):
+        if input_dir is None:
+            return await upload_image(value, base_url=backend_url)
+        _, encoded = value.split(",", 1) if "," in value else ("", value)
+        img_bytes = base64.b64decode(encoded)
+        filename = f"upload_{hashlib.sha256(img_bytes).hexdigest()[:16]}.png"
+        try:
+            return await asyncio.to_thread(_stage_bytes, img_bytes, input_dir, filename)
+        except OSError as e:
+            logger.warning(f"Shared input write failed, falling back to upload: {e}")
+            return await upload_image_bytes(img_bytes, filename, backend_url)
+
+    local_path = storage.resolve_workspace_path(value)
+    if local_path is None:
+        return None
+    if input_dir is not None:
+        try:
+            return await asyncio.to_thread(_stage_file, local_path, input_dir)
+        except OSError as e:
+            logger.warning(f"Shared input link failed, falling back to upload: {e}")
+    # 远程节点: 读取文件后通过 HTTP 上传
+    img_bytes = await asyncio.to_thread(local_path.read_bytes)
+    return await upload_image_bytes(img_bytes, f"upload_{uuid.uuid4().hex[:8]}_{local_path.name}", backend_url)
+
+class BackendUnavailable(Exception):
+    """节点在任务入队前就无法连接 (可以安全地换一个节点重试)"""
+
+# [新增] 记录每个任务对应的 ComfyUI prompt_id (task_id -> {"prompt_id", "backend", "queued_at"})
+# WebSocket 断开后据此从 /history 找回结果；GET /api/comfy/stats 中列出，便于排查卡住的任务
+active_prompts: Dict[str, Dict[str, str]] = {}
+
+# 向前端推送 ETA 更新的最小间隔 (秒)
+ETA_UPDATE_INTERVAL = 2.0
+
+class _ProgressTracker:
+    """
+    [新增] 跟踪一次执行的进度：记录单节点耗时，并定期向前端推送 ETA
+    ETA = 排队等待 (队列位置 × 节点平均耗时) + 剩余执行时间
+    """
+    def __init__(self, workflow: Dict[str, Any], backend_url: str, client_id: Optional[str], task_id: Optional[str]):
+        self.wf_key = workflow_key(workflow)
+        self.pending_nodes = set(workflow.keys())
+        self.backend_url = backend_url
+        self.client_id = client_id
+        self.task_id = task_id
+        self.queue_ahead = 0
+        self.exec_started: Optional[float] = None
+        self.current_node: Optional[str] = None
+        self.node_started = 0.0
+        self.last_sent = 0.0
+
+    def on_event(self, msg_type: str, data: Dict[str, Any]):
+        now = time.monotonic()
+        if msg_type == "execution_start":
+            self.exec_started = now
+            self.queue_ahead = 0
+        elif msg_type == "execution_cached":
+            self.pending_nodes.difference_update(str(n) for n in data.get("nodes", []))
+        elif msg_type == "executing":
+            if self.exec_started is None:
+                self.exec_started = now
+                self.queue_ahead = 0
+            # 上一个节点在下一个节点开始时结束
+            if self.current_node is not None:
+                comfy_stats.record_node(self.wf_key, self.current_node, now - self.node_started)
+            node = data.get("node")
+            self.current_node = str(node) if node is not None else None
+            self.node_started = now
+            if self.current_node:
+                self.pending_nodes.discard(self.current_node)
+
+    def execution_time(self) -> Optional[float]:
+        if self.exec_started is None:
+            return None
+        return time.monotonic() - self.exec_started
+
+    def eta(self) -> float:
+        if self.exec_started is None:
+            return comfy_stats.eta(self.wf_key, self.backend_url, self.queue_ahead)
+        remaining = comfy_stats.remaining_duration(self.wf_key, self.pending_nodes, self.execution_time())
+        return max(remaining, 0.0)
+
+    async def notify(self, force: bool = False):
+        if not (self.client_id and self.task_id):
+            return
+        now = time.monotonic()
+        if not force and now - self.last_sent < ETA_UPDATE_INTERVAL:
+            return
+        self.last_sent = now
+        running = self.exec_started is not None
+        await manager.send_to_client(self.client_id, WSMessage(
+            type="status",
+            task_id=self.task_id,
+            data={
+                "message": "ComfyUI 正在执行..." if running else f"ComfyUI 排队中 (前方 {self.queue_ahead} 个任务)",
+                "eta": round(self.eta(), 1),
+                "queue_position": self.queue_ahead,
+                "node": self.current_node,
+            }
+        ))
+
+async def _queue_position(http_client: httpx.AsyncClient, base_url: str, prompt_id: str) -> int:
+    """查询 /queue，返回排在该 prompt 前面的任务数 (含正在执行的)"""
+    try:
+        resp = await http_client.get(f"{base_url}/queue")
+        queue = resp.json()
+    except (httpx.TransportError, ValueError):
+        return 0
+    running = queue.get("queue_running", [])
+    pending = sorted(queue.get("queue_pending", []), key=lambda item: item[0])
+    ahead = len(running)
+    for item in pending:
+        if item[1] == prompt_id:
+            return ahead
+        ahead += 1
+    # 不在等待队列中：已经开始执行
+    return 0
+
+def estimate(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    [新增] 提交前的 ETA 预估 (供调度器在初始 status 消息中返回)
+    返回 {"eta": 秒, "backend": 预计使用的节点}，无可用节点时返回 None
+    """
+    workflow = payload.get("workflow")
+    if not workflow and payload.get("template"):
+        try:
+            workflow = workflow_registry.registry.get(payload["template"]).graph
+        except Exception:
+            return None
+    try:
+        backend = comfy_pool.pool.select(workflow)
+    except RuntimeError:
+        return None
+    wf_key = workflow_key(workflow) if workflow else None
+    return {"eta": round(backend.load_score(wf_key), 1), "backend": backend.url}
+
+async def run(payload: Dict[str, Any], task_id: Optional[str] = None, client_id: Optional[str] = None) -> Dict[str, Any]:
     """
     执行 ComfyUI 任务
+    task_id: (可选) 调度器的任务 ID，用于追踪该任务在 ComfyUI 中的 prompt_id
+    client_id: (可选) 前端 WebSocket ID，提供时会推送 ETA 更新
     payload 结构:
     {
         "workflow": { ... },  # ComfyUI API 格式 JSON
         "inputs": {           # (可选) 按节点 ID 修改输入
             "25": { "image": "data:image/png;base64,..." }, # Base64 会自动上传
+            "26": { "image": "/files/{project_id}/inputs/a.png" }, # workspace 文件: 本机直接放入 input 目录，远程自动上传
             "30": { "text": "A beautiful sunset" },         # 文本直接替换
             "40": { "image": "G:/my_images/test.png" }      # 本地路径直接替换
         },
@@ -76,22 +293,43 @@ async def run(payload: Dict[str, Any]) -> Dict[str, Any]:
             {"name": "mask", "nodeId": "101"}
         ]
     }
+
+    [新增] 模板模式 (无需上传整个工作流 JSON):
+    {
+        "template": "workflow_api.json",  # workspace/workflow 下的文件名
+        "params": {                       # 槽位名 -> 值，槽位见 GET /api/workflows/{name}/slots
+            "image": "data:image/png;base64,...",
+            "prompt": "A beautiful sunset",
+            "seed": 42
+        }
+        # output_nodes 省略时使用模板中识别出的输出节点
+    }
     """
-    client_id = str(uuid.uuid4())
-    ws_url = settings.COMFY_URL.replace("http://", "ws://").replace("https://", "wss://")
-    ws_url = f"{ws_url}/ws?clientId={client_id}"
-    
     # [新增] 获取项目ID
     project_id = payload.get("project_id")
 
     workflow = payload.get("workflow")
     inputs_map = payload.get("inputs", {})
+    default_outputs = []
+
+    # [新增] 模板模式：在服务端缓存的工作流副本上应用参数
+    if payload.get("template"):
+        try:
+            workflow, inputs_map, default_outputs = workflow_registry.registry.compile(
+                payload["template"], payload.get("params", {}), inputs_map
+            )
+        except FileNotFoundError as e:
+            return {"status": "error", "message": str(e)}
+        except (KeyError, ValueError) as e:
+            return {"status": "error", "message": f"Invalid template parameters: {e}"}
     
     # [Modified] 解析输出节点列表
     output_nodes = payload.get("output_nodes", [])
     # 兼容旧字段
     if not output_nodes and payload.get("output_node_id"):
         output_nodes = [{"nodeId": str(payload.get("output_node_id"))}]
+    if not output_nodes:
+        output_nodes = [{"nodeId": node_id} for node_id in default_outputs]
     
     # 提取所有需要监听的 Node ID 集合
     target_node_ids = set(str(n.get("nodeId")) for n in output_nodes if n.get("nodeId"))
@@ -101,6 +339,31 @@ async def run(payload: Dict[str, Any]) -> Dict[str, Any]:
     if not target_node_ids:
         return {"status": "error", "message": "No output nodes provided"}
 
+    # [新增] 从后端池中选择节点；入队前连接失败时换下一个节点重试
+    tried = []
+    while True:
+        try:
+            backend = comfy_pool.pool.acquire(workflow, exclude=tried)
+        except RuntimeError as e:
+            return {"status": "error", "message": str(e)}
+
+        try:
+            return await _run_on_backend(backend, workflow, inputs_map, set(target_node_ids), project_id, task_id, client_id)
+        except BackendUnavailable as e:
+            backend.record_failure(str(e))
+            tried.append(backend)
+            logger.warning(f"ComfyUI backend {backend.url} unavailable, trying another: {e}")
+        finally:
+            comfy_pool.pool.release(backend)
+
+async def _run_on_backend(backend: comfy_pool.ComfyBackend, workflow: Dict[str, Any], inputs_map: Dict[str, Any],
+                          target_node_ids: set, project_id: str, task_id: Optional[str] = None,
+                          client_id: Optional[str] = None) -> Dict[str, Any]:
+    """在指定节点上执行工作流"""
+    task_key = task_id or str(uuid.uuid4())
+    comfy_client_id = str(uuid.uuid4())
+    ws_url = f"{backend.ws_url}/ws?clientId={comfy_client_id}"
+
     # [New] 用于收集所有节点的输出结果
     collected_results = []
 
@@ -111,93 +374,213 @@ async def run(payload: Dict[str, Any]) -> Dict[str, Any]:
             continue
             
         for field_name, value in fields.items():
-            # 智能上传：只有当值是 Base64 图片字符串时才上传
-            if isinstance(value, str) and value.startswith("data:image"):
-                logger.info(f"Uploading image for Node {node_id}, Field {field_name}...")
+            # 智能上传：Base64 图片、/files/... URL 或 workspace 内的文件
+            # [Modified] 本机/共享卷节点直接放入 input 目录，远程节点走 HTTP 上传
+            if isinstance(value, str):
                 try:
-                    filename = await upload_image(value)
-                    workflow[node_id]["inputs"][field_name] = filename
+                    filename = await _prepare_image_input(value, backend.url)
+                except httpx.TransportError as e:
+                    # 只有连不上节点才换节点重试；读取本地文件失败 (OSError) 是任务本身的错误
+                    raise BackendUnavailable(f"Upload failed: {e}")
                 except Exception as e:
                     return {"status": "error", "message": f"Failed to upload image: {str(e)}"}
-            else:
-                # 普通值（文本、数字、本地文件路径）直接替换
-                workflow[node_id]["inputs"][field_name] = value
+                if filename is not None:
+                    logger.info(f"Prepared image for Node {node_id}, Field {field_name}: {filename}")
+                    workflow[node_id]["inputs"][field_name] = filename
+                    continue
+
+            # 普通值（文本、数字、本地文件路径）直接替换
+            workflow[node_id]["inputs"][field_name] = value
 
     # --- 2. 连接并执行 ---
     logger.info(f"Connecting to ComfyUI: {ws_url}")
     try:
-        async with websockets.connect(ws_url) as ws:
+        ws = await websockets.connect(ws_url)
+    except (OSError, websockets.exceptions.InvalidHandshake) as e:
+        raise BackendUnavailable(f"WebSocket connect failed: {e}")
+
+    tracker = _ProgressTracker(workflow, backend.url, client_id, task_id)
+    prompt_id = None
+    # 本 prompt 已保存的输出图片 (filename, subfolder, type) -> 结果项；恢复时不重复下载 / 保存
+    saved_outputs: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+    try:
+        async with ws, httpx.AsyncClient(trust_env=False) as http_client:
             # 发送任务
-            prompt_payload = {"prompt": workflow, "client_id": client_id}
+            prompt_payload = {"prompt": workflow, "client_id": comfy_client_id}
             
-            async with httpx.AsyncClient(trust_env=False) as http_client:
-                resp = await http_client.post(f"{settings.COMFY_URL}/prompt", json=prompt_payload)
-                if resp.status_code != 200:
-                    return {"status": "error", "message": f"ComfyUI Error: {resp.text}"}
-                
-                prompt_id = resp.json().get("prompt_id")
-                logger.info(f"Task Queued: {prompt_id}")
+            try:
+                resp = await http_client.post(f"{backend.url}/prompt", json=prompt_payload)
+            except httpx.TransportError as e:
+                raise BackendUnavailable(f"Submit failed: {e}")
+            if resp.status_code != 200:
+                return {"status": "error", "message": f"ComfyUI Error: {resp.text}"}
+            
+            prompt_id = resp.json().get("prompt_id")
+            active_prompts[task_key] = {"prompt_id": prompt_id, "backend": backend.url, "queued_at": time.time()}
+            logger.info(f"Task Queued: {prompt_id} on {backend.url}")
+
+            # [新增] 查询队列位置并推送初始 ETA
+            tracker.queue_ahead = await _queue_position(http_client, backend.url, prompt_id)
+            await tracker.notify(force=True)
 
             # --- 3. 监听并捕获指定节点的输出 ---
-            while True:
-                out = await ws.recv()
-                if isinstance(out, str):
+            try:
+                while target_node_ids:
+                    out = await ws.recv()
+                    if not isinstance(out, str):
+                        continue
                     message = json.loads(out)
                     msg_type = message["type"]
                     data = message["data"]
 
+                    # [新增] 只统计本 prompt 的事件 (status 等全局事件没有 prompt_id)
+                    if data.get("prompt_id") in (None, prompt_id):
+                        tracker.on_event(msg_type, data)
+                        if msg_type == "status" and tracker.exec_started is None:
+                            tracker.queue_ahead = await _queue_position(http_client, backend.url, prompt_id)
+                        await tracker.notify()
+
                     if msg_type == "executed":
                         node_id = str(data.get("node"))
                         
                         # [Modified] 检查是否在目标列表中
                         if node_id in target_node_ids:
-                            output_data = data.get("output", {})
                             logger.info(f"Target Node {node_id} executed. Capturing output...")
-                            
-                            # 情况 A: 输出是图片
-                            if "images" in output_data:
-                                for image in output_data["images"]:
-                                    # 下载图片
-                                    query = urllib.parse.urlencode({
-                                        "filename": image.get("filename"),
-                                        "subfolder": image.get("subfolder", ""),
-                                        "type": image.get("type", "output")
-                                    })
-                                    img_url = f"{settings.COMFY_URL}/view?{query}"
-                                    
-                                    async with httpx.AsyncClient(trust_env=False) as client:
-                                        img_resp = await client.get(img_url)
-                                        if img_resp.status_code == 200:
-                                            # [Modified] Save to storage and return URL
-                                            save_result = storage.save_generated_image(img_resp.content, prefix="comfy", project_id=project_id)
-                                            collected_results.append({"type": "image", "value": save_result["url"]})
-                                        else:
-                                            logger.error(f"Failed to download output: {img_url}")
-                            
-                            # 情况 B: 输出是文本
-                            elif "text" in output_data:
-                                for text_val in output_data["text"]:
-                                    collected_results.append({"type": "text", "value": text_val})
-                            
-                            # 情况 C: 其他常见文本字段 (string)
-                            elif "string" in output_data:
-                                for text_val in output_data["string"]:
-                                    collected_results.append({"type": "text", "value": text_val})
-                            
+                            # 下载失败 (httpx.TransportError) 时该节点保持未完成，由下面的 /history 恢复流程重新收集
+                            collected_results.extend(
+                                await _collect_node_output(http_client, backend.url, data.get("output", {}), project_id,
+                                                           saved_outputs)
+                            )
                             # [Modified] 标记该节点已完成
                             target_node_ids.discard(node_id)
-                            
-                            # [Modified] 只有当所有目标节点都执行完毕后，才返回结果
-                            if not target_node_ids:
-                                return {
-                                    "status": "success",
-                                    "data": collected_results
-                                }
                     
                     # 监听执行中断
                     elif msg_type == "execution_interrupted":
                          return {"status": "error", "message": "ComfyUI execution interrupted"}
+                    elif msg_type == "execution_error":
+                        return {"status": "error", "message": f"ComfyUI execution error: {data.get('exception_message', '')}"}
 
+            except (websockets.exceptions.ConnectionClosed, OSError, httpx.TransportError) as e:
+                # [新增] WebSocket 断开 (或下载输出失败) 时 ComfyUI 仍在继续渲染，改为轮询 /history 找回结果
+                # 已收集的输出保留在 collected_results 中，下载到一半的节点已保存的图片记录在 saved_outputs 中
+                logger.warning(f"ComfyUI connection lost for prompt {prompt_id}: {e}. Recovering from history...")
+                error = await _recover_from_history(http_client, backend.url, prompt_id, target_node_ids, collected_results,
+                                                    project_id, saved_outputs)
+                if not collected_results:
+                    return {"status": "error", "message": error or f"No outputs recovered for ComfyUI prompt {prompt_id}"}
+                if error:
+                    logger.warning(f"Partial recovery for prompt {prompt_id}: {error}")
+
+            # [Modified] 只有当所有目标节点都执行完毕后，才返回结果
+            backend.record_success(comfy_pool.workflow_signature(workflow))
+            # [新增] 记录执行耗时 (不含排队时间)，供 ETA 估算与调度使用
+            exec_time = tracker.execution_time()
+            if exec_time is not None and not target_node_ids:
+                comfy_stats.record_run(tracker.wf_key, backend.url, exec_time)
+            result = {
+                "status": "success",
+                "data": collected_results,
+                "prompt_id": prompt_id
+            }
+            if target_node_ids:
+                # 部分节点没有产出，但已完成的渲染结果仍然返回
+                result["warning"] = f"No output from nodes: {', '.join(sorted(target_node_ids))}"
+            return result
+
+    except BackendUnavailable:
+        raise
     except Exception as e:
         logger.error(f"ComfyUI Pipeline Failed: {e}", exc_info=True)
         return {"status": "error", "message": str(e)}
+    finally:
+        active_prompts.pop(task_key, None)
+
+async def _collect_node_output(http_client: httpx.AsyncClient, base_url: str, output_data: Dict[str, Any], project_id: str,
+                               saved: Optional[Dict[Tuple[str, str, str], Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    把一个输出节点的结果 (图片/文本) 转换为前端需要的格式，图片会保存到项目目录
+    saved 记录本 prompt 已保存的图片：中途下载失败后重新收集该节点时，已保存的图片直接复用，不重复保存
+    """
+    results = []
+    saved = {} if saved is None else saved
+
+    # 情况 A: 输出是图片
+    if "images" in output_data:
+        for image in output_data["images"]:
+            key = (image.get("filename"), image.get("subfolder", ""), image.get("type", "output"))
+            if key in saved:
+                results.append(saved[key])
+                continue
+            # 下载图片
+            query = urllib.parse.urlencode({"filename": key[0], "subfolder": key[1], "type": key[2]})
+            img_url = f"{base_url}/view?{query}"
+            
+            img_resp = await http_client.get(img_url)
+            if img_resp.status_code == 200:
+                # [Modified] Save to storage (非阻塞写入) and return URL
+                save_result = await storage.save_generated_image_async(img_resp.content, prefix="comfy", project_id=project_id)
+                saved[key] = {"type": "image", "value": save_result["url"]}
+                results.append(saved[key])
+            else:
+                logger.error(f"Failed to download output: {img_url}")
+    
+    # 情况 B: 输出是文本
+    elif "text" in output_data:
+        for text_val in output_data["text"]:
+            results.append({"type": "text", "value": text_val})
+    
+    # 情况 C: 其他常见文本字段 (string)
+    elif "string" in output_data:
+        for text_val in output_data["string"]:
+            results.append({"type": "text", "value": text_val})
+
+    return results
+
+async def _recover_from_history(http_client: httpx.AsyncClient, base_url: str, prompt_id: str, target_node_ids: set,
+                                collected_results: List[Dict[str, Any]], project_id: str,
+                                saved: Optional[Dict[Tuple[str, str, str], Dict[str, Any]]] = None) -> Optional[str]:
+    """
+    [新增] 轮询 /history/{prompt_id}，收集仍未拿到的目标节点输出
+    已完成的节点立即收集，其余节点继续等待，直到 prompt 结束或超时
+    saved 见 _collect_node_output (跨多次重试共用，避免重复保存)
+    返回错误信息 (成功时返回 None)
+    """
+    saved = {} if saved is None else saved
+    deadline = time.monotonic() + settings.COMFY_RECOVERY_TIMEOUT
+    interval = 1.0
+    while target_node_ids and time.monotonic() < deadline:
+        try:
+            resp = await http_client.get(f"{base_url}/history/{prompt_id}")
+            entry = resp.json().get(prompt_id) if resp.status_code == 200 else None
+        except (httpx.TransportError, ValueError) as e:
+            logger.warning(f"History poll failed for {prompt_id}: {e}")
+            entry = None
+
+        if entry:
+            outputs = entry.get("outputs", {})
+            for node_id in list(target_node_ids):
+                if node_id in outputs:
+                    try:
+                        collected_results.extend(
+                            await _collect_node_output(http_client, base_url, outputs[node_id], project_id, saved)
+                        )
+                    except httpx.TransportError as e:
+                        logger.warning(f"Fetching output of Node {node_id} failed, will retry: {e}")
+                        continue
+                    logger.info(f"Recovered output of Node {node_id} from history")
+                    target_node_ids.discard(node_id)
+
+            status = entry.get("status", {})
+            if status.get("status_str") == "error":
+                return f"ComfyUI execution failed (prompt {prompt_id})"
+            if status.get("completed"):
+                break
+
+        await asyncio.sleep(interval)
+        interval = min(interval * 1.5, 5.0)
+
+    if target_node_ids and time.monotonic() >= deadline:
+        return f"Timed out waiting for ComfyUI prompt {prompt_id}"
+    if target_node_ids:
+        return f"ComfyUI prompt {prompt_id} finished without output from nodes: {', '.join(sorted(target_node_ids))}"
+    return None
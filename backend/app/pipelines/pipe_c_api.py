@@ -8,10 +8,22 @@ import base64
 import httpx
 import io
 import os
-from typing import Dict, Any
+import time
+import asyncio
+import hashlib
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+from config import settings
 from app.websocket_manager import manager
 from app.schemas import WSMessage
 from app.utils import storage
+from app.utils import response_cache # [新增] 确定性调用的响应缓存
+from app.utils import image_budget # [新增] 图片预算预处理
+from app.utils import rate_limiter # [新增] 提供商限流与重试
+from app.utils import health # [新增] 后端熔断器
+from app.utils import asset_index # [新增] 素材元数据索引
 
 logger = logging.getLogger("backend.pipe_c")
 
@@ -32,12 +44,70 @@ try:
 except ImportError:
     GOOGLE_GENAI_AVAILABLE = False
 
-async def _load_image_pil(image_input: Any) -> Any:
-    """Helper: Load image input as PIL Image for Google SDK"""
+# 原样转发给 LiteLLM 的生成参数 (都计入响应缓存键，见 response_cache.KEY_PARAMS)
+CHAT_PARAMS = (
+    "temperature", "max_tokens", "top_p", "stop", "frequency_penalty", "presence_penalty", "seed",
+    "tools", "tool_choice", "response_format", "logit_bias", "reasoning_effort",
+)
+IMAGE_PARAMS = ("n", "size", "response_format", "quality", "style")
+
+# [新增] 流式输出的合并策略：每 50ms 或每累积 N 个片段向前端推送一次
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_FLUSH_CHUNKS = 16
+
+class _DeltaStreamer:
+    """
+    把模型逐 token 返回的增量合并后，以 WSMessage(type="progress") 推送给前端
+    data: {"delta": 本次新增文本, "index": 第几次推送}
+    """
+    def __init__(self, client_id: Optional[str], task_id: Optional[str]):
+        self.client_id = client_id
+        self.task_id = task_id
+        self.parts = []        # 完整内容
+        self.pending = []      # 尚未推送的增量
+        self.index = 0
+        self.last_flush = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.client_id and self.task_id)
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+    async def push(self, delta: Optional[str]):
+        if not delta:
+            return
+        self.parts.append(delta)
+        self.pending.append(delta)
+        if len(self.pending) >= STREAM_FLUSH_CHUNKS or time.monotonic() - self.last_flush >= STREAM_FLUSH_INTERVAL:
+            await self.flush()
+
+    async def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending or not self.enabled:
+            self.pending = []
+            return
+        delta = "".join(self.pending)
+        self.pending = []
+        await manager.send_to_client(self.client_id, WSMessage(
+            type="progress",
+            task_id=self.task_id,
+            data={"delta": delta, "index": self.index}
+        ))
+        self.index += 1
+
+async def _load_image_bytes(image_input: Any) -> Optional[bytes]:
+    """Helper: Load image input (URL / data URL / Base64 / bytes) as raw bytes"""
     try:
         data = None
         if isinstance(image_input, str):
-            if image_input.startswith("http"):
+            if image_input.startswith("blob://"):
+                # [新增] 二进制上传的 Blob 句柄
+                path = storage.resolve_workspace_path(image_input)
+                data = await asyncio.to_thread(path.read_bytes) if path else None
+            elif image_input.startswith("http"):
                 async with httpx.AsyncClient() as client:
                     resp = await client.get(image_input)
                     if resp.status_code == 200:
@@ -56,23 +126,189 @@ async def _load_image_pil(image_input: Any) -> Any:
         elif isinstance(image_input, bytes):
             data = image_input
             
-        if data:
-            return Image.open(io.BytesIO(data))
+        return data
     except Exception as e:
-        logger.warning(f"Failed to load PIL image: {e}")
+        logger.warning(f"Failed to load image: {e}")
     return None
 
-async def _run_google_genai(payload: Dict[str, Any]) -> Dict[str, Any]:
+async def _prepare_image(image_input: Any, model: str) -> Optional[tuple]:
+    """
+    [新增] 按模型的像素 / 字节预算预处理图片，返回 (bytes, mime_type)
+    已满足预算的源图原样透传，结果按内容哈希缓存 (见 app/utils/image_budget.py)
+    """
+    max_pixels, max_bytes = image_budget.budget_for(model)
+    # [新增] 工作区素材直接读本地文件 (不经 HTTP 回环)；元数据索引表明已满足预算时不再解析图片
+    path = None
+    if isinstance(image_input, str) and image_input.startswith(("http", "/files/")):
+        path = storage.resolve_workspace_path(image_input)
+    try:
+        if path is not None:
+            meta = await storage.run_io(asset_index.index.get, path)
+            data = await storage.run_io(path.read_bytes)
+            if meta and image_budget.within_budget(meta, max_pixels, max_bytes):
+                return data, meta["mime"]
+        else:
+            data = await _load_image_bytes(image_input)
+        if not data:
+            return None
+        return await image_budget.prepared.get_or_fit(data, max_pixels, max_bytes, executor=_genai_executor)
+    except Exception as e:
+        logger.warning(f"Failed to preprocess image: {e}")
+        return None
+
+async def _budget_messages(messages: list, model: str) -> list:
+    """
+    [新增] LiteLLM 消息中内嵌的图片 (data URL / blob://) 按预算压缩后重新生成 data URL
+    远程 http 图片由模型服务自行下载，不做处理；不修改原始 payload
+    """
+    async def _budget_item(item):
+        url = (item.get("image_url") or {}).get("url") if isinstance(item, dict) and item.get("type") == "image_url" else None
+        # blob:// 句柄模型服务无法访问，必须转换为 data URL
+        if isinstance(url, str) and (url.startswith("data:") or url.startswith("blob://")):
+            prepared = await _prepare_image(url, model)
+            if prepared:
+                data, mime_type = prepared
+                url = f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+                item = {**item, "image_url": {**item["image_url"], "url": url}}
+        return item
+
+    result = []
+    for msg in messages:
+        content = msg.get("content") if isinstance(msg, dict) else None
+        if not isinstance(content, list):
+            result.append(msg)
+            continue
+        items = await _gather_limited([_budget_item(item) for item in content])
+        result.append({**msg, "content": items})
+    return result
+
+async def _gather_limited(coros: list) -> list:
+    """[新增] 并发执行 (最多 IMAGE_LOAD_CONCURRENCY 个)，结果保持原顺序"""
+    sem = asyncio.Semaphore(settings.IMAGE_LOAD_CONCURRENCY)
+
+    async def _limited(coro):
+        async with sem:
+            return await coro
+
+    return await asyncio.gather(*(_limited(c) for c in coros))
+
+# [新增] Gemini 客户端池 (按 API Key 复用，避免每次请求重新创建客户端)
+_genai_clients: "OrderedDict[str, Any]" = OrderedDict()
+# [新增] Gemini 专用线程池：仍需同步执行的 CPU 密集操作 (图片预算缩放、Base64 编码等) 不再占用默认线程池
+# (文件写入走 storage 自己的 I/O 线程池)
+_genai_executor = ThreadPoolExecutor(max_workers=settings.GENAI_EXECUTOR_WORKERS, thread_name_prefix="genai")
+
+async def _run_in_genai_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_genai_executor, functools.partial(func, *args, **kwargs))
+
+def _get_genai_client(api_key: str):
+    """从客户端池取出 (或创建) 该 API Key 对应的客户端，池满时淘汰最久未用的"""
+    key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    client = _genai_clients.get(key)
+    if client is None:
+        client = genai.Client(api_key=api_key)
+        _genai_clients[key] = client
+        while len(_genai_clients) > settings.GENAI_CLIENT_POOL_SIZE:
+            _genai_clients.popitem(last=False)
+    else:
+        _genai_clients.move_to_end(key)
+    return client
+
+async def _image_part(image_input: Any, model: str):
+    """加载图片 (经预算预处理) 并转换为 Gemini 的 inline_data Part，失败时返回 None"""
+    prepared = await _prepare_image(image_input, model)
+    if not prepared:
+        return None
+    data, mime_type = prepared
+    return types.Part(inline_data=types.Blob(mime_type=mime_type, data=data))
+
+class _PartCache:
+    """
+    [新增] 会话级 Part 缓存：(会话, 模型:图片来源哈希) -> Part
+    多轮对话每次都会带上完整历史，历史中的图片只需加载 / 编码一次
+    按 Part 中图片数据的总字节数限制容量，所有会话共享同一个 LRU (只在事件循环线程中读写)
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (Part, 字节数)
+
+    def get(self, key: tuple):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key: tuple, part, size: int):
+        if size > self.max_bytes:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self._items[key] = (part, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self._items.popitem(last=False)
+            self.size -= evicted
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._items), "bytes": self.size}
+
+_conversation_parts = _PartCache(settings.GENAI_PART_CACHE_MB * 1024 * 1024)
+
+async def _image_parts(sources: list, model: str, conversation: Optional[str] = None) -> list:
+    """
+    [新增] 并发加载一组图片 Part (数量受 IMAGE_LOAD_CONCURRENCY 限制)，返回与 sources 等长的列表
+    指定 conversation 时，同一会话中已加载过的图片直接复用
+    """
+    async def _load(source):
+        raw = source if isinstance(source, bytes) else str(source).encode("utf-8")
+        key = (conversation, f"{model}:{hashlib.sha1(raw).hexdigest()}")
+        if conversation:
+            part = _conversation_parts.get(key)
+            if part is not None:
+                return part
+        part = await _image_part(source, model)
+        if part and conversation:
+            _conversation_parts.put(key, part, len(part.inline_data.data))
+        return part
+
+    return await _gather_limited([_load(s) for s in sources])
+
+async def _limited_call(payload: Dict[str, Any], model: str, factory, **kwargs):
+    """
+    [新增] 在熔断器与提供商 / 模型限流、重试保护下执行一次调用，参数见 rate_limiter.RateLimiterRegistry.call
+    自定义 base_url 按主机登记熔断器 (并由健康注册表定期探测)，其余按提供商登记
+    """
+    base_url = payload.get("base_url")
+    provider = rate_limiter.provider_of(model, base_url)
+    breaker = health.registry.register_base_url(base_url) if base_url else health.registry.register(f"api:{provider}")
+    # 熔断中直接失败，不进入限流队列
+    if not breaker.is_available():
+        raise health.CircuitOpenError(breaker.unavailable_message())
+    return await rate_limiter.limits.call(
+        provider, model, lambda: health.registry.call(breaker, factory),
+        est_tokens=rate_limiter.estimate_tokens(payload), **kwargs
+    )
+
+def _genai_usage(response) -> Optional[int]:
+    return getattr(getattr(response, "usage_metadata", None), "total_token_count", None)
+
+async def _run_google_genai(payload: Dict[str, Any], client_id: Optional[str] = None, task_id: Optional[str] = None) -> Dict[str, Any]:
     """
     Native Google GenAI SDK call for Gemini models
     Supports: Chat, Vision, Image Generation (Imagen 3)
+    [新增] 使用 SDK 的异步接口 (client.aio)；payload["stream"] 为 True 时流式推送文本
     """
     try:
         api_key = payload.get("api_key") or os.getenv("GEMINI_API_KEY")
         if not api_key:
              return {"status": "error", "message": "Missing API Key for Gemini"}
 
-        client = genai.Client(api_key=api_key)
+        client = _get_genai_client(api_key)
         
         # Clean model name (remove 'gemini/' prefix if coming from frontend)
         model = payload.get("model", "gemini-1.5-flash")
@@ -80,9 +316,19 @@ async def _run_google_genai(payload: Dict[str, Any]) -> Dict[str, Any]:
             model = model.replace("gemini/", "", 1)
 
         contents = []
+        # [新增] 会话标识 (前端未传 conversation_id 时按客户端连接区分)，用于复用历史图片
+        conversation = payload.get("conversation_id") or client_id
         
         # 1. Handle Chat History (messages)
         if payload.get("messages"):
+            # [Modified] 先收集所有图片来源并发加载，再按原顺序组装
+            sources = [
+                item["image_url"]["url"]
+                for msg in payload["messages"] if isinstance(msg["content"], list)
+                for item in msg["content"] if item["type"] == "image_url"
+            ]
+            loaded = iter(await _image_parts(sources, model, conversation))
+
             for msg in payload["messages"]:
                 role = "user" if msg["role"] == "user" else "model"
                 parts = []
@@ -95,13 +341,9 @@ async def _run_google_genai(payload: Dict[str, Any]) -> Dict[str, Any]:
                         if item["type"] == "text":
                             parts.append(types.Part(text=str(item["text"])))
                         elif item["type"] == "image_url":
-                            img = await _load_image_pil(item["image_url"]["url"])
-                            if img:
-                                b = io.BytesIO()
-                                fmt = img.format or "PNG"
-                                img.save(b, format=fmt)
-                                mime_type = f"image/{fmt.lower()}"
-                                parts.append(types.Part(inline_data=types.Blob(mime_type=mime_type, data=b.getvalue())))
+                            part = next(loaded)
+                            if part:
+                                parts.append(part)
                 
                 if parts:
                     contents.append(types.Content(role=role, parts=parts))
@@ -110,13 +352,9 @@ async def _run_google_genai(payload: Dict[str, Any]) -> Dict[str, Any]:
         elif payload.get("prompt"):
             parts = [types.Part(text=str(payload["prompt"]))]
             if payload.get("image"):
-                img = await _load_image_pil(payload["image"])
-                if img:
-                    b = io.BytesIO()
-                    fmt = img.format or "PNG"
-                    img.save(b, format=fmt)
-                    mime_type = f"image/{fmt.lower()}"
-                    parts.append(types.Part(inline_data=types.Blob(mime_type=mime_type, data=b.getvalue())))
+                part = (await _image_parts([payload["image"]], model, conversation))[0]
+                if part:
+                    parts.append(part)
             contents.append(types.Content(role="user", parts=parts))
 
         # Config: Enable Image Generation
@@ -126,45 +364,67 @@ async def _run_google_genai(payload: Dict[str, Any]) -> Dict[str, Any]:
 
         logger.info(f"🚀 Google GenAI Call: {model}")
 
-        # Execute in thread pool (SDK is sync)
-        def _call_sync():
-            return client.models.generate_content(
-                model=model,
-                contents=contents,
-                config=config
+        # Parse Response
+        streamer = _DeltaStreamer(client_id, task_id)
+        inline_images = []
+        raw = None
+
+        def _collect(parts):
+            for part in parts or []:
+                if part.inline_data:
+                    inline_images.append(part.inline_data)
+
+        if payload.get("stream"):
+            # [新增] 流式：文本增量推送给前端，图片在结束后统一保存
+            async def _consume_stream():
+                last = None
+                stream = await client.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+                async for chunk in stream:
+                    for part in chunk.parts or []:
+                        await streamer.push(part.text)
+                    _collect(chunk.parts)
+                    last = chunk
+                await streamer.flush()
+                return last
+
+            # 已经推送过内容的流不再重试，避免前端收到重复文本
+            await _limited_call(payload, model, _consume_stream, usage_of=_genai_usage, can_retry=lambda: not streamer.parts)
+        else:
+            response = await _limited_call(
+                payload, model,
+                lambda: client.aio.models.generate_content(model=model, contents=contents, config=config),
+                usage_of=_genai_usage,
             )
-        
-        import asyncio
-        loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(None, _call_sync)
+            for part in response.parts or []:
+                if part.text:
+                    streamer.parts.append(part.text)
+            _collect(response.parts)
+            # [Modified] 原始响应包含内联图片数据，仅在 payload["include_raw"] 时回传
+            if payload.get("include_raw"):
+                raw = str(response)
 
-        # Parse Response
-        text_content = ""
+        text_content = streamer.content
         images = []
-        
-        if response.parts:
-            for part in response.parts:
-                if part.text:
-                    text_content += part.text
-                if part.inline_data:
-                    # Convert raw bytes to base64 data URI
-                    img_bytes = part.inline_data.data
-                    
-                    # Save to project if available
-                    project_id = payload.get("project_id")
-                    if project_id:
-                        save_res = storage.save_generated_image(img_bytes, prefix="gemini_gen", project_id=project_id)
-                        images.append(save_res["url"])
-                    else:
-                        b64_str = base64.b64encode(img_bytes).decode('utf-8')
-                        mime = part.inline_data.mime_type or "image/png"
-                        images.append(f"data:{mime};base64,{b64_str}")
+        project_id = payload.get("project_id")
+        for blob in inline_images:
+            img_bytes = blob.data
+            # Save to project if available
+            if project_id:
+                save_res = await storage.save_generated_image_async(img_bytes, prefix="gemini_gen", project_id=project_id)
+                images.append(save_res["url"])
+            else:
+                # Convert raw bytes to base64 data URI
+                b64_str = (await _run_in_genai_executor(base64.b64encode, img_bytes)).decode('utf-8')
+                mime = blob.mime_type or "image/png"
+                images.append(f"data:{mime};base64,{b64_str}")
 
         result_data = {
             "content": text_content,
             "images": images,
-            "raw": str(response)
+            "raw": raw
         }
+        if payload.get("stream"):
+            result_data["streamed"] = True
         
         if not text_content and not images:
              result_data["content"] = "⚠️ Empty response from Gemini."
@@ -175,9 +435,10 @@ async def _run_google_genai(payload: Dict[str, Any]) -> Dict[str, Any]:
         logger.error(f"❌ Google GenAI Error: {e}")
         return {"status": "error", "message": str(e)}
 
-async def run(payload: Dict[str, Any]) -> Dict[str, Any]:
+async def run(payload: Dict[str, Any], client_id: Optional[str] = None, task_id: Optional[str] = None) -> Dict[str, Any]:
     """
     通用大模型调用接口。
+    client_id / task_id: (可选) 流式模式下用于向前端推送增量内容
 
     支持 "protocol": "litellm" 模式
     直接使用 Python litellm 库调用所有主流大模型。
@@ -186,6 +447,9 @@ async def run(payload: Dict[str, Any]) -> Dict[str, Any]:
     - model: 模型名称 (如 "gpt-4", "claude-3-opus", "ollama/llama3")
     - messages: 对话历史
     - api_key, base_url 等可选参数
+    - stream: (可选) True 时流式生成，增量内容以 progress 消息推送，最终 complete 消息包含完整内容与用量
+    - cache / cache_control: (可选) 响应缓存控制，见 app/utils/response_cache.py
+    - include_raw: (可选) 调试用，结果中附带模型的原始响应 (可能包含完整的 Base64 图片)
 
     支持 "protocol": "litellm_image" 模式
     调用 DALL-E 3, Imagen 等生图模型。
@@ -194,18 +458,36 @@ async def run(payload: Dict[str, Any]) -> Dict[str, Any]:
     - model: "dall-e-3", "vertex_ai/imagen-3"
     - prompt: "A cute cat"
     """
+    # --- [新增] 响应缓存：LiteLLM 对话中 temperature=0 / 固定 seed 的调用直接复用上次结果 ---
+    rc = response_cache.cache
+    cache_key = rc.make_key(payload) if rc.is_cacheable(payload) else None
+    if cache_key is None:
+        rc.skip()
+    elif payload.get("cache_control") != "no-cache":
+        cached = await rc.get(cache_key)
+        if cached:
+            logger.info(f"⚡ Response cache hit: {payload.get('model')}")
+            return {**cached, "data": {**cached.get("data", {}), "cached": True}}
+
+    result = await _run_uncached(payload, client_id, task_id)
+    if cache_key and result.get("status") == "success":
+        await rc.put(cache_key, result)
+    return result
+
+async def _run_uncached(payload: Dict[str, Any], client_id: Optional[str] = None, task_id: Optional[str] = None) -> Dict[str, Any]:
+    """按协议分发到具体的调用实现"""
     # --- 0. Google GenAI 原生调用 (针对 Gemini 模型) ---
     model = payload.get("model", "").lower()
     if model.startswith("gemini") or "gemini" in model:
         if not GOOGLE_GENAI_AVAILABLE:
              return {"status": "error", "message": "google-genai library not installed. Please run `pip install google-genai`"}
-        return await _run_google_genai(payload)
+        return await _run_google_genai(payload, client_id, task_id)
 
     # --- 1. LiteLLM 库调用模式 ---
     if payload.get("protocol") == "litellm":
         if litellm is None:
             return {"status": "error", "message": "LiteLLM library not installed. Please run `pip install litellm`"}
-        return await _run_litellm(payload)
+        return await _run_litellm(payload, client_id, task_id)
 
     # --- 1.5 LiteLLM 图片生成模式 ---
     if payload.get("protocol") == "litellm_image":
@@ -215,7 +497,7 @@ async def run(payload: Dict[str, Any]) -> Dict[str, Any]:
 
     return {"status": "error", "message": "Unknown protocol. Please use 'litellm' or 'litellm_image'."}
 
-async def _run_litellm(payload: Dict[str, Any]) -> Dict[str, Any]:
+async def _run_litellm(payload: Dict[str, Any], client_id: Optional[str] = None, task_id: Optional[str] = None) -> Dict[str, Any]:
     """
     使用 LiteLLM 库进行通用大模型调用
     """
@@ -232,7 +514,7 @@ async def _run_litellm(payload: Dict[str, Any]) -> Dict[str, Any]:
         # 构造参数
         kwargs = {
             "model": model,
-            "messages": payload.get("messages", []),
+            "messages": await _budget_messages(payload.get("messages", []), model),
             "stream": False,
         }
 
@@ -254,25 +536,125 @@ async def _run_litellm(payload: Dict[str, Any]) -> Dict[str, Any]:
                     os.environ["NO_PROXY"] = f"{no_proxy},localhost,127.0.0.1".lstrip(",")
             
         # 透传常见参数
-        for key in ["temperature", "max_tokens", "top_p", "stop", "frequency_penalty", "presence_penalty"]:
+        for key in CHAT_PARAMS:
             if key in payload:
                 kwargs[key] = payload[key]
 
         logger.info(f"🚀 LiteLLM Call: {kwargs['model']}")
+
+        # [新增] 流式模式
+        if payload.get("stream"):
+            streamer = _DeltaStreamer(client_id, task_id)
+            return await _limited_call(
+                payload, kwargs["model"], lambda: _stream_litellm(kwargs, streamer),
+                usage_of=lambda r: (r["data"].get("usage") or {}).get("total_tokens"),
+                can_retry=lambda: not streamer.parts,
+            )
         
         # 异步调用 (acompletion 是 litellm 的异步方法)
         # 注意：开启 stream=True 后，返回的是一个 AsyncGenerator
-        response = await litellm.acompletion(**kwargs)
+        # [Modified] 经限流器排队，429 / 5xx 自动退避重试
+        response = await _limited_call(
+            payload, kwargs["model"], lambda: litellm.acompletion(**kwargs),
+            usage_of=lambda r: getattr(getattr(r, "usage", None), "total_tokens", None),
+        )
         
         # 提取文本内容
         content = response.choices[0].message.content
+        usage = response.usage.model_dump() if getattr(response, "usage", None) else None
         # 返回标准化结果
-        return {"status": "success", "data": {"content": content, "raw": response.model_dump()}}
+        return {"status": "success", "data": {"content": content, "usage": usage, "raw": response.model_dump()}}
 
     except Exception as e:
         logger.error(f"❌ LiteLLM Error: {e}")
         return {"status": "error", "message": str(e)}
 
+async def _stream_litellm(kwargs: Dict[str, Any], streamer: _DeltaStreamer) -> Dict[str, Any]:
+    """
+    [新增] 消费 acompletion(stream=True) 的 AsyncGenerator
+    增量内容合并后推送 progress 消息，结束时返回完整内容与 token 用量
+    """
+    kwargs = {**kwargs, "stream": True, "stream_options": {"include_usage": True}}
+    usage = None
+    finish_reason = None
+
+    response = await litellm.acompletion(**kwargs)
+    async for chunk in response:
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage.model_dump() if hasattr(chunk.usage, "model_dump") else dict(chunk.usage)
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        finish_reason = choice.finish_reason or finish_reason
+        await streamer.push(getattr(choice.delta, "content", None))
+    await streamer.flush()
+
+    return {
+        "status": "success",
+        "data": {
+            "content": streamer.content,
+            "usage": usage,
+            "finish_reason": finish_reason,
+            "streamed": True
+        }
+    }
+
+async def _save_image_item(item: Any, project_id: Optional[str], http_client: httpx.AsyncClient) -> Optional[str]:
+    """
+    [新增] 处理一条生图结果，返回前端可用的图片地址 (失败时尽量返回原始值)
+    远程 URL 流式写入磁盘；Base64 解码与写文件放到线程中执行，不阻塞事件循环
+    """
+    val = None
+    # 尝试对象属性访问 (忽略 AttributeError)
+    try:
+        val = getattr(item, 'url', None) or getattr(item, 'b64_json', None)
+    except AttributeError:
+        pass
+    
+    # 尝试字典访问
+    if not val and isinstance(item, dict):
+        val = item.get('url') or item.get('b64_json')
+    
+    if not val:
+        return None
+
+    # [Fix] 如果是 Base64 且没有前缀，补上前缀
+    if isinstance(val, str) and len(val) > 200 and not val.startswith('http') and not val.startswith('data:'):
+        val = f"data:image/png;base64,{val}"
+    
+    # [New] 自动保存到项目文件夹
+    if not project_id:
+        return val
+    try:
+        save_result = None
+        # 情况 A: 远程 URL (如 DALL-E 3) -> 边下载边写入
+        if val.startswith("http"):
+            async with http_client.stream("GET", val) as resp:
+                if resp.status_code == 200:
+                    save_result = await storage.save_generated_stream(resp.aiter_bytes(), prefix="ai_gen", project_id=project_id)
+        
+        # 情况 B: Base64 (如 Stable Diffusion/Gemini) -> 解码并保存
+        elif val.startswith("data:image"):
+            _, encoded = val.split(",", 1)
+            img_bytes = await asyncio.to_thread(base64.b64decode, encoded)
+            save_result = await storage.save_generated_image_async(img_bytes, prefix="ai_gen", project_id=project_id)
+        
+        if save_result:
+            val = save_result["url"] # 替换为本地 URL
+            logger.info(f"💾 Saved AI image to: {val}")
+    except Exception as e:
+        logger.error(f"Failed to save generated image: {e}")
+    return val
+
+async def _blob_file(ref: str, name: str) -> io.BytesIO:
+    """[新增] 读取 Blob 句柄为带文件名的 BytesIO (LiteLLM 图片编辑接口需要文件对象)"""
+    path = storage.resolve_workspace_path(ref)
+    if path is None:
+        raise FileNotFoundError(f"Blob not found or expired: {ref}")
+    f = io.BytesIO(await asyncio.to_thread(path.read_bytes))
+    f.name = name # 必须设置文件名，否则部分库会报错
+    return f
+
 async def _run_litellm_image(payload: Dict[str, Any]) -> Dict[str, Any]:
     """
     使用 LiteLLM 库进行图片生成 (DALL-E 3, Imagen 3 等)
@@ -315,8 +697,11 @@ async def _run_litellm_image(payload: Dict[str, Any]) -> Dict[str, Any]:
         # [Fix] 支持图生图/编辑模式传入 image
         if payload.get("image"):
             img_input = payload["image"]
+            # [新增] Blob 句柄：直接以文件对象上传，不经过 Base64
+            if isinstance(img_input, str) and img_input.startswith("blob://"):
+                kwargs["image"] = await _blob_file(img_input, "image.png")
             # 如果是 Data URL，转换为 BytesIO 对象 (模拟文件上传)
-            if isinstance(img_input, str) and img_input.startswith("data:"):
+            elif isinstance(img_input, str) and img_input.startswith("data:"):
                 try:
                     if "," in img_input:
                         _, encoded = img_input.split(",", 1)
@@ -335,7 +720,9 @@ async def _run_litellm_image(payload: Dict[str, Any]) -> Dict[str, Any]:
         # [New] 支持 Mask (用于 Inpainting)
         if payload.get("mask"):
             mask_input = payload["mask"]
-            if isinstance(mask_input, str) and mask_input.startswith("data:"):
+            if isinstance(mask_input, str) and mask_input.startswith("blob://"):
+                kwargs["mask"] = await _blob_file(mask_input, "mask.png")
+            elif isinstance(mask_input, str) and mask_input.startswith("data:"):
                 try:
                     if "," in mask_input:
                         _, encoded = mask_input.split(",", 1)
@@ -351,18 +738,23 @@ async def _run_litellm_image(payload: Dict[str, Any]) -> Dict[str, Any]:
                 kwargs["mask"] = mask_input
             
         # 透传常见参数 (n=数量, size=尺寸, response_format=url/b64_json)
-        for key in ["n", "size", "response_format", "quality", "style"]:
+        for key in IMAGE_PARAMS:
             if key in payload:
                 kwargs[key] = payload[key]
 
         logger.info(f"🚀 LiteLLM Image Gen: {kwargs['model']}")
         
-        # 异步调用
-        response = await litellm.aimage_generation(**kwargs)
-        logger.info(f"📸 Raw Response: {response}")
+        # 异步调用 [Modified] 经限流器排队与重试；重试前把上传文件指针复位
+        def _image_call():
+            for key in ("image", "mask"):
+                if hasattr(kwargs.get(key), "seek"):
+                    kwargs[key].seek(0)
+            return litellm.aimage_generation(**kwargs)
+
+        response = await _limited_call(payload, kwargs["model"], _image_call)
+        logger.debug(f"📸 Raw Response: {str(response)[:500]}")
         
         # 提取结果 (兼容 OpenAI 格式对象或字典)
-        images = []
         data_items = []
         project_id = payload.get("project_id")
 
@@ -371,60 +763,20 @@ async def _run_litellm_image(payload: Dict[str, Any]) -> Dict[str, Any]:
         elif isinstance(response, dict) and 'data' in response:
             data_items = response['data']
 
-        for item in data_items:
-            val = None
-            # 尝试对象属性访问 (忽略 AttributeError)
-            try:
-                val = getattr(item, 'url', None) or getattr(item, 'b64_json', None)
-            except AttributeError:
-                pass
-            
-            # 尝试字典访问
-            if not val and isinstance(item, dict):
-                val = item.get('url') or item.get('b64_json')
-            
-            if val:
-                # [Fix] 如果是 Base64 且没有前缀，补上前缀
-                if isinstance(val, str) and len(val) > 200 and not val.startswith('http') and not val.startswith('data:'):
-                    val = f"data:image/png;base64,{val}"
-                
-                # [New] 自动保存到项目文件夹
-                if project_id:
-                    try:
-                        image_content = None
-                        # 情况 A: 远程 URL (如 DALL-E 3) -> 下载并保存
-                        if val.startswith("http"):
-                            async with httpx.AsyncClient() as client:
-                                resp = await client.get(val)
-                                if resp.status_code == 200:
-                                    image_content = resp.content
-                        
-                        # 情况 B: Base64 (如 Stable Diffusion/Gemini) -> 解码并保存
-                        elif val.startswith("data:image"):
-                            try:
-                                _, encoded = val.split(",", 1)
-                                image_content = base64.b64decode(encoded)
-                            except Exception:
-                                pass
-                        
-                        if image_content:
-                            save_result = storage.save_generated_image(image_content, prefix="ai_gen", project_id=project_id)
-                            val = save_result["url"] # 替换为本地 URL
-                            logger.info(f"💾 Saved AI image to: {val}")
-                    except Exception as e:
-                        logger.error(f"Failed to save generated image: {e}")
-
-                images.append(val)
+        # [Modified] 多张结果并发下载 / 解码 / 保存，共用一个 HTTP 客户端
+        async with httpx.AsyncClient() as http_client:
+            results = await asyncio.gather(*(_save_image_item(item, project_id, http_client) for item in data_items))
+        images = [val for val in results if val]
         
         # 返回标准化结果
-        result_data = {
-            "images": images, 
-            "raw": response.model_dump() if hasattr(response, "model_dump") else str(response)
-        }
+        # [Modified] 原始响应通常包含完整的 Base64 图片，默认不再回传，调试时用 payload["include_raw"] 开启
+        result_data = {"images": images}
+        if payload.get("include_raw"):
+            result_data["raw"] = response.model_dump() if hasattr(response, "model_dump") else str(response)
 
         # [Fix] 如果没有生成图片，返回提示信息防止前端卡死
         if not images:
-            result_data["content"] = "⚠️ 生成结果为空 (No images returned)。\n请检查下方原始响应以排查问题:\n" + str(result_data["raw"])
+            result_data["content"] = "⚠️ 生成结果为空 (No images returned)。\n请检查下方原始响应以排查问题:\n" + str(response)
 
         return {
             "status": "success", 
@@ -2,77 +2,222 @@
 backend/app/pipelines/pipe_d_gemini_local.py
 Pipeline D: 本地 Gemini 服务调用 (Port 8021)
 通常用于调用本地运行的浏览器自动化/爬虫版 Gemini
+[新增] 8021 服务同一时间只能处理一个对话，并发调用会互相干扰：
+- 所有请求进入单并发队列依次执行，排队中的任务会收到队列位置更新
+- 会话亲和：当前浏览器对话所属会话的后续消息 (new_chat=False) 优先执行，
+  连续插队最多 GEMINI_LOCAL_MAX_AFFINITY 次，之后先执行队首任务，其他客户端不会一直等待
+- 复用一个长连接 HTTP 客户端
 """
 import logging
-import base64
+import asyncio
 import os
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 import httpx
 from config import settings
 from app.utils import storage
+from app.utils import health
+from app.websocket_manager import manager
+from app.schemas import WSMessage
 
 logger = logging.getLogger("backend.pipe_d_local")
 
-async def run(payload: Dict[str, Any]) -> Dict[str, Any]:
+# [新增] 长连接客户端 (懒加载，关闭见 close())
+_client: Optional[httpx.AsyncClient] = None
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        # trust_env=False 忽略代理，timeout 设置长一点因为本地爬虫处理可能较慢
+        _client = httpx.AsyncClient(
+            trust_env=False,
+            timeout=120.0,
+            limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+        )
+    return _client
+
+async def close():
+    """关闭长连接客户端 (在 lifespan 关闭阶段调用)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# [新增] 8021 服务的熔断器 (第一次调用后健康注册表定期探测服务根路径)
+_breaker = health.registry.register("gemini_local", probe_url=f"{settings.GEMINI_LOCAL_URL}/")
+
+
+class _Job:
+    def __init__(self, payload: Dict[str, Any], task_id: Optional[str], client_id: Optional[str]):
+        self.payload = payload
+        self.task_id = task_id
+        self.client_id = client_id
+        # 会话标识：前端未传 conversation_id 时按客户端连接区分
+        self.conversation = payload.get("conversation_id") or client_id
+        self.new_chat = payload.get("new_chat", True)
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class _SessionQueue:
+    """单并发任务队列 (全局单例见模块底部的 session_queue)"""
+
+    def __init__(self):
+        self.pending: List[_Job] = []
+        self.running: Optional[_Job] = None
+        self.active_conversation: Optional[str] = None   # 浏览器当前对话所属的会话
+        self.affinity_streak = 0                          # 会话亲和连续插队的次数
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, payload: Dict[str, Any], task_id: Optional[str] = None, client_id: Optional[str] = None) -> Dict[str, Any]:
+        # [新增] 服务熔断中直接失败，不进入队列
+        if not _breaker.is_available():
+            return {"status": "error", "message": _breaker.unavailable_message()}
+        job = _Job(payload, task_id, client_id)
+        self.pending.append(job)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run_worker())
+        await self._notify_positions()
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            # 调用方取消：尚未开始的任务直接出队
+            if job in self.pending:
+                self.pending.remove(job)
+                job.future.cancel()
+            raise
+
+    def _next(self) -> _Job:
+        """会话亲和：优先执行当前对话的后续消息 (连续插队有上限)，否则先进先出"""
+        if self.affinity_streak < settings.GEMINI_LOCAL_MAX_AFFINITY:
+            for index, job in enumerate(self.pending):
+                if not job.new_chat and job.conversation and job.conversation == self.active_conversation:
+                    # 本来就在队首时不算插队
+                    self.affinity_streak = self.affinity_streak + 1 if index else 0
+                    return self.pending.pop(index)
+        self.affinity_streak = 0
+        return self.pending.pop(0)
+
+    async def _run_worker(self):
+        while self.pending:
+            job = self._next()
+            self.running = job
+            await self._notify_positions()
+            try:
+                result = await _call_service(job, self.active_conversation)
+                self.active_conversation = job.conversation
+                if not job.future.done():
+                    job.future.set_result(result)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self.running = None
+
+    async def _notify_positions(self):
+        """推送排队位置：正在执行的任务为 0 (处理中)，排队中的任务为前方任务数"""
+        jobs = ([self.running] if self.running else []) + self.pending
+        for position, job in enumerate(jobs):
+            if not (job.client_id and job.task_id):
+                continue
+            await manager.send_to_client(job.client_id, WSMessage(
+                type="status",
+                task_id=job.task_id,
+                data={
+                    "message": f"Gemini 本地服务排队中 (前方 {position} 个任务)" if position else "Gemini 本地服务处理中...",
+                    "queue_position": position,
+                }
+            ))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running.task_id if self.running else None,
+            "pending": len(self.pending),
+            "active_conversation": self.active_conversation,
+            "affinity_streak": self.affinity_streak,
+        }
+
+
+async def run(payload: Dict[str, Any], task_id: Optional[str] = None, client_id: Optional[str] = None) -> Dict[str, Any]:
     """
-    调用本地运行的 Gemini 服务
+    调用本地运行的 Gemini 服务 (经单并发队列排队执行)
     Payload 参数:
     - user_input (str): 提示词
     - file_path (str): 本地文件路径 (可选)
     - ratio (str): 图片比例 (可选, 默认 auto)
     - new_chat (bool): 是否开启新对话 (默认 True)
+    - conversation_id (str): (可选) 会话标识，默认按 client_id 区分
+    task_id / client_id: (可选) 用于推送排队位置
     """
+    try:
+        return await session_queue.submit(payload, task_id, client_id)
+    except Exception as e:
+        logger.error(f"❌ Gemini Local Call Failed: {e}")
+        return {"status": "error", "message": str(e)}
+
+
+async def _call_service(job: _Job, active_conversation: Optional[str]) -> Dict[str, Any]:
+    """实际调用 8021 服务 (同一时间只会有一个调用)"""
+    payload = job.payload
     # [新增] 获取项目ID (如果前端传了)
     project_id = payload.get("project_id")
 
-    # 确保配置中有 GEMINI_LOCAL_URL，否则使用默认
-    base_url = getattr(settings, "GEMINI_LOCAL_URL", "http://127.0.0.1:8021")
+    base_url = settings.GEMINI_LOCAL_URL
     url = f"{base_url}/chat"
-    
+
+    # [新增] 浏览器当前对话已属于其他会话时，后续消息不能接在别人的对话里，改为开启新对话
+    new_chat = job.new_chat
+    note = ""
+    if not new_chat and active_conversation is not None and active_conversation != job.conversation:
+        logger.warning(f"⚠️ Conversation {job.conversation} was displaced by {active_conversation}, starting a new chat")
+        new_chat = True
+        note = " [Note: previous conversation was replaced, started a new chat]"
+
     # 构造发给 8021 的请求体，字段名必须与 server.py 中的 GeminiRequest 一致
+    # [新增] file_path 可以是 blob:// 句柄或 /files/ 地址，8021 服务只接受本地路径
+    file_path = payload.get("file_path")
+    if file_path and not os.path.isabs(file_path):
+        resolved = storage.resolve_workspace_path(file_path)
+        file_path = str(resolved) if resolved else file_path
+
     gemini_payload = {
         "user_input": payload.get("user_input", payload.get("prompt", "")), # 兼容 prompt 字段
-        "file_path": payload.get("file_path"),
+        "file_path": file_path,
         "ratio": payload.get("ratio", "auto"),
-        "new_chat": payload.get("new_chat", True)
+        "new_chat": new_chat
     }
 
     logger.info(f"🚀 Calling Gemini Local Service at {url}...")
 
-    try:
-        # trust_env=False 忽略代理，timeout 设置长一点因为本地爬虫处理可能较慢
-        async with httpx.AsyncClient(trust_env=False, timeout=120.0) as client:
-            resp = await client.post(url, json=gemini_payload)
-            
-            if resp.status_code != 200:
-                return {"status": "error", "message": f"Gemini Service Error: {resp.text}"}
-            
-            result = resp.json()
-            logger.info(f"🔍 Raw Gemini Response: {result}")
-            
-            # 处理返回结果
-            # server.py 返回的是 {"status": "success", "images": ["本地路径..."], "text": "..."}
-            response_data = {
-                "status": result.get("status", "error"),
-                "info": result.get("text") or result.get("message", "")
-            }
-
-            images = result.get("images", [])
-            if images:
-                img_path = images[0]
-                if os.path.exists(img_path):
-                    # [Modified] Read file and save to storage, return URL
-                    with open(img_path, "rb") as img_file:
-                        content = img_file.read()
-                        save_result = storage.save_generated_image(content, prefix="gemini", project_id=project_id)
-                        response_data["image"] = save_result["url"]
-                        response_data["assets"] = save_result
-                else:
-                    logger.error(f"❌ Image path returned but file not found: {img_path}")
-                    response_data["info"] = (response_data["info"] or "") + f" [Error: File not found at {img_path}]"
-            
-            return response_data
+    # 排队期间服务可能已熔断：health.registry.call 会直接抛出 CircuitOpenError
+    resp = await health.registry.call(_breaker, lambda: _get_client().post(url, json=gemini_payload))
 
-    except Exception as e:
-        logger.error(f"❌ Gemini Local Call Failed: {e}")
-        return {"status": "error", "message": str(e)}
\ No newline at end of file
+    if resp.status_code != 200:
+        return {"status": "error", "message": f"Gemini Service Error: {resp.text}"}
+
+    result = resp.json()
+    logger.info(f"🔍 Raw Gemini Response: {result}")
+
+    # 处理返回结果
+    # server.py 返回的是 {"status": "success", "images": ["本地路径..."], "text": "..."}
+    response_data = {
+        "status": result.get("status", "error"),
+        "info": (result.get("text") or result.get("message", "")) + note
+    }
+
+    images = result.get("images", [])
+    if images:
+        img_path = images[0]
+        if os.path.exists(img_path):
+            # [Modified] 硬链接 (或复制) 到存储目录，不再读入内存重新写出
+            save_result = await storage.import_generated_file_async(img_path, prefix="gemini", project_id=project_id)
+            response_data["image"] = save_result["url"]
+            response_data["assets"] = save_result
+        else:
+            logger.error(f"❌ Image path returned but file not found: {img_path}")
+            response_data["info"] = (response_data["info"] or "") + f" [Error: File not found at {img_path}]"
+
+    return response_data
+
+
+# 全局单例
+session_queue = _SessionQueue()
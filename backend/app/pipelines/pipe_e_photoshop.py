@@ -7,10 +7,10 @@ import asyncio
 import json
 import uuid
 import os
-from urllib.parse import urlparse, unquote
 from typing import Dict, Any
 from config import settings
 from app.utils import ps_bridge
+from app.utils import storage
 from app.websocket_manager import manager # [New] 引入 WebSocket 管理器以支持广播
 
 logger = logging.getLogger("backend.pipeline.photoshop")
@@ -188,19 +188,15 @@ def _resolve_path(path_str: str) -> str:
     if not path_str:
         return ""
     
-    # 1. 如果是完整 URL (http://...), 提取路径部分
-    if path_str.startswith("http"):
-        parsed = urlparse(path_str)
-        path_str = unquote(parsed.path) # 解码 URL 编码
+    # 1. 完整 URL (http://...) 或 /files/ 开头的路径: [Fix] 统一经 storage 解析 (分片目录 / 扁平目录 / 回收站恢复)
+    if path_str.startswith(("http", "/files/")):
+        path = storage.resolve_workspace_path(path_str)
+        if path is None:
+            logger.warning(f"⚠️ Layer image not found in workspace: {path_str}")
+            return ""
+        return str(path)
         
-    # 2. 如果是 /files/ 开头的路径 (映射到 workspace)
-    if path_str.startswith("/files/"):
-        # 去掉 /files/ 前缀
-        rel_path = path_str[len("/files/"):]
-        # 拼接到 workspace 根目录
-        return str(settings.WORKSPACE_DIR / rel_path)
-        
-    # 3. 如果已经是本地存在的绝对路径，直接返回
+    # 2. 如果已经是本地存在的绝对路径，直接返回
     if os.path.exists(path_str):
         return path_str
         
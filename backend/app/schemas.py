@@ -7,6 +7,7 @@ class TaskType(str, Enum):
     COMFY_PROXY = "comfy_proxy"   # Pipeline A: ComfyUI
     REMBG_LOCAL = "rembg_local"   # Pipeline B: 本地去底
     EXTERNAL_API = "external_api" # Pipeline C: 外部 API
+    GEMINI_LOCAL = "gemini_local" # [新增] Pipeline D: 本地 Gemini 服务 (8021)
     PHOTOSHOP_IMPORT = "photoshop_import" # Pipeline E: Photoshop 导入
     PHOTOSHOP_EXPORT = "photoshop_export" # Pipeline E: Photoshop 导出
     BRIDGE_SYNC = "bridge_sync"   # [新增] Bridge 同步信号
@@ -0,0 +1,321 @@
+"""
+backend/app/utils/asset_gc.py
+项目素材垃圾回收 (按引用追踪)
+- 回收范围: 每个项目的 generations/ 与 ps_exchange/ (GC_DIRS)；inputs/ 是用户上传，不回收
+- 引用集合:
+    1. project.json 中出现的全部路径 (图层 src 为项目内相对路径，其他位置可能是 /files/{项目}/... URL)
+    2. 最近被引用过的路径及其时间 (见 touch): 每次保存项目、前端撤销历史中的图片 (保存时随 history_refs 上报)、
+       任务的输入与结果。某个文件从画布上删掉后，只要还在宽限期内就仍可撤销回来
+- 未被引用、且最后写入 / 链接 / 引用时间都早于宽限期 (GC_GRACE_PERIOD) 的文件移入回收站
+  {项目}/.gc/trash/{移入时间}/{原相对路径}；之后重新被引用的文件在下一轮自动恢复，
+  在此之前被请求 (/files 或任务输入) 时按需立即恢复 (见 restore)
+- 回收站中超过保留期 (GC_TRASH_RETENTION) 的文件被彻底删除: 释放内容寻址存储的引用，
+  并删除对应的缩略图 / 瓦片缓存；对象无其他引用时磁盘空间才真正释放 (计入 reclaimed_bytes)
+- 后台每 GC_INTERVAL 秒运行一轮，逐个项目在线程中处理，不阻塞请求；
+  每轮开始时读取一次全部 project.json 得到跨项目引用表，各项目共用
+"""
+import os
+import re
+import json
+import time
+import shutil
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+from urllib.parse import unquote
+
+from config import settings
+from app.utils.cas import store as cas_store, write_atomic
+from app.utils.thumbnails import mips
+from app.utils.tiles import tiles
+from app.utils import storage
+from app.utils.storage import public_rel
+from app.utils.asset_index import index as asset_index
+
+logger = logging.getLogger("backend.asset_gc")
+
+GC_DIR_NAME = ".gc"
+TRASH = "trash"
+REFS = "refs.json"
+
+
+class AssetCollector:
+    """引用追踪与回收 (单例见模块底部的 collector)"""
+
+    def __init__(self, workspace: Path, dirs: Iterable[str]):
+        self.workspace = workspace.resolve()
+        self.dirs = tuple(dirs)
+        alternation = "|".join(re.escape(d) for d in self.dirs)
+        # /files/{项目}/{子目录}/...  与  项目内相对路径 {子目录}/... (前面不能是路径字符，避免误配其他项目的 URL)
+        self._url_pattern = re.compile(rf"/files/([^/\"'\s?#]+)/((?:{alternation})/[^\"'\s?#]+)")
+        self._rel_pattern = re.compile(rf"(?<![\w./-])((?:{alternation})/[^\"'\s?#]+)")
+        # 最近被引用的路径: {项目: {相对路径: 时间戳}}，每轮回收时合并进 {项目}/.gc/refs.json
+        self._seen: Dict[str, Dict[str, float]] = {}
+        self._seen_lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.totals = {
+            "runs": 0,
+            "trashed_files": 0,
+            "trashed_bytes": 0,
+            "restored_files": 0,
+            "purged_files": 0,
+            "purged_bytes": 0,
+            "reclaimed_bytes": 0,
+        }
+        self.last_run: Optional[Dict[str, Any]] = None
+
+    # --- 引用追踪 ---
+    def extract(self, data: Any, project_id: Optional[str] = None) -> Set[Tuple[str, str]]:
+        """从任意 JSON 数据中提取引用，返回 {(项目, 相对路径)}；project_id 为空时忽略相对路径"""
+        text = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False, default=str)
+        refs = {(unquote(pid), unquote(rel)) for pid, rel in self._url_pattern.findall(text)}
+        if project_id:
+            stripped = self._url_pattern.sub("", text)
+            refs.update((project_id, unquote(rel)) for rel in self._rel_pattern.findall(stripped))
+        return refs
+
+    def touch(self, data: Any, project_id: Optional[str] = None):
+        """记录 data 中引用的文件 (保存项目 / 撤销历史 / 任务输入与结果)，宽限期内不会被回收"""
+        if not data:
+            return
+        now = time.time()
+        refs = self.extract(data, project_id)
+        if not refs:
+            return
+        with self._seen_lock:
+            for pid, rel in refs:
+                self._seen.setdefault(pid, {})[rel] = now
+
+    def _load_seen(self, project_dir: Path) -> Dict[str, float]:
+        """合并磁盘上与内存中的最近引用记录，丢弃早于宽限期的条目并写回"""
+        path = project_dir / GC_DIR_NAME / REFS
+        try:
+            seen = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            seen = {}
+        with self._seen_lock:
+            pending = self._seen.pop(project_dir.name, {})
+        for rel, ts in pending.items():
+            seen[rel] = max(ts, seen.get(rel, 0))
+        cutoff = time.time() - settings.GC_GRACE_PERIOD
+        seen = {rel: ts for rel, ts in seen.items() if ts >= cutoff}
+        write_atomic(path, json.dumps(seen).encode("utf-8"))
+        return seen
+
+    def _reference_map(self) -> Dict[str, Set[str]]:
+        """[线程] 读取全部 project.json 一次，返回 {项目: 被引用的相对路径} (含其他项目的跨项目引用)"""
+        refs: Dict[str, Set[str]] = {}
+        for project_dir in self._projects():
+            try:
+                text = (project_dir / "project.json").read_text(encoding="utf-8")
+            except OSError:
+                continue
+            for pid, rel in self.extract(text, project_dir.name):
+                refs.setdefault(pid, set()).add(rel)
+        return refs
+
+    # --- 按需恢复 ---
+    def restore(self, project_id: str, rel: str) -> Optional[Path]:
+        """
+        [线程] 请求的文件已被移入回收站时立即放回原处 (不必等下一轮回收)，返回恢复后的路径。
+        rel 为 URL 中的项目内相对路径；同时记为最近引用，宽限期内不会再被回收
+        """
+        project_dir = self.workspace / project_id
+        trash_root = project_dir / GC_DIR_NAME / TRASH
+        if project_id.startswith(".") or "/" in project_id or ".." in rel.split("/"):
+            return None
+        if not rel.startswith(tuple(f"{d}/" for d in self.dirs)) or not trash_root.is_dir():
+            return None
+        for batch in sorted(trash_root.iterdir(), reverse=True):
+            for disk_rel in filter(None, (storage.sharded_rel(f"{project_id}/{rel}"), f"{project_id}/{rel}")):
+                disk_rel = disk_rel.split("/", 1)[1]
+                trashed = batch / disk_rel
+                original = project_dir / disk_rel
+                if not trashed.is_file() or original.exists():
+                    continue
+                try:
+                    original.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(trashed, original)
+                except OSError as e:
+                    # 可能正被本轮回收彻底删除
+                    logger.warning(f"⚠️ Could not restore trashed file {trashed}: {e}")
+                    return None
+                with self._seen_lock:
+                    self._seen.setdefault(project_id, {})[rel] = time.time()
+                    self.totals["restored_files"] += 1
+                logger.info(f"♻️ Restored requested file {project_id}/{disk_rel}")
+                return original
+        return None
+
+    # --- 回收 ---
+    def _projects(self):
+        for d in sorted(self.workspace.iterdir()):
+            if d.is_dir() and not d.name.startswith(".") and (d / "project.json").exists():
+                yield d
+
+    def _candidates(self, project_dir: Path):
+        for sub in self.dirs:
+            root = project_dir / sub
+            if not root.is_dir():
+                continue
+            for f in root.rglob("*"):
+                if f.name.startswith(".") or f.suffix == ".part" or not f.is_file():
+                    continue
+                yield f
+
+    def _purge_file(self, trashed: Path, original: Path, report: Dict[str, int]):
+        st = trashed.stat()
+        digest = None
+        # 原路径上已有新文件时，索引中的引用属于新文件，不能释放
+        if not original.exists():
+            digest = cas_store.hash_of(original)
+            cas_store.release(original)
+        trashed.unlink()
+        if digest is not None:
+            freed = not cas_store.object_path(digest).exists()
+        else:
+            freed = st.st_nlink <= 1
+        report["purged_files"] += 1
+        report["purged_bytes"] += st.st_size
+        if freed:
+            report["reclaimed_bytes"] += st.st_size
+        asset_index.forget(original)
+        for cache in (mips.cache_dir(original), tiles.cache_dir(original)):
+            shutil.rmtree(cache, ignore_errors=True)
+
+    def collect_project(self, project_dir: Path, references: Set[str]) -> Dict[str, int]:
+        """[线程] 对一个项目执行一轮回收：恢复 / 清理过期回收站 -> 移入回收站；references 见 _reference_map"""
+        report = {k: 0 for k in ("trashed_files", "trashed_bytes", "restored_files",
+                                 "purged_files", "purged_bytes", "reclaimed_bytes")}
+        now = time.time()
+        seen = self._load_seen(project_dir)
+        referenced = references | set(seen)
+        trash_root = project_dir / GC_DIR_NAME / TRASH
+
+        # 1. 回收站中重新被引用的文件放回原处；超过保留期的批次彻底删除
+        if trash_root.is_dir():
+            for batch in sorted(trash_root.iterdir()):
+                try:
+                    trashed_at = int(batch.name)
+                except ValueError:
+                    continue
+                expired = now - trashed_at > settings.GC_TRASH_RETENTION
+                for f in [p for p in batch.rglob("*") if p.is_file()]:
+                    rel = f.relative_to(batch).as_posix()
+                    original = project_dir / rel
+                    try:
+                        if public_rel(rel) in referenced and not original.exists():
+                            original.parent.mkdir(parents=True, exist_ok=True)
+                            os.replace(f, original)
+                            report["restored_files"] += 1
+                            logger.info(f"♻️ Restored referenced file {project_dir.name}/{rel}")
+                        elif expired:
+                            self._purge_file(f, original, report)
+                    except OSError as e:
+                        logger.warning(f"⚠️ GC could not process trashed file {f}: {e}")
+                if expired:
+                    shutil.rmtree(batch, ignore_errors=True)
+
+        # 2. 未被引用且超过宽限期的文件移入回收站
+        # ctime 也参与判断: 内容去重时新文件是指向旧对象的硬链接，mtime 是旧的，但建立链接会更新 ctime
+        cutoff = now - settings.GC_GRACE_PERIOD
+        batch = trash_root / str(int(now))
+        for f in self._candidates(project_dir):
+            rel = f.relative_to(project_dir).as_posix()
+            # 引用记录的是 URL 中的路径 (不含分片子目录)
+            if public_rel(rel) in referenced:
+                continue
+            try:
+                st = f.stat()
+                if max(st.st_mtime, st.st_ctime) >= cutoff:
+                    continue
+                target = batch / rel
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(f, target)
+            except OSError as e:
+                logger.warning(f"⚠️ GC could not move {f}: {e}")
+                continue
+            report["trashed_files"] += 1
+            report["trashed_bytes"] += st.st_size
+        return report
+
+    def run_once(self, project_id: Optional[str] = None,
+                 reference_map: Optional[Dict[str, Set[str]]] = None) -> Dict[str, Any]:
+        """[线程] 同步执行一轮 (可指定单个项目)，返回本轮报告；reference_map 为空时现读"""
+        with self._run_lock:
+            started = time.time()
+            projects = [self.workspace / project_id] if project_id else list(self._projects())
+            if reference_map is None:
+                reference_map = self._reference_map()
+            summary: Dict[str, Any] = {"projects": {}}
+            for project_dir in projects:
+                if not (project_dir / "project.json").exists():
+                    continue
+                report = self.collect_project(project_dir, reference_map.get(project_dir.name, set()))
+                if any(report.values()):
+                    summary["projects"][project_dir.name] = report
+                for k, v in report.items():
+                    summary[k] = summary.get(k, 0) + v
+                    self.totals[k] += v
+            self.totals["runs"] += 1
+            summary["started_at"] = started
+            summary["duration"] = round(time.time() - started, 3)
+            self.last_run = summary
+        if summary.get("trashed_files") or summary.get("purged_files"):
+            logger.info(
+                f"🧹 Asset GC: trashed {summary['trashed_files']} files ({summary['trashed_bytes']} bytes), "
+                f"purged {summary['purged_files']}, reclaimed {summary['reclaimed_bytes']} bytes"
+            )
+        return summary
+
+    async def run(self, project_id: Optional[str] = None,
+                  reference_map: Optional[Dict[str, Set[str]]] = None) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.run_once, project_id, reference_map)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(settings.GC_INTERVAL)
+            # 引用表每轮只读一次；之后逐个项目提交到线程，项目之间让出事件循环
+            # (本轮中途保存的项目由 touch 记录的最近引用保护)
+            try:
+                reference_map = await asyncio.to_thread(self._reference_map)
+            except Exception as e:
+                logger.error(f"Asset GC could not read project references: {e}")
+                continue
+            for project_dir in await asyncio.to_thread(lambda: list(self._projects())):
+                try:
+                    await self.run(project_dir.name, reference_map)
+                except Exception as e:
+                    logger.error(f"Asset GC failed for {project_dir.name}: {e}")
+
+    def start(self):
+        """启动后台回收 (在 lifespan 中调用)"""
+        if settings.GC_ENABLED and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def trash_bytes(self) -> int:
+        total = 0
+        for project_dir in self._projects():
+            trash_root = project_dir / GC_DIR_NAME / TRASH
+            if trash_root.is_dir():
+                total += sum(f.stat().st_size for f in trash_root.rglob("*") if f.is_file())
+        return total
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.totals, "last_run": self.last_run}
+
+
+# 全局单例
+collector = AssetCollector(settings.WORKSPACE_DIR, settings.GC_DIRS)
@@ -0,0 +1,328 @@
+"""
+backend/app/utils/asset_index.py
+素材元数据索引 (入库时建立，之后无需再用 PIL 探测文件)
+- 每个项目一个 SQLite 索引: {项目}/.meta/index.db，按项目内磁盘相对路径 (同内容寻址存储) 记录:
+  内容哈希、字节数、MIME / 格式、宽高、颜色模式、是否含透明像素、不透明区域 bbox、感知哈希 (dHash)、EXIF 方向
+- EXIF 方向在入库前统一转正 (normalize_bytes / normalize_file / oriented_copy)
+  转正需要重新编码: PNG / TIFF 无损 (保留文本块、ICC、DPI)；JPEG 沿用原图的量化表与色度采样重新编码，
+  仍有一次轻微的有损损失；WEBP 以 JPEG_QUALITY 重新编码
+  文件直接编码到同目录的临时文件再替换，哈希流式计算，不在内存中保留编码结果；
+  超过 ORIENT_NORMALIZE_MAX_PIXELS 的图片不转正，只记录方向 (缩略图 / 瓦片 / 转码 / 模型预处理各自转正)
+- 查询时记录缺失或文件已变化 (大小 / 修改时间不符) 则当场探测并补录，旧项目与外部写入的文件 (如 ps_exchange) 同样可查
+- 同一项目中内容哈希相同的文件直接复用已有记录，不重复解码
+- 数据库连接随用随关 (不常驻)，删除项目 / 回收时不会因文件被占用而失败 (Windows)，也不会累积文件句柄
+"""
+import io
+import os
+import json
+import time
+import sqlite3
+import logging
+import mimetypes
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image, ImageOps, JpegImagePlugin, PngImagePlugin
+
+from config import settings
+from app.utils.cas import store as cas_store, hash_file
+
+logger = logging.getLogger("backend.asset_index")
+
+META_DIR_NAME = ".meta"
+ORIENTATION = 0x0112
+# 转正后可按原格式重新编码的格式 (其他格式保留原文件，只在元数据中记录方向)
+REWRITABLE_FORMATS = ("JPEG", "PNG", "WEBP", "TIFF")
+# JPEG 缺少量化表时 / WEBP 重新编码的质量
+JPEG_QUALITY = 95
+HASH_SIZE = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    path TEXT PRIMARY KEY,
+    hash TEXT,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    mime TEXT,
+    format TEXT,
+    width INTEGER,
+    height INTEGER,
+    mode TEXT,
+    has_alpha INTEGER,
+    alpha_bbox TEXT,
+    phash TEXT,
+    orientation INTEGER,
+    indexed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assets_hash ON assets(hash);
+"""
+COLUMNS = ("path", "hash", "size", "mtime_ns", "mime", "format", "width", "height", "mode",
+           "has_alpha", "alpha_bbox", "phash", "orientation", "indexed_at")
+
+
+# --- EXIF 方向 ---
+def _needs_transpose(im: Image.Image) -> bool:
+    if im.getexif().get(ORIENTATION, 1) in (0, 1) or im.format not in REWRITABLE_FORMATS:
+        return False
+    # 超大图转正需要完整解码并重新编码，保留原文件
+    return im.width * im.height <= settings.ORIENT_NORMALIZE_MAX_PIXELS
+
+
+def _save_transposed(im: Image.Image, target) -> bool:
+    """需要转正时把转正后按原格式编码的图片写入 target (路径或文件对象) 并返回 True，否则不写入"""
+    if not _needs_transpose(im):
+        return False
+    fmt = im.format
+    icc = im.info.get("icc_profile")
+    params: Dict[str, Any] = {"format": fmt}
+    if fmt == "JPEG":
+        # 沿用原图的量化表与色度采样，避免按固定质量重新压缩导致的画质变化 / 体积膨胀
+        qtables = getattr(im, "quantization", None)
+        sampling = JpegImagePlugin.get_sampling(im)
+        if qtables:
+            params["qtables"] = qtables
+        else:
+            params["quality"] = JPEG_QUALITY
+        if sampling != -1:
+            params["subsampling"] = sampling
+        params["optimize"] = True
+        params["progressive"] = bool(im.info.get("progressive"))
+    elif fmt == "PNG" and getattr(im, "text", None):
+        pnginfo = PngImagePlugin.PngInfo()
+        for key, value in im.text.items():
+            pnginfo.add_text(key, value)
+        params["pnginfo"] = pnginfo
+    image = ImageOps.exif_transpose(im)  # 同时去掉 EXIF 中的方向标记
+    if image.info.get("exif"):
+        params["exif"] = image.info["exif"]
+    if icc:
+        params["icc_profile"] = icc
+    if image.info.get("dpi"):
+        params["dpi"] = image.info["dpi"]
+    if fmt == "WEBP":
+        params.update(quality=JPEG_QUALITY, method=4)
+    image.save(target, **params)
+    return True
+
+
+def normalize_bytes(data: bytes) -> bytes:
+    """把带 EXIF 旋转的图片字节转正 (非图片或无需转正时原样返回)"""
+    buf = io.BytesIO()
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            if not _save_transposed(im, buf):
+                return data
+    except (OSError, Image.DecompressionBombError):
+        return data
+    return buf.getvalue()
+
+
+def oriented_copy(src: Path, dest: Path) -> Optional[str]:
+    """
+    src 需要转正时把转正后的图片写入 dest，返回其 SHA-256；无需转正 (或无法解码) 时返回 None，dest 不存在
+    dest 由调用方提供 (与最终位置同一文件系统)，编码结果直接落盘，不经过内存
+    """
+    try:
+        with Image.open(src) as im:
+            if not _save_transposed(im, dest):
+                return None
+    except (OSError, Image.DecompressionBombError):
+        dest.unlink(missing_ok=True)
+        return None
+    except BaseException:
+        dest.unlink(missing_ok=True)
+        raise
+    return hash_file(dest)
+
+
+def normalize_file(path: Path) -> Optional[str]:
+    """
+    原地转正一个尚未入库的临时文件 (上传 / 下载中的 .part)，返回转正后内容的 SHA-256；无需转正时返回 None
+    注意: 不要用于已入库的文件 (可能与其他文件共享硬链接)
+    """
+    tmp = path.with_name(f".{path.name}.orient")
+    digest = oriented_copy(path, tmp)
+    if digest is not None:
+        os.replace(tmp, path)
+    return digest
+
+
+# --- 探测 ---
+def dhash(image: Image.Image) -> str:
+    """差值哈希 (dHash, 64 位)：缩到 9x8 灰度后比较相邻像素，相似图片的汉明距离小"""
+    small = image.convert("RGBA").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS, reducing_gap=4.0)
+    # 透明区域按白底计算，避免抠图结果中不可见像素的颜色影响哈希
+    background = Image.new("RGBA", small.size, (255, 255, 255, 255))
+    gray = Image.alpha_composite(background, small).convert("L")
+    pixels = gray.tobytes()
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:016x}"
+
+
+def hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def probe(path: Path) -> Dict[str, Any]:
+    """读取一个文件的元数据 (非图片只有字节数与 MIME)"""
+    st = path.stat()
+    meta: Dict[str, Any] = {
+        "size": st.st_size, "mtime_ns": st.st_mtime_ns, "mime": mimetypes.guess_type(path.name)[0],
+        "format": None, "width": None, "height": None, "mode": None,
+        "has_alpha": None, "alpha_bbox": None, "phash": None, "orientation": None,
+    }
+    try:
+        with Image.open(path) as im:
+            orientation = im.getexif().get(ORIENTATION, 1) or 1
+            image = ImageOps.exif_transpose(im) if orientation != 1 else im
+            meta.update(format=im.format, mime=Image.MIME.get(im.format, meta["mime"]), mode=im.mode,
+                        width=image.width, height=image.height, orientation=orientation)
+            alpha = None
+            if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+                alpha = image.convert("RGBA").getchannel("A")
+            # 只有存在非不透明像素才算含透明；bbox 为可见 (alpha > 0) 像素的范围
+            meta["has_alpha"] = bool(alpha is not None and alpha.getextrema()[0] < 255)
+            if meta["has_alpha"]:
+                meta["alpha_bbox"] = alpha.getbbox()
+            meta["phash"] = dhash(image)
+    except (OSError, Image.DecompressionBombError):
+        pass
+    return meta
+
+
+class AssetIndex:
+    """每个项目的素材元数据索引 (单例见模块底部的 index)"""
+
+    def __init__(self, workspace: Path):
+        self.workspace = workspace.resolve()
+
+    def _locate(self, path: Path) -> Tuple[Path, str]:
+        """文件 -> (项目目录, 项目内相对路径)"""
+        rel = path.resolve().relative_to(self.workspace)
+        return self.workspace / rel.parts[0], Path(*rel.parts[1:]).as_posix()
+
+    @contextmanager
+    def _conn(self, project_dir: Path) -> Iterator[sqlite3.Connection]:
+        """打开项目索引 (用完即关，不占用 .meta 目录)"""
+        meta_dir = project_dir / META_DIR_NAME
+        meta_dir.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(meta_dir / "index.db", timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            conn.row_factory = sqlite3.Row
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        record = dict(row)
+        record["has_alpha"] = None if record["has_alpha"] is None else bool(record["has_alpha"])
+        record["alpha_bbox"] = json.loads(record["alpha_bbox"]) if record["alpha_bbox"] else None
+        return record
+
+    def ingest(self, path: Path, digest: Optional[str] = None) -> Dict[str, Any]:
+        """记录一个文件的元数据 (digest 为入库时已算好的内容哈希)；同项目中相同内容的文件复用已有记录"""
+        project_dir, rel = self._locate(path)
+        st = path.stat()
+        digest = digest or cas_store.hash_of(path)
+        meta = None
+        if digest:
+            with self._conn(project_dir) as conn:
+                row = conn.execute("SELECT * FROM assets WHERE hash = ? LIMIT 1", (digest,)).fetchone()
+            if row is not None:
+                meta = {**dict(row), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        if meta is None:
+            # 探测 (解码图片) 期间不持有连接
+            meta = probe(path)
+            if isinstance(meta["alpha_bbox"], tuple):
+                meta["alpha_bbox"] = json.dumps(list(meta["alpha_bbox"]))
+        meta.update(path=rel, hash=digest or meta.get("hash"), indexed_at=time.time())
+        if meta.get("has_alpha") is not None:
+            meta["has_alpha"] = int(meta["has_alpha"])
+        with self._conn(project_dir) as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO assets ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                tuple(meta.get(c) for c in COLUMNS),
+            )
+            return self._to_dict(conn.execute("SELECT * FROM assets WHERE path = ?", (rel,)).fetchone())
+
+    def get(self, path: Path) -> Optional[Dict[str, Any]]:
+        """一个文件的元数据；尚未记录或文件已变化时当场探测补录，文件不存在时返回 None"""
+        try:
+            st = path.stat()
+            project_dir, rel = self._locate(path)
+        except (OSError, ValueError):
+            return None
+        with self._conn(project_dir) as conn:
+            row = conn.execute("SELECT * FROM assets WHERE path = ?", (rel,)).fetchone()
+        if row is not None and row["size"] == st.st_size and row["mtime_ns"] == st.st_mtime_ns:
+            return self._to_dict(row)
+        return self.ingest(path)
+
+    def query(self, project_id: str, prefix: Optional[str] = None, has_alpha: Optional[bool] = None,
+              min_width: Optional[int] = None, min_height: Optional[int] = None) -> List[Dict[str, Any]]:
+        """按条件列出项目中已记录的素材 (只查索引，不探测文件)"""
+        project_dir = self.workspace / project_id
+        if not (project_dir / META_DIR_NAME).exists():
+            return []
+        sql, args = "SELECT * FROM assets WHERE 1 = 1", []
+        if prefix:
+            sql += " AND substr(path, 1, ?) = ?"
+            args += [len(prefix), prefix]
+        if has_alpha is not None:
+            sql += " AND has_alpha = ?"
+            args.append(int(has_alpha))
+        if min_width:
+            sql += " AND width >= ?"
+            args.append(min_width)
+        if min_height:
+            sql += " AND height >= ?"
+            args.append(min_height)
+        with self._conn(project_dir) as conn:
+            rows = conn.execute(sql + " ORDER BY path", args).fetchall()
+        return [self._to_dict(r) for r in rows]
+
+    def similar(self, path: Path, max_distance: int = 8) -> List[Dict[str, Any]]:
+        """同一项目中感知哈希接近的素材 (按汉明距离排序，不含自身)"""
+        record = self.get(path)
+        if not record or not record["phash"]:
+            return []
+        project_dir, rel = self._locate(path)
+        with self._conn(project_dir) as conn:
+            rows = conn.execute("SELECT * FROM assets WHERE phash IS NOT NULL AND path != ?", (rel,)).fetchall()
+        matches = []
+        for row in rows:
+            distance = hamming(record["phash"], row["phash"])
+            if distance <= max_distance:
+                matches.append({**self._to_dict(row), "distance": distance})
+        return sorted(matches, key=lambda r: r["distance"])
+
+    def forget(self, path: Path):
+        """文件被删除时移除记录"""
+        try:
+            project_dir, rel = self._locate(path)
+        except ValueError:
+            return
+        if (project_dir / META_DIR_NAME).exists():
+            with self._conn(project_dir) as conn:
+                conn.execute("DELETE FROM assets WHERE path = ?", (rel,))
+
+    def move(self, src: Path, dst: Path):
+        """文件在项目内移动 (如迁移到分片目录) 时更新记录的路径"""
+        project_dir, src_rel = self._locate(src)
+        _, dst_rel = self._locate(dst)
+        if (project_dir / META_DIR_NAME).exists():
+            with self._conn(project_dir) as conn:
+                conn.execute("UPDATE assets SET path = ? WHERE path = ?", (dst_rel, src_rel))
+
+
+# 全局单例
+index = AssetIndex(settings.WORKSPACE_DIR)
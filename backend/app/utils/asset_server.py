@@ -0,0 +1,218 @@
+"""
+backend/app/utils/asset_server.py
+工作区素材静态服务 (替代普通的 StaticFiles 挂载 /files)
+- 强 ETag: 由 inode + 大小 + 修改时间 (纳秒) 组成；素材只写一次并以原子 rename 落盘，内容变化必然产生新 inode
+- 内容寻址命名 (上传 {名称}_{哈希8位}.ext / 生成 {前缀}_{uuid8位}.ext) 的素材: Cache-Control immutable，一年有效
+  其他文件 (project.json、工作流 JSON 等会被覆盖的文件): no-cache，每次用 ETag 协商 (304)
+- 条件请求 (If-None-Match / If-Modified-Since) 与 Range 请求由 Starlette 的 FileResponse 处理；
+  服务器支持 http.response.pathsend 扩展时由服务器直接发送文件 (sendfile)
+- JSON 等文本文件提供预压缩的 .br (需安装 brotli) / .gz 副本: 第一次请求时在后台生成，存放于 CACHE_DIR/precompressed
+  每个文件每种编码只保留最新版本的副本 (project.json 自动保存后旧副本随即删除)
+- 写后回写队列中尚未落盘的文件先等待写完再响应
+- 以 "." 开头的目录 (.cas / .thumbs / .tiles) 不对外提供
+- 带 format / max / q 查询参数的图片请求返回转码副本 (见 app/utils/variants.py)
+- 分片目录 (STORAGE_SHARDED_DIRS) 中的文件: URL 不含分片子目录，先查分片位置，再查旧的扁平位置
+"""
+import os
+import re
+import gzip
+import hashlib
+import asyncio
+import stat
+import mimetypes
+import logging
+from pathlib import Path
+from typing import Optional, Tuple
+
+import anyio
+from PIL import Image
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from config import settings
+from app.utils import variants
+from app.utils.storage import sharded_rel, write_behind
+from app.utils.asset_gc import collector as gc_collector
+
+try:
+    import brotli  # 可选依赖
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger("backend.asset_server")
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+# 内容寻址命名: inputs / generations 下以 _{8位十六进制}.扩展名 结尾的文件
+CONTENT_ADDRESSED = re.compile(r"^[^/]+/(inputs|generations)/.+_[0-9a-f]{8}\.[A-Za-z0-9]+$")
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+class AssetFiles(StaticFiles):
+    """带强缓存 / 预压缩的 StaticFiles"""
+
+    def __init__(self, *args, precompressed_dir: Path, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.precompressed_dir = precompressed_dir
+        self._pending: set = set()
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if any(part.startswith(".") for part in Path(path).parts):
+            raise HTTPException(status_code=404)
+        if write_behind.pending:
+            await self._wait_for_write(path)
+        request = Request(scope)
+        if any(k in request.query_params for k in variants.VARIANT_PARAMS) and scope["method"] in ("GET", "HEAD"):
+            return await self.variant_response(path, scope, request)
+        return await super().get_response(path, scope)
+
+    async def _wait_for_write(self, path: str):
+        """文件可能仍在写后回写队列中 (刚生成就被请求)：等它落盘，写入失败时按文件不存在处理"""
+        rel = Path(path).as_posix()
+        for candidate in filter(None, (sharded_rel(rel), rel)):
+            try:
+                await write_behind.wait_for(Path(self.directory) / candidate)
+            except Exception:
+                pass
+
+    def lookup_path(self, path: str) -> Tuple[str, Optional[os.stat_result]]:
+        sharded = sharded_rel(Path(path).as_posix())
+        if sharded:
+            full_path, stat_result = super().lookup_path(sharded)
+            if stat_result is not None:
+                return full_path, stat_result
+        full_path, stat_result = super().lookup_path(path)
+        if stat_result is None:
+            # 已被回收但仍被引用 (如撤销回来的图层) 的文件: 从回收站放回后再查
+            project_id, _, rel = Path(path).as_posix().partition("/")
+            restored = gc_collector.restore(project_id, rel) if rel else None
+            if restored is not None:
+                return self.lookup_path(path)
+        return full_path, stat_result
+
+    async def variant_response(self, path: str, scope: Scope, request: Request) -> Response:
+        """返回转码副本 (格式 / 最长边 / 质量由查询参数指定)"""
+        full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path)
+        if not (stat_result and stat.S_ISREG(stat_result.st_mode)):
+            raise HTTPException(status_code=404)
+        try:
+            params = variants.parse_params(dict(request.query_params), Path(full_path).suffix)
+        except variants.VariantParamError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        fmt, max_side, quality = params
+        rel = Path(full_path).resolve().relative_to(Path(self.directory).resolve()).as_posix()
+        # 缓存键已包含源内容哈希与参数，可直接作为强 ETag；先协商，命中时不转码
+        key = await variants.cache.key_for(Path(full_path), fmt, max_side, quality)
+        headers = {
+            "etag": f'"{key[:32]}"',
+            "cache-control": IMMUTABLE_CACHE if CONTENT_ADDRESSED.match(rel) else REVALIDATE_CACHE,
+        }
+        if self.is_not_modified(Headers(headers), request.headers):
+            return NotModifiedResponse(Headers(headers))
+        try:
+            key, variant_path = await variants.cache.get(Path(full_path), fmt, max_side, quality, key=key)
+        except (OSError, Image.UnidentifiedImageError, Image.DecompressionBombError) as e:
+            logger.warning(f"⚠️ Transcoding failed for {path}: {e}")
+            raise HTTPException(status_code=415, detail="Source is not a supported image")
+
+        response = FileResponse(variant_path, media_type=variants.MEDIA_TYPES[fmt])
+        response.headers.update(headers)
+        return response
+
+    # --- 预压缩 ---
+    def _variant_path(self, full_path: str, stat_result: os.stat_result, suffix: str) -> Path:
+        """
+        命名: {路径哈希}-{大小与修改时间哈希}{编码后缀}
+        原文件变化后版本部分不同，旧副本不再命中；同一路径的旧副本在生成新副本后删除
+        """
+        path_key = hashlib.sha1(full_path.encode()).hexdigest()
+        version = hashlib.sha1(f"{stat_result.st_size}:{stat_result.st_mtime_ns}".encode()).hexdigest()[:16]
+        return self.precompressed_dir / f"{path_key}-{version}{suffix}"
+
+    @staticmethod
+    def _prune_old_variants(target: Path, suffix: str):
+        path_key = target.name.split("-", 1)[0]
+        for old in target.parent.glob(f"{path_key}-*{suffix}"):
+            if old != target:
+                old.unlink(missing_ok=True)
+
+    def _precompress(self, full_path: str, stat_result: os.stat_result):
+        self.precompressed_dir.mkdir(parents=True, exist_ok=True)
+        data = Path(full_path).read_bytes()
+        outputs = [(".gz", lambda: gzip.compress(data, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            outputs.append((".br", lambda: brotli.compress(data, quality=11)))
+        for suffix, compress in outputs:
+            target = self._variant_path(full_path, stat_result, suffix)
+            if target.exists():
+                continue
+            tmp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+            tmp.write_bytes(compress())
+            os.replace(tmp, target)
+            self._prune_old_variants(target, suffix)
+
+    def _schedule_precompress(self, full_path: str, stat_result: os.stat_result):
+        key = (full_path, stat_result.st_mtime_ns)
+        if key in self._pending:
+            return
+        self._pending.add(key)
+
+        def _run():
+            try:
+                self._precompress(full_path, stat_result)
+            except OSError as e:
+                logger.warning(f"⚠️ Precompression failed for {full_path}: {e}")
+            finally:
+                self._pending.discard(key)
+
+        asyncio.get_running_loop().run_in_executor(None, _run)
+
+    def _pick_variant(self, full_path: str, stat_result: os.stat_result, request_headers: Headers) -> Optional[Tuple[str, str]]:
+        """返回 (编码, 副本路径)；副本尚未生成时安排后台生成并返回 None"""
+        accepted = request_headers.get("accept-encoding", "")
+        missing = False
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted or (encoding == "br" and brotli is None):
+                continue
+            variant = self._variant_path(full_path, stat_result, suffix)
+            if variant.exists():
+                return encoding, str(variant)
+            missing = True
+        if missing:
+            self._schedule_precompress(full_path, stat_result)
+        return None
+
+    # --- 响应 ---
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        rel = Path(full_path).resolve().relative_to(Path(self.directory).resolve()).as_posix()
+        etag = f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+        compressible = Path(full_path).suffix.lower() in settings.ASSET_PRECOMPRESS_SUFFIXES
+        variant = None
+        if compressible and stat_result.st_size >= settings.ASSET_PRECOMPRESS_MIN_BYTES:
+            variant = self._pick_variant(full_path, stat_result, request_headers)
+
+        if variant:
+            encoding, variant_path = variant
+            media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+            response = FileResponse(variant_path, status_code=status_code, media_type=media_type,
+                                    stat_result=os.stat(variant_path))
+            response.headers["content-encoding"] = encoding
+            # 不同编码是不同的表示，强 ETag 也必须不同
+            etag = f'{etag[:-1]}-{encoding}"'
+        else:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        response.headers["etag"] = etag
+        response.headers["cache-control"] = IMMUTABLE_CACHE if CONTENT_ADDRESSED.match(rel) else REVALIDATE_CACHE
+        if compressible:
+            response.headers["vary"] = "Accept-Encoding"
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
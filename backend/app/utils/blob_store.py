@@ -0,0 +1,162 @@
+"""
+backend/app/utils/blob_store.py
+任务输入的二进制 Blob 暂存区
+- 前端通过 WebSocket 二进制帧或 POST /api/blobs 上传原始图片字节，得到句柄 blob://<sha256>
+- 任务 payload 中直接引用句柄，各管道解析为本地文件路径 / 字节，不再经过 Base64 往返
+- 同内容只保存一份；超过 BLOB_TTL 未使用的 Blob 会被清理
+
+WebSocket 二进制帧格式:
+    [4 字节大端序 头部长度][UTF-8 JSON 头部][原始字节]
+    头部 (可为空对象): {"ref": "前端自定义标识", "sha256": "可选，前端预先计算的哈希"}
+    提供 sha256 时先校验再写入，不一致的帧被拒绝；回执 (成功或失败) 都带回 ref
+"""
+import os
+import json
+import time
+import struct
+import asyncio
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from config import settings
+
+logger = logging.getLogger("backend.blob_store")
+
+BLOB_SCHEME = "blob://"
+# 每写入多少个 Blob 检查一次过期文件
+PRUNE_EVERY = 50
+
+
+class BlobTooLarge(ValueError):
+    pass
+
+
+class BlobRejected(ValueError):
+    """二进制帧无法保存 (格式错误 / 哈希不符 / 过大)，ref 为帧头中的前端标识 (解析失败时为 None)"""
+
+    def __init__(self, message: str, ref: Optional[str] = None):
+        super().__init__(message)
+        self.ref = ref
+
+
+def is_blob_ref(value: Any) -> bool:
+    return isinstance(value, str) and value.startswith(BLOB_SCHEME)
+
+
+class BlobStore:
+    """Blob 暂存区 (单例见模块底部的 blobs)"""
+
+    def __init__(self, directory: Path, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._writes = 0
+
+    def _path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / digest
+
+    def path_of(self, ref: str) -> Optional[Path]:
+        """blob://<sha256> -> 本地文件路径 (不存在或格式不对时返回 None)"""
+        if not is_blob_ref(ref):
+            return None
+        digest = ref[len(BLOB_SCHEME):].strip().lower()
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+            return None
+        path = self._path(digest)
+        if not path.exists():
+            return None
+        # 被引用即续期，避免排队中的任务输入被清理
+        os.utime(path)
+        return path
+
+    def read_bytes(self, ref: str) -> Optional[bytes]:
+        path = self.path_of(ref)
+        return path.read_bytes() if path else None
+
+    def _commit(self, tmp_path: Path, digest: str) -> str:
+        dest = self._path(digest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if dest.exists():
+            tmp_path.unlink(missing_ok=True)
+            os.utime(dest)
+        else:
+            tmp_path.replace(dest)
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            self.prune()
+        return f"{BLOB_SCHEME}{digest}"
+
+    def put_bytes(self, data, digest: Optional[str] = None) -> str:
+        """[同步] 保存字节 (bytes / memoryview) 并返回句柄；digest 为已计算好的 sha256 时不再重复计算"""
+        if len(data) > self.max_bytes:
+            raise BlobTooLarge(f"Blob exceeds {self.max_bytes} bytes")
+        digest = digest or hashlib.sha256(data).hexdigest()
+        if self._path(digest).exists():
+            os.utime(self._path(digest))
+            return f"{BLOB_SCHEME}{digest}"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return self._commit(Path(tmp), digest)
+
+    async def put_stream(self, chunks: AsyncIterator[bytes]) -> Tuple[str, int]:
+        """边接收边写入临时文件并计算哈希，返回 (句柄, 字节数)"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise BlobTooLarge(f"Blob exceeds {self.max_bytes} bytes")
+                    hasher.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        handle = await asyncio.to_thread(self._commit, Path(tmp), hasher.hexdigest())
+        return handle, size
+
+    async def put_frame(self, frame: bytes) -> Dict[str, Any]:
+        """
+        解析一个 WebSocket 二进制帧并保存，返回回执 {"handle", "size", "ref"}
+        帧无效时抛出 BlobRejected (带 ref)，哈希不符的内容不会写入磁盘
+        """
+        ref = None
+        try:
+            if len(frame) < 4:
+                raise ValueError("Binary frame too short")
+            (header_len,) = struct.unpack(">I", frame[:4])
+            header = json.loads(frame[4:4 + header_len] or b"{}") if header_len else {}
+            ref = header.get("ref")
+            body = memoryview(frame)[4 + header_len:]
+            if len(body) > self.max_bytes:
+                raise BlobTooLarge(f"Blob exceeds {self.max_bytes} bytes")
+            digest = await asyncio.to_thread(lambda: hashlib.sha256(body).hexdigest())
+            expected = header.get("sha256")
+            if expected and expected.lower() != digest:
+                raise ValueError(f"Blob hash mismatch for ref {ref}")
+        except ValueError as e:
+            raise BlobRejected(str(e), ref) from e
+        handle = await asyncio.to_thread(self.put_bytes, body, digest)
+        return {"handle": handle, "size": len(body), "ref": ref}
+
+    def prune(self):
+        """删除超过 TTL 未被引用的 Blob 与残留的临时文件"""
+        cutoff = time.time() - self.ttl
+        for f in list(self.directory.glob("*/*")) + list(self.directory.glob("*.part")):
+            try:
+                if f.stat().st_mtime < cutoff:
+                    f.unlink()
+            except OSError:
+                pass
+
+
+# 全局单例
+blobs = BlobStore(settings.CACHE_DIR / "blobs", max_bytes=settings.BLOB_MAX_BYTES, ttl=settings.BLOB_TTL)
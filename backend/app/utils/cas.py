@@ -0,0 +1,345 @@
+"""
+backend/app/utils/cas.py
+工作区级内容寻址存储 (Content-Addressable Store)
+- 所有项目的 inputs/ 与 generations/ 文件按 SHA-256 只保存一份: WORKSPACE_DIR/.cas/objects/<前2位>/<sha256>
+- 项目中的文件是指向对象的硬链接 (同一文件系统)，不支持时依次退回 reflink / 复制
+- SQLite 引用计数索引 (.cas/index.db): 项目文件路径 -> 哈希；对象引用数归零时删除对象
+- 项目文件约定为只写一次：不要原地修改已保存的文件 (硬链接会同时改变其他引用)
+- 写入时先在索引事务中登记引用 (引用数 > 0)，再创建 / 链接对象；删除对象前在写事务中复查引用数，
+  并发的 release (回收 / 删除项目) 不会删掉正在被链接的对象
+
+注意: ProcessPool 中的子进程 (如 RemBg) 也会写入，索引连接按进程创建，SQLite 负责跨进程加锁
+"""
+import os
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from config import settings
+
+logger = logging.getLogger("backend.cas")
+
+CHUNK_SIZE = 1024 * 1024
+# Linux FICLONE ioctl (btrfs / xfs 等支持 reflink 的文件系统)
+FICLONE = 0x40049409
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS refs (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS refs_hash ON refs(hash);
+"""
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    try:
+        import fcntl
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except (ImportError, OSError):
+        dst.unlink(missing_ok=True)
+        return False
+
+
+def clone_file(src: Path, dst: Path, hardlink: bool = True) -> str:
+    """
+    把 src 放到 dst (dst 必须不存在)，返回实际使用的方式
+    hardlink=False 用于外部文件：用户之后修改源文件不应影响工作区里的副本
+    """
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    if _reflink(src, dst):
+        return "reflink"
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def fsync_file(f):
+    """按 STORAGE_FSYNC 策略把已写入的文件内容刷到磁盘"""
+    if settings.STORAGE_FSYNC in ("file", "full"):
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def fsync_dir(directory: Path):
+    """STORAGE_FSYNC = "full" 时同步目录项，保证 rename 在断电后仍然可见"""
+    if settings.STORAGE_FSYNC != "full" or os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path: Path, data) -> None:
+    """原子写入：先写同目录临时文件 (按策略 fsync)，再 rename 到目标路径"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            fsync_file(f)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    fsync_dir(path.parent)
+
+
+def hash_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ContentStore:
+    """内容寻址存储 (单例见模块底部的 store)"""
+
+    def __init__(self, root: Path, workspace: Path):
+        self.root = root
+        self.workspace = workspace.resolve()
+        self.objects = root / "objects"
+        self.db_path = root / "index.db"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    # --- 索引 ---
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            self.root.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _rel(self, path: Path) -> str:
+        return path.resolve().relative_to(self.workspace).as_posix()
+
+    def _register(self, dest: Path, digest: str, size: int) -> bool:
+        """
+        登记 dest -> digest，并维护引用计数 (dest 之前指向其他对象时先释放旧引用)
+        返回是否新增了引用 (dest 已指向 digest 时为 False)
+        """
+        rel = self._rel(dest)
+        with self._lock:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT hash FROM refs WHERE path = ?", (rel,)).fetchone()
+                if row and row[0] == digest:
+                    conn.execute("COMMIT")
+                    return False
+                orphan = self._decref(conn, row[0]) if row else None
+                conn.execute("INSERT OR REPLACE INTO refs (path, hash) VALUES (?, ?)", (rel, digest))
+                conn.execute(
+                    "INSERT INTO objects (hash, size, refcount) VALUES (?, ?, 1) "
+                    "ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1",
+                    (digest, size),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if orphan:
+            self._remove_object(orphan)
+        return True
+
+    def _decref(self, conn: sqlite3.Connection, digest: str) -> Optional[str]:
+        """引用数减一，归零时删除索引记录并返回该哈希 (提交后再删除对象文件)"""
+        conn.execute("UPDATE objects SET refcount = refcount - 1 WHERE hash = ?", (digest,))
+        row = conn.execute("SELECT refcount FROM objects WHERE hash = ?", (digest,)).fetchone()
+        if row and row[0] <= 0:
+            conn.execute("DELETE FROM objects WHERE hash = ?", (digest,))
+            return digest
+        return None
+
+    def _remove_object(self, digest: str):
+        """删除引用数已归零的对象文件；在写事务中复查 (提交到此处之间可能已被重新引用)"""
+        with self._lock:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT refcount FROM objects WHERE hash = ?", (digest,)).fetchone()
+                if row is None or row[0] <= 0:
+                    self.object_path(digest).unlink(missing_ok=True)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    # --- 对象 ---
+    def object_path(self, digest: str) -> Path:
+        return self.objects / digest[:2] / digest
+
+    def _link(self, obj: Path, dest: Path):
+        """让 dest 指向对象 (原子替换已存在的 dest)"""
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if dest.exists() and os.path.samefile(obj, dest):
+            return
+        tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.tmp")
+        clone_file(obj, tmp)
+        os.replace(tmp, dest)
+        fsync_dir(dest.parent)
+
+    def _store(self, dest: Path, digest: str, size: int, materialize: Callable[[Path], None]) -> str:
+        """
+        先登记引用 (引用数 > 0 的对象不会被并发的 release 删除)，再确保对象存在 (不存在时调用 materialize 创建)
+        并链接到 dest；失败时撤销本次登记的引用
+        """
+        added = self._register(dest, digest, size)
+        try:
+            obj = self.object_path(digest)
+            if not obj.exists():
+                materialize(obj)
+            self._link(obj, dest)
+        except BaseException:
+            if added:
+                self.release(dest)
+            raise
+        return digest
+
+    def put_bytes(self, data: bytes, dest: Path) -> str:
+        """写入字节到 dest (内容已存在时只建立链接)，返回哈希"""
+        digest = hashlib.sha256(data).hexdigest()
+        return self._store(dest, digest, len(data), lambda obj: write_atomic(obj, data))
+
+    def temp_path(self) -> Path:
+        """与对象目录同一文件系统的临时文件路径 (写完后可直接 rename 为对象)"""
+        tmp_dir = self.root / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        return tmp_dir / f"{uuid.uuid4().hex}.part"
+
+    def put_temp(self, tmp: Path, digest: str, dest: Path) -> str:
+        """把已写完并算好哈希的临时文件 (见 temp_path) 提交为对象并链接到 dest；内容已存在时丢弃临时文件"""
+        def materialize(obj: Path):
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, obj)
+            fsync_dir(obj.parent)
+
+        try:
+            return self._store(dest, digest, tmp.stat().st_size, materialize)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def put_file(self, src: Path, dest: Path) -> str:
+        """把工作区外的文件 src 的内容放到 dest (reflink 或复制，不与 src 共享 inode)，返回哈希"""
+        digest = hash_file(src)
+
+        def materialize(obj: Path):
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            tmp = obj.with_name(f"{digest}.{uuid.uuid4().hex[:8]}.tmp")
+            clone_file(src, tmp, hardlink=False)
+            os.replace(tmp, obj)
+
+        return self._store(dest, digest, src.stat().st_size, materialize)
+
+    def adopt(self, path: Path) -> str:
+        """把工作区内已有的普通文件纳入存储 (内容重复时替换为指向已有对象的链接)"""
+        digest = hash_file(path)
+
+        def materialize(obj: Path):
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            tmp = obj.with_name(f"{digest}.{uuid.uuid4().hex[:8]}.tmp")
+            # 文件本身就在工作区内，对象直接硬链接到它 (之后的 _link 发现是同一文件，不再替换)
+            clone_file(path, tmp)
+            os.replace(tmp, obj)
+
+        return self._store(path, digest, path.stat().st_size, materialize)
+
+    def adopt_tree(self, directory: Path) -> int:
+        count = 0
+        for f in directory.rglob("*"):
+            if f.is_file() and f.name != "project.json":
+                self.adopt(f)
+                count += 1
+        return count
+
+    def release(self, path: Path):
+        """文件即将被删除：释放其引用"""
+        self.release_prefix(self._rel(path), exact=True)
+
+    def release_tree(self, directory: Path):
+        """目录 (如整个项目) 即将被删除：释放其下所有引用"""
+        self.release_prefix(self._rel(directory) + "/")
+
+    def release_prefix(self, prefix: str, exact: bool = False):
+        orphans = []
+        with self._lock:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if exact:
+                    rows = conn.execute("SELECT path, hash FROM refs WHERE path = ?", (prefix,)).fetchall()
+                else:
+                    rows = conn.execute(
+                        "SELECT path, hash FROM refs WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)
+                    ).fetchall()
+                for path, digest in rows:
+                    conn.execute("DELETE FROM refs WHERE path = ?", (path,))
+                    orphan = self._decref(conn, digest)
+                    if orphan:
+                        orphans.append(orphan)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        for digest in orphans:
+            self._remove_object(digest)
+
+    def move(self, src: Path, dst: Path):
+        """移动项目文件 (同一文件系统内 rename，dst 必须不存在) 并更新索引中的路径"""
+        src_rel, dst_rel = self._rel(src), self._rel(dst)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, dst)
+        fsync_dir(dst.parent)
+        with self._lock:
+            self._conn().execute("UPDATE refs SET path = ? WHERE path = ?", (dst_rel, src_rel))
+
+    def hash_of(self, path: Path) -> Optional[str]:
+        """项目文件对应的内容哈希 (未纳入存储的文件返回 None)"""
+        try:
+            rel = self._rel(path)
+        except ValueError:
+            return None
+        row = self._conn().execute("SELECT hash FROM refs WHERE path = ?", (rel,)).fetchone()
+        return row[0] if row else None
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._conn()
+        objects, stored, logical = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refcount), 0) FROM objects"
+        ).fetchone()
+        refs = conn.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+        return {
+            "objects": objects,
+            "refs": refs,
+            "stored_bytes": stored,
+            "logical_bytes": logical,
+            "saved_bytes": logical - stored,
+        }
+
+
+# 全局单例
+store = ContentStore(settings.WORKSPACE_DIR / ".cas", settings.WORKSPACE_DIR)
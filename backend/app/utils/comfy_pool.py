@@ -0,0 +1,187 @@
+"""
+backend/app/utils/comfy_pool.py
+ComfyUI 后端池：多台 GPU 节点的负载均衡、健康检查与熔断
+- 路由: 选择 (排队数 × 近期平均耗时) 最小的健康节点
+- 粘性: 工作流所需模型已在某节点加载过时，优先复用该节点
+- 熔断: 连续失败达到阈值后暂停派发，冷却后放行一次试探 (半开)
+"""
+import time
+import asyncio
+import hashlib
+import logging
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+import httpx
+from config import settings
+from app.utils.comfy_stats import stats, workflow_key
+from app.utils.health import CircuitBreaker, registry as health_registry
+
+logger = logging.getLogger("backend.comfy_pool")
+
+# 粘性路由容忍度：已加载模型的节点负载不超过最优节点的该倍数时仍优先选择它
+STICKY_TOLERANCE = 1.5
+# 工作流中代表模型文件的输入字段
+MODEL_FIELDS = ("ckpt_name", "unet_name", "vae_name", "clip_name", "lora_name", "model_name", "control_net_name")
+
+
+def workflow_signature(workflow: Dict[str, Any]) -> str:
+    """
+    计算工作流的"模型签名"：相同签名的工作流使用同一组模型，
+    在已经加载过这些模型的节点上执行可以省去加载时间。
+    """
+    models = set()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        for field, value in (node.get("inputs") or {}).items():
+            if field in MODEL_FIELDS and isinstance(value, str):
+                models.add(value)
+    if not models:
+        # 没有显式模型时，用节点类型集合区分工作流
+        models = {str(node.get("class_type")) for node in workflow.values() if isinstance(node, dict)}
+    return hashlib.sha1("|".join(sorted(models)).encode("utf-8")).hexdigest()[:12]
+
+
+class ComfyBackend(CircuitBreaker):
+    """单个 ComfyUI 节点的运行状态 (熔断逻辑见 app/utils/health.py)"""
+
+    def __init__(self, url: str):
+        super().__init__(
+            f"comfy:{url.rstrip('/')}",
+            threshold=settings.COMFY_FAILURE_THRESHOLD,
+            cooldown=settings.COMFY_CIRCUIT_COOLDOWN,
+        )
+        self.url = url.rstrip("/")
+        self.queue_remaining = 0          # 最近一次探测到的 ComfyUI 队列长度
+        self.inflight = 0                 # 本进程已派发、尚未结束的任务数
+        self.loaded = deque(maxlen=4)     # 最近执行过的工作流签名 (模型大概率仍在显存中)
+
+    @property
+    def ws_url(self) -> str:
+        return self.url.replace("http://", "ws://").replace("https://", "wss://")
+
+    def avg_duration(self) -> float:
+        """该节点最近的平均执行耗时 (来自 comfy_stats)"""
+        return stats.backend_mean(self.url)
+
+    def load_score(self, wf_key: Optional[str] = None) -> float:
+        """预计完成时间：排队任务数 × 平均耗时 + 本工作流的预计耗时"""
+        pending = max(self.queue_remaining, self.inflight)
+        return stats.eta(wf_key, self.url, pending)
+
+    def record_success(self, signature: Optional[str] = None):
+        super().record_success()
+        if signature:
+            if signature in self.loaded:
+                self.loaded.remove(signature)
+            self.loaded.append(signature)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "state": self.state,
+            "queue_remaining": self.queue_remaining,
+            "inflight": self.inflight,
+            "avg_duration": round(self.avg_duration(), 2),
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class ComfyPool:
+    """ComfyUI 后端池 (全局单例见模块底部的 pool)"""
+
+    def __init__(self, urls: List[str]):
+        self.backends = [ComfyBackend(u) for u in urls]
+        # 节点由本池自行探测 (顺带读取队列长度)，健康注册表只登记熔断器用于汇总状态
+        for b in self.backends:
+            health_registry.register(b.name, breaker=b)
+        self._health_task: Optional[asyncio.Task] = None
+        # 显式配置了 COMFY_URLS 时立即开始探测；只有默认 COMFY_URL 时等到第一次派发任务 (可能根本没有部署 ComfyUI)
+        self.active = bool(settings.COMFY_URLS)
+
+    def select(self, workflow: Optional[Dict[str, Any]] = None, exclude=()) -> ComfyBackend:
+        """
+        为工作流挑选一个节点
+        exclude: 本次任务中已经尝试失败的节点
+        半开节点只有在试探名额空闲时才是候选，名额由 acquire() 占用
+        """
+        candidates = [b for b in self.backends if b.ready() and b not in exclude]
+        if not candidates:
+            errors = "; ".join(f"{b.url}: {b.last_error}" for b in self.backends if b.last_error)
+            raise RuntimeError(f"No healthy ComfyUI backend available ({errors or 'all circuits open'})")
+
+        wf_key = workflow_key(workflow) if workflow else None
+        best = min(candidates, key=lambda b: b.load_score(wf_key))
+        if workflow:
+            signature = workflow_signature(workflow)
+            warm = [b for b in candidates if signature in b.loaded]
+            if warm:
+                sticky = min(warm, key=lambda b: b.load_score(wf_key))
+                if sticky.load_score(wf_key) <= best.load_score(wf_key) * STICKY_TOLERANCE:
+                    return sticky
+        return best
+
+    def acquire(self, workflow: Optional[Dict[str, Any]] = None, exclude=()) -> ComfyBackend:
+        """选择节点并登记一个进行中的任务，结束后必须调用 release()"""
+        self.active = True
+        backend = self.select(workflow, exclude)
+        # 半开节点在此占用唯一的试探名额，其余任务在试探结束前不会再派发到该节点
+        backend.allow()
+        backend.inflight += 1
+        return backend
+
+    def release(self, backend: ComfyBackend):
+        backend.inflight = max(0, backend.inflight - 1)
+        if backend.inflight == 0:
+            # 节点上已没有任务：试探若未上报结果 (被取消 / 业务错误) 则归还名额
+            backend.end_trial()
+
+    async def probe(self, backend: ComfyBackend, client: httpx.AsyncClient):
+        """轻量探测：GET /prompt 返回 {"exec_info": {"queue_remaining": n}}"""
+        backend.last_probe = time.monotonic()
+        try:
+            resp = await client.get(f"{backend.url}/prompt")
+            resp.raise_for_status()
+            backend.queue_remaining = int(resp.json().get("exec_info", {}).get("queue_remaining", 0))
+            if backend.failures:
+                logger.info(f"✅ ComfyUI backend {backend.url} recovered")
+            backend.record_success()
+        except Exception as e:
+            backend.record_failure(f"Health check failed: {e}")
+
+    async def probe_all(self):
+        async with httpx.AsyncClient(trust_env=False, timeout=5.0) as client:
+            await asyncio.gather(*(self.probe(b, client) for b in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            try:
+                if self.active:
+                    await self.probe_all()
+            except Exception as e:
+                logger.error(f"ComfyUI health loop error: {e}")
+            await asyncio.sleep(settings.COMFY_HEALTH_INTERVAL)
+
+    def start(self):
+        """启动后台健康检查 (在 lifespan 中调用)"""
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+            logger.info(f"✅ ComfyUI pool started with {len(self.backends)} backend(s)")
+
+    async def stop(self):
+        if self._health_task:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [b.to_dict() for b in self.backends]
+
+
+# 全局单例
+pool = ComfyPool(settings.COMFY_URLS or [settings.COMFY_URL])
@@ -0,0 +1,119 @@
+"""
+backend/app/utils/comfy_stats.py
+ComfyUI 执行耗时统计：按工作流 / 按后端节点 / 按单个节点记录最近的执行时间
+- 用于估算任务 ETA (结合 ComfyUI 队列位置)
+- comfy_pool 调度时也读取这里的数据判断各节点负载
+"""
+import time
+import hashlib
+from collections import deque
+from typing import Dict, Any, Iterable, Optional, Tuple
+
+# 每个统计项保留的样本数
+WINDOW = 30
+# 没有任何历史数据时假定的单次执行耗时 (秒)
+DEFAULT_DURATION = 20.0
+
+
+def workflow_key(workflow: Dict[str, Any]) -> str:
+    """工作流结构指纹：节点 ID + 节点类型相同即视为同一个工作流 (参数不同不影响)"""
+    items = sorted(
+        (str(node_id), str(node.get("class_type")))
+        for node_id, node in workflow.items() if isinstance(node, dict)
+    )
+    return hashlib.sha1(repr(items).encode("utf-8")).hexdigest()[:12]
+
+
+class RollingStat:
+    """固定窗口的耗时样本"""
+
+    def __init__(self, window: int = WINDOW):
+        self.samples = deque(maxlen=window)
+        self.updated_at = 0.0
+
+    def add(self, value: float):
+        self.samples.append(value)
+        self.updated_at = time.time()
+
+    def mean(self) -> Optional[float]:
+        if not self.samples:
+            return None
+        return sum(self.samples) / len(self.samples)
+
+    def to_dict(self) -> Dict[str, Any]:
+        mean = self.mean()
+        return {
+            "count": len(self.samples),
+            "mean": round(mean, 2) if mean is not None else None,
+            "last": round(self.samples[-1], 2) if self.samples else None,
+        }
+
+
+class ComfyStats:
+    """全局耗时统计 (单例见模块底部的 stats)"""
+
+    def __init__(self):
+        self.workflows: Dict[str, RollingStat] = {}
+        self.backends: Dict[str, RollingStat] = {}
+        self.nodes: Dict[Tuple[str, str], RollingStat] = {}
+
+    @staticmethod
+    def _stat(table: dict, key) -> RollingStat:
+        if key not in table:
+            table[key] = RollingStat()
+        return table[key]
+
+    # --- 记录 ---
+    def record_run(self, wf_key: str, backend_url: str, duration: float):
+        self._stat(self.workflows, wf_key).add(duration)
+        self._stat(self.backends, backend_url).add(duration)
+
+    def record_node(self, wf_key: str, node_id: str, duration: float):
+        self._stat(self.nodes, (wf_key, str(node_id))).add(duration)
+
+    # --- 查询 ---
+    def backend_mean(self, backend_url: str) -> float:
+        stat = self.backends.get(backend_url)
+        mean = stat.mean() if stat else None
+        return mean if mean is not None else DEFAULT_DURATION
+
+    def expected_duration(self, wf_key: Optional[str], backend_url: Optional[str] = None) -> float:
+        """预计执行耗时：优先用该工作流的历史，其次用该节点的平均值"""
+        stat = self.workflows.get(wf_key) if wf_key else None
+        mean = stat.mean() if stat else None
+        if mean is not None:
+            return mean
+        if backend_url:
+            return self.backend_mean(backend_url)
+        return DEFAULT_DURATION
+
+    def remaining_duration(self, wf_key: str, pending_nodes: Iterable[str], elapsed: float) -> float:
+        """
+        估算剩余执行时间
+        有节点级统计时累加尚未执行节点的平均耗时，否则用 (整体预计耗时 - 已耗时)
+        """
+        total, known = 0.0, False
+        for node_id in pending_nodes:
+            stat = self.nodes.get((wf_key, str(node_id)))
+            mean = stat.mean() if stat else None
+            if mean is not None:
+                total += mean
+                known = True
+        if known:
+            return total
+        return max(self.expected_duration(wf_key) - elapsed, 0.0)
+
+    def eta(self, wf_key: Optional[str], backend_url: str, queue_ahead: int) -> float:
+        """ETA = 前面排队的任务数 × 节点平均耗时 + 本工作流预计耗时"""
+        return queue_ahead * self.backend_mean(backend_url) + self.expected_duration(wf_key, backend_url)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "workflows": {k: v.to_dict() for k, v in self.workflows.items()},
+            "backends": {k: v.to_dict() for k, v in self.backends.items()},
+            "nodes": {f"{wf}:{node}": v.to_dict() for (wf, node), v in self.nodes.items()},
+        }
+
+
+# 全局单例
+stats = ComfyStats()
@@ -0,0 +1,198 @@
+"""
+backend/app/utils/health.py
+外部后端健康注册表：熔断器 + 周期性轻量探测
+- 每个后端 (ComfyUI 节点、8021 本地 Gemini、自定义 base_url 的 LiteLLM 服务) 一个熔断器
+- 熔断器状态: closed (正常) / open (连续失败达到阈值，直接拒绝) / half_open (冷却结束，只放行一次试探)
+- 熔断打开期间任务立即失败并给出明确原因，不再逐个等待连接超时
+- 后台定期探测已注册且实际使用过的后端，恢复后自动闭合 (没有部署 / 从未使用的服务不探测)
+"""
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+from config import settings
+
+logger = logging.getLogger("backend.health")
+
+
+class CircuitOpenError(Exception):
+    """目标后端熔断中 (不可重试)"""
+
+
+def is_connection_error(error: Exception) -> bool:
+    """连接失败 / 超时类错误才计入熔断，业务错误 (参数错误、内容审核等) 不算后端故障"""
+    if isinstance(error, (httpx.TransportError, ConnectionError, OSError, asyncio.TimeoutError)):
+        return True
+    name = type(error).__name__
+    return any(k in name for k in ("Connect", "Timeout", "ServiceUnavailable"))
+
+
+class CircuitBreaker:
+    """单个后端的熔断器"""
+
+    def __init__(self, name: str, threshold: Optional[int] = None, cooldown: Optional[float] = None):
+        self.name = name
+        self.threshold = threshold or settings.BREAKER_FAILURE_THRESHOLD
+        self.cooldown = cooldown or settings.BREAKER_COOLDOWN
+        self.failures = 0                 # 连续失败次数
+        self.open_until = 0.0             # 熔断截止时间 (0 表示闭合)
+        self.last_error: Optional[str] = None
+        self.last_probe = 0.0
+        self._trial_running = False       # 半开状态下是否已有试探请求在执行
+
+    @property
+    def state(self) -> str:
+        """熔断器状态: closed / open / half_open"""
+        if self.failures < self.threshold:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half_open"
+
+    def is_available(self) -> bool:
+        return self.state != "open"
+
+    def ready(self) -> bool:
+        """allow() 的只读版本：闭合，或半开且试探名额尚未被占用 (不占用名额)"""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self._trial_running)
+
+    def allow(self) -> bool:
+        """请求前调用：闭合时放行；半开时只放行一个试探请求"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def end_trial(self):
+        """试探请求结束但没有上报成功 / 失败 (如被取消、业务错误) 时归还试探名额"""
+        self._trial_running = False
+
+    def retry_in(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    def unavailable_message(self) -> str:
+        return (f"Backend '{self.name}' is unavailable (circuit open, retry in {self.retry_in():.0f}s): "
+                f"{self.last_error or 'unknown error'}")
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.last_error = None
+        self._trial_running = False
+
+    def record_failure(self, error: str):
+        self.failures += 1
+        self.last_error = error
+        self._trial_running = False
+        if self.failures >= self.threshold:
+            # 打开 (或在半开试探失败后重新打开) 熔断器
+            self.open_until = time.monotonic() + self.cooldown
+            logger.warning(f"⛔ Backend {self.name} circuit open ({self.failures} failures): {error}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": round(self.retry_in(), 1) if self.state == "open" else 0,
+            "last_error": self.last_error,
+        }
+
+
+class HealthRegistry:
+    """全部后端的熔断器与探测任务 (单例见模块底部的 registry)"""
+
+    def __init__(self):
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.probe_urls: Dict[str, str] = {}
+        self.used: set = set()            # 至少被 call() 调用过一次的后端，只探测这些
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, name: str, probe_url: Optional[str] = None, breaker: Optional[CircuitBreaker] = None) -> CircuitBreaker:
+        """
+        登记一个后端 (重复登记返回已有的熔断器)
+        probe_url: 探测地址，只要能得到 HTTP 响应 (非 5xx) 即视为存活；不提供时由调用方自行上报结果
+                   该后端第一次经 call() 调用之后才开始探测
+        breaker: 已有的熔断器对象 (如 ComfyUI 节点自带的)
+        """
+        if name not in self.breakers:
+            self.breakers[name] = breaker or CircuitBreaker(name)
+        if probe_url:
+            self.probe_urls[name] = probe_url
+        return self.breakers[name]
+
+    def register_base_url(self, base_url: str) -> CircuitBreaker:
+        """自定义 base_url 的 LiteLLM 服务 (vLLM / Ollama 等)，按主机登记并探测 /models"""
+        name = f"llm:{urlparse(base_url).netloc or base_url}"
+        return self.register(name, probe_url=f"{base_url.rstrip('/')}/models")
+
+    async def call(self, breaker: CircuitBreaker, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """在熔断器保护下执行 factory()：熔断中直接抛出 CircuitOpenError，连接类错误计入失败"""
+        self.used.add(breaker.name)
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.unavailable_message())
+        try:
+            result = await factory()
+        except Exception as e:
+            if is_connection_error(e):
+                breaker.record_failure(str(e) or type(e).__name__)
+            else:
+                breaker.record_success()
+            raise
+        except BaseException:
+            # 被取消 (CancelledError) 时没有结论：归还半开状态的试探名额，否则熔断器会一直拒绝请求
+            breaker.end_trial()
+            raise
+        breaker.record_success()
+        return result
+
+    async def probe(self, name: str, client: httpx.AsyncClient):
+        breaker = self.breakers[name]
+        breaker.last_probe = time.monotonic()
+        try:
+            resp = await client.get(self.probe_urls[name])
+            if resp.status_code >= 500:
+                raise httpx.HTTPStatusError(f"HTTP {resp.status_code}", request=resp.request, response=resp)
+            if breaker.failures:
+                logger.info(f"✅ Backend {name} recovered")
+            breaker.record_success()
+        except Exception as e:
+            breaker.record_failure(f"Health check failed: {e}")
+
+    async def probe_all(self):
+        async with httpx.AsyncClient(trust_env=False, timeout=5.0) as client:
+            names = [name for name in self.probe_urls if name in self.used]
+            await asyncio.gather(*(self.probe(name, client) for name in names))
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"Health probe loop error: {e}")
+            await asyncio.sleep(settings.HEALTH_PROBE_INTERVAL)
+
+    def start(self):
+        """启动后台探测 (在 lifespan 中调用)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def status(self) -> Dict[str, Any]:
+        return {name: b.to_dict() for name, b in self.breakers.items()}
+
+
+# 全局单例
+registry = HealthRegistry()
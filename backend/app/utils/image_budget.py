@@ -0,0 +1,147 @@
+"""
+backend/app/utils/image_budget.py
+发送给外部模型前的图片预处理 (供 pipe_c_api 使用)
+- 每个模型有像素与字节预算，超出时缩小并重新编码
+- 源图已满足预算、格式通用且没有 EXIF 旋转时直接透传原始字节，不做任何解码 / 编码
+- 需要缩小的图先按 EXIF 方向摆正再缩放，输出不带方向标记，与透传的图方向一致
+- 缩小使用 PIL 的 draft / reduce (JPEG 可在解码阶段直接按比例缩小)，避免完整解码 40MP 大图
+- 预处理结果按 (内容哈希, 预算) 缓存在内存 LRU 中，同一张图在多轮对话中只处理一次
+"""
+import io
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps
+from config import settings
+
+logger = logging.getLogger("backend.image_budget")
+
+# 模型名关键字 -> (最大像素数, 最大字节数)；按顺序匹配，第一个命中的生效
+MODEL_BUDGETS = (
+    ("gemini", (3072 * 3072, 7 * 1024 * 1024)),
+    ("claude", (1568 * 1568, 5 * 1024 * 1024)),
+    ("gpt", (2048 * 2048, 8 * 1024 * 1024)),
+)
+# 可直接透传的源格式 (各家模型都支持)
+PASSTHROUGH_FORMATS = ("JPEG", "PNG", "WEBP")
+# 交换宽高的 EXIF 方向 (旋转 90° / 270°)
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+# 重新编码时的初始 / 最低质量
+START_QUALITY = 85
+MIN_QUALITY = 50
+
+
+def budget_for(model: str) -> Tuple[int, int]:
+    model = (model or "").lower()
+    for keyword, budget in MODEL_BUDGETS:
+        if keyword in model:
+            return budget
+    return settings.IMAGE_BUDGET_MAX_PIXELS, settings.IMAGE_BUDGET_MAX_BYTES
+
+
+def _has_alpha(img: Image.Image) -> bool:
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+
+
+def _encode(img: Image.Image, alpha: bool, quality: int) -> Tuple[bytes, str]:
+    """带透明通道的图用 WEBP，其余用 JPEG"""
+    buf = io.BytesIO()
+    if alpha:
+        img.save(buf, format="WEBP", quality=quality, method=4)
+        return buf.getvalue(), "image/webp"
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue(), "image/jpeg"
+
+
+def within_budget(meta: dict, max_pixels: int, max_bytes: int) -> bool:
+    """[新增] 按元数据索引记录判断源图能否原样透传 (与 fit 的透传条件一致，不打开文件)"""
+    return (meta.get("format") in PASSTHROUGH_FORMATS and meta["width"] * meta["height"] <= max_pixels
+            and meta["size"] <= max_bytes and (meta.get("orientation") or 1) == 1)
+
+
+def fit(data: bytes, max_pixels: int, max_bytes: int) -> Tuple[bytes, str]:
+    """
+    [同步] 把图片字节压到预算以内，返回 (bytes, mime_type)
+    Image.open 只读取文件头，透传判断不会触发解码
+    """
+    img = Image.open(io.BytesIO(data))
+    width, height = img.size
+    orientation = img.getexif().get(0x0112, 1)
+    if (img.format in PASSTHROUGH_FORMATS and width * height <= max_pixels and len(data) <= max_bytes
+            and orientation == 1):
+        return data, Image.MIME[img.format]
+
+    scale = min(1.0, (max_pixels / float(width * height)) ** 0.5)
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    # 先用 draft 让 JPEG 在解码阶段按比例缩小 (按原始方向的尺寸)，再摆正方向，最后精细缩放
+    # exif_transpose 会触发解码，放在 draft 之后才不会完整解码大图
+    if img.format == "JPEG":
+        img.draft("RGB", (target[0] * 2, target[1] * 2))
+    img = ImageOps.exif_transpose(img)
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        target = (target[1], target[0])
+    # thumbnail 内部再用 reduce 粗缩，然后做一次精细重采样
+    img.thumbnail(target, Image.LANCZOS, reducing_gap=2.0)
+
+    alpha = _has_alpha(img)
+    img = img.convert("RGBA" if alpha else "RGB")
+    quality = START_QUALITY
+    encoded, mime = _encode(img, alpha, quality)
+    while len(encoded) > max_bytes:
+        if quality > MIN_QUALITY:
+            quality -= 10
+        else:
+            img = img.resize((max(1, int(img.width * 0.75)), max(1, int(img.height * 0.75))), Image.LANCZOS)
+        encoded, mime = _encode(img, alpha, quality)
+
+    logger.debug(f"Image fitted: {width}x{height} {len(data)}B -> {img.width}x{img.height} {len(encoded)}B ({mime})")
+    return encoded, mime
+
+
+class PreparedImageCache:
+    """预处理结果的内存 LRU，按总字节数限制容量 (单例见模块底部的 prepared)"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_fit(self, data: bytes, max_pixels: int, max_bytes: int,
+                         executor: Optional[Executor] = None) -> Tuple[bytes, str]:
+        """
+        哈希与缩放都在 executor 中执行 (None 表示事件循环的默认线程池)，LRU 本身只在事件循环线程中读写
+        调用方传入自己的有界线程池，避免大图缩放占满默认线程池
+        """
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(executor, lambda: hashlib.sha256(data).hexdigest())
+        key = f"{digest}:{max_pixels}:{max_bytes}"
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+        self.misses += 1
+        item = await loop.run_in_executor(executor, fit, data, max_pixels, max_bytes)
+        if key in self._items:
+            # 并发请求同一张图时，先完成的结果已写入
+            return self._items[key]
+        self._items[key] = item
+        self.size += len(item[0])
+        while self.size > self.max_bytes and self._items:
+            _, (old, _) = self._items.popitem(last=False)
+            self.size -= len(old)
+        return item
+
+    def stats(self):
+        return {"entries": len(self._items), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+# 全局单例
+prepared = PreparedImageCache(settings.IMAGE_PREP_CACHE_MB * 1024 * 1024)
@@ -0,0 +1,99 @@
+"""
+backend/app/utils/layout_migration.py
+把已有项目从扁平目录迁移到分片目录布局 (见 storage.STORAGE_SHARDED_DIRS)
+- {项目}/generations/{文件名} -> {项目}/generations/{分片}/{文件名}，同一文件系统内 rename，不复制数据
+- 同步内容寻址存储与元数据索引中的路径，并移动已生成的缩略图 / 瓦片缓存
+- URL 不变，迁移可以在服务运行时进行 (解析时先查分片位置再查扁平位置，单个文件的移动是原子的)
+- 可重复执行：已迁移的文件不再处理
+
+用法 (在 backend 目录下):
+    python -m app.utils.layout_migration                 # 迁移全部项目
+    python -m app.utils.layout_migration --project ID    # 只迁移指定项目
+    python -m app.utils.layout_migration --dry-run       # 只统计，不移动
+"""
+import os
+import argparse
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+
+from config import settings
+from app.utils import storage
+from app.utils.cas import store as cas_store, hash_file
+from app.utils.thumbnails import mips
+from app.utils.tiles import tiles
+from app.utils.asset_index import index as asset_index
+
+logger = logging.getLogger("backend.layout_migration")
+
+
+def _move_cache(old: Path, new: Path):
+    """缩略图 / 瓦片缓存跟随原文件移动 (不存在或目标已有时忽略，需要时会重新生成)"""
+    if old.is_dir() and not new.exists():
+        new.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(old, new)
+
+
+def migrate_project(project_dir: Path, dry_run: bool = False) -> Dict[str, int]:
+    """迁移一个项目，返回 {moved, duplicates, conflicts}"""
+    report = {"moved": 0, "duplicates": 0, "conflicts": 0}
+    for sub_dir in settings.STORAGE_SHARDED_DIRS:
+        root = project_dir / sub_dir
+        if not root.is_dir():
+            continue
+        # 只处理扁平位置上的文件 (子目录即分片目录)
+        for f in sorted(p for p in root.iterdir() if p.is_file() and not p.name.startswith(".")):
+            target = storage.asset_path(project_dir.name, sub_dir, f.name)
+            if target.exists():
+                # 两处都有同名文件 (如中途失败后重新写入)：内容相同时删掉扁平副本，否则保留两者并报告
+                if os.path.samefile(f, target) or hash_file(f) == hash_file(target):
+                    report["duplicates"] += 1
+                    if not dry_run:
+                        cas_store.release(f)
+                        asset_index.forget(f)
+                        f.unlink()
+                else:
+                    report["conflicts"] += 1
+                    logger.warning(f"⚠️ Layout conflict, keeping both: {f} / {target}")
+                continue
+            report["moved"] += 1
+            if dry_run:
+                continue
+            cas_store.move(f, target)
+            asset_index.move(f, target)
+            _move_cache(mips.cache_dir(f), mips.cache_dir(target))
+            _move_cache(tiles.cache_dir(f), tiles.cache_dir(target))
+    return report
+
+
+def migrate_workspace(project_id: Optional[str] = None, dry_run: bool = False) -> Dict[str, Dict[str, int]]:
+    workspace = settings.WORKSPACE_DIR
+    if project_id:
+        projects = [workspace / project_id]
+    else:
+        projects = [d for d in sorted(workspace.iterdir())
+                    if d.is_dir() and not d.name.startswith(".") and (d / "project.json").exists()]
+    results = {}
+    for project_dir in projects:
+        if not (project_dir / "project.json").exists():
+            raise FileNotFoundError(f"Project {project_dir.name} not found")
+        results[project_dir.name] = migrate_project(project_dir, dry_run)
+        logger.info(f"📦 {project_dir.name}: {results[project_dir.name]}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate project assets to the sharded directory layout")
+    parser.add_argument("--project", help="only migrate this project id")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be moved without moving")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    results = migrate_workspace(args.project, args.dry_run)
+    totals = {k: sum(r[k] for r in results.values()) for k in ("moved", "duplicates", "conflicts")}
+    verb = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{verb} {len(results)} projects: {totals}")
+
+
+if __name__ == "__main__":
+    main()
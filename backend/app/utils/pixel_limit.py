@@ -0,0 +1,24 @@
+"""
+backend/app/utils/pixel_limit.py
+在进程池任务中临时放宽 PIL 的解压炸弹保护 (Image.MAX_IMAGE_PIXELS)
+- MAX_IMAGE_PIXELS 是进程全局设置；进程池的子进程一次只执行一个任务，在其中临时修改不会影响其他解码
+- 线程中执行 (未绑定进程池) 时传入 None，保持默认限制，不修改全局设置
+"""
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from PIL import Image
+
+
+@contextmanager
+def raised_pixel_limit(max_pixels: Optional[int]) -> Iterator[None]:
+    """[进程池] 在 with 块内把像素上限放宽到 max_pixels (None 时不修改)，退出时恢复"""
+    if max_pixels is None:
+        yield
+        return
+    previous = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = max(max_pixels, previous or 0) if previous is not None else None
+    try:
+        yield
+    finally:
+        Image.MAX_IMAGE_PIXELS = previous
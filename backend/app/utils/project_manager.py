@@ -8,6 +8,8 @@ import zipfile
 import io
 from pathlib import Path
 from config import settings
+from app.utils.cas import store as cas_store # [新增] 内容寻址存储 (引用计数)
+from app.utils.asset_gc import collector as gc_collector # [新增] 素材垃圾回收 (引用追踪)
 
 logger = logging.getLogger("backend.project_manager")
 
@@ -109,6 +111,8 @@ def update_project(project_id: str, data: dict):
     
     with open(json_path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
+    # [新增] 记录本次保存引用的文件: 之后从画布删除的图片在宽限期内仍可撤销回来
+    gc_collector.touch(data, project_id=project_id)
     
     logger.info(f"💾 Project Saved: {project_id}")
 
@@ -116,6 +120,8 @@ def delete_project(project_id: str):
     """删除项目 (物理删除文件夹)"""
     project_path = PROJECTS_DIR / project_id
     if project_path.exists():
+        # [新增] 先释放项目文件对共享内容的引用，无其他项目引用的对象随之删除
+        cas_store.release_tree(project_path)
         shutil.rmtree(project_path)
         logger.info(f"🗑️ Deleted Project: {project_id}")
     else:
@@ -137,6 +143,12 @@ def import_project(file_bytes: bytes) -> dict:
         if project_dir.exists():
             shutil.rmtree(project_dir)
         raise ValueError(f"Invalid ZIP file: {e}")
+
+    # [新增] 解压出的文件纳入内容寻址存储，与其他项目重复的内容只保留一份
+    try:
+        cas_store.adopt_tree(project_dir)
+    except Exception as e:
+        logger.error(f"Failed to deduplicate imported project files: {e}")
         
     # 3. 修正 project.json 中的 ID
     json_path = project_dir / "project.json"
@@ -164,6 +176,8 @@ def export_project(project_id: str) -> io.BytesIO:
     with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
         # 遍历目录
         for root, dirs, files in os.walk(project_path):
+            # [新增] 缩略图 / 瓦片缓存与元数据索引可随时重建，不打包
+            dirs[:] = [d for d in dirs if d not in (".thumbs", ".tiles", ".gc", ".meta")]
             for file in files:
                 file_path = Path(root) / file
                 # 计算在 ZIP 中的相对路径 (相对于项目根目录)
@@ -0,0 +1,302 @@
+"""
+backend/app/utils/rate_limiter.py
+外部模型 API 的限流、并发控制与重试 (供 pipe_c_api 使用)
+- 按提供商 + 按模型两级限制: 并发上限 + 令牌桶 (每分钟请求数 RPM / 每分钟 token 数 TPM)
+- 超出限制的请求排队等待，而不是直接失败
+- 429 / 5xx / 超时等可重试错误按指数退避 + 随机抖动重试，优先遵守服务端返回的 Retry-After
+- 收到 429 时整个提供商暂停派发到 Retry-After 之后，避免排队的请求继续撞墙
+"""
+import time
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+from config import settings
+
+logger = logging.getLogger("backend.rate_limiter")
+
+# 视为可重试的 HTTP 状态码
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504, 529)
+# 模型名关键字 -> 提供商 (模型名不带 "provider/" 前缀时使用)
+PROVIDER_KEYWORDS = (
+    ("gemini", "gemini"),
+    ("claude", "anthropic"),
+    ("gpt", "openai"),
+    ("dall-e", "openai"),
+    ("o1", "openai"),
+    ("o3", "openai"),
+)
+
+
+def provider_of(model: str, base_url: Optional[str] = None) -> str:
+    """推断调用的提供商：自定义 base_url 按主机区分，其次看 "provider/model" 前缀与模型名关键字"""
+    if base_url:
+        return urlparse(base_url).netloc or base_url
+    model = (model or "").lower()
+    if "/" in model:
+        return model.split("/", 1)[0]
+    for keyword, provider in PROVIDER_KEYWORDS:
+        if keyword in model:
+            return provider
+    return "default"
+
+
+def estimate_tokens(payload: Dict[str, Any]) -> int:
+    """粗略估算一次调用消耗的 token 数 (约 4 字符 / token，图片按固定值计)，调用结束后按实际用量修正"""
+    chars = len(str(payload.get("prompt") or ""))
+    images = 0
+    for msg in payload.get("messages") or []:
+        content = msg.get("content") if isinstance(msg, dict) else None
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for item in content:
+                if isinstance(item, dict) and item.get("type") == "text":
+                    chars += len(str(item.get("text", "")))
+                else:
+                    images += 1
+    return chars // 4 + images * 1000 + int(payload.get("max_tokens") or 512)
+
+
+class TokenBucket:
+    """令牌桶：容量 = 每分钟配额，按秒连续补充；rate 为 0 表示不限制"""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(self.per_minute), self.tokens + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """取出 amount 个令牌还需等待的秒数 (0 表示现在即可)"""
+        if not self.per_minute:
+            return 0.0
+        self._refill()
+        # 单次请求超过桶容量时按满桶处理，否则永远等不到
+        amount = min(amount, self.per_minute)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.per_minute
+
+    def take(self, amount: float):
+        if self.per_minute:
+            self._refill()
+            self.tokens -= min(amount, self.per_minute)
+
+    def give_back(self, amount: float):
+        """按实际用量修正 (多扣的退回，少扣的补扣，允许短暂为负)"""
+        if self.per_minute:
+            self._refill()
+            self.tokens = min(float(self.per_minute), self.tokens + amount)
+
+
+class Limiter:
+    """一个提供商或一个模型的限制器"""
+
+    def __init__(self, name: str, concurrency: int, rpm: int, tpm: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0     # 收到 429 后暂停派发的截止时间
+        self.inflight = 0
+        self.waiting = 0
+        self.counters = {"calls": 0, "retries": 0, "throttled": 0, "failures": 0}
+
+    async def wait_for_budget(self, est_tokens: int):
+        """等待 RPM / TPM 令牌与 429 冷却，拿到后立即扣除"""
+        while True:
+            delay = max(
+                self.blocked_until - time.monotonic(),
+                self.requests.wait_time(1),
+                self.tokens.wait_time(est_tokens),
+            )
+            if delay <= 0:
+                self.requests.take(1)
+                self.tokens.take(est_tokens)
+                return
+            await asyncio.sleep(min(delay, 5.0))
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "rpm": self.requests.per_minute,
+            "rpm_available": round(self.requests.tokens, 1) if self.requests.per_minute else None,
+            "tpm": self.tokens.per_minute,
+            "tpm_available": round(self.tokens.tokens) if self.tokens.per_minute else None,
+            "blocked_for": round(max(0.0, self.blocked_until - time.monotonic()), 1),
+            **self.counters,
+        }
+
+
+def _status_of(error: Exception) -> Optional[int]:
+    for attr in ("status_code", "code", "status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """从异常附带的响应头中读取 Retry-After (秒数或 HTTP 日期)"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def is_retryable(error: Exception) -> bool:
+    # httpx.TransportError: 连接失败 / 读写超时 / 连接被重置 (Gemini SDK 与自定义 base_url 服务直接抛出)
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    status = _status_of(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    name = type(error).__name__
+    return any(k in name for k in ("RateLimit", "Timeout", "ServiceUnavailable", "APIConnection", "InternalServer"))
+
+
+class RateLimiterRegistry:
+    """所有提供商 / 模型的限制器 (单例见模块底部的 limits)"""
+
+    def __init__(self):
+        self.providers: Dict[str, Limiter] = {}
+        self.models: Dict[str, Limiter] = {}
+
+    def _provider(self, name: str) -> Limiter:
+        if name not in self.providers:
+            conf = settings.PROVIDER_LIMITS.get(name, {})
+            self.providers[name] = Limiter(
+                name,
+                conf.get("concurrency", settings.PROVIDER_DEFAULT_CONCURRENCY),
+                conf.get("rpm", settings.PROVIDER_DEFAULT_RPM),
+                conf.get("tpm", settings.PROVIDER_DEFAULT_TPM),
+            )
+        return self.providers[name]
+
+    def _model(self, name: str) -> Optional[Limiter]:
+        """模型级限制只对 MODEL_LIMITS 中配置过的模型生效"""
+        conf = settings.MODEL_LIMITS.get(name)
+        if conf is None:
+            return None
+        if name not in self.models:
+            self.models[name] = Limiter(name, conf.get("concurrency", 0), conf.get("rpm", 0), conf.get("tpm", 0))
+        return self.models[name]
+
+    @asynccontextmanager
+    async def _slot(self, limiters, est_tokens: int):
+        """依次获取并发名额与令牌 (提供商在前，模型在后，顺序固定避免死锁)"""
+        acquired = []
+        started = False
+        for lim in limiters:
+            lim.waiting += 1
+        try:
+            for lim in limiters:
+                if lim.semaphore:
+                    await lim.semaphore.acquire()
+                acquired.append(lim)
+                await lim.wait_for_budget(est_tokens)
+            for lim in limiters:
+                lim.waiting -= 1
+                lim.inflight += 1
+            started = True
+            yield
+        finally:
+            for lim in limiters:
+                if started:
+                    lim.inflight -= 1
+                else:
+                    lim.waiting -= 1
+            for lim in acquired:
+                if lim.semaphore:
+                    lim.semaphore.release()
+
+    async def call(
+        self,
+        provider: str,
+        model: str,
+        factory: Callable[[], Awaitable[Any]],
+        est_tokens: int = 0,
+        usage_of: Optional[Callable[[Any], Optional[int]]] = None,
+        can_retry: Optional[Callable[[], bool]] = None,
+    ) -> Any:
+        """
+        在限流保护下执行 factory() (每次重试都会重新调用 factory 生成新的协程)
+        usage_of: 从结果中取实际 token 用量，用于修正 TPM 桶
+        can_retry: 返回 False 时不再重试 (如流式输出已经向前端推送过内容)
+        """
+        limiters = [self._provider(provider)]
+        model_limiter = self._model(model)
+        if model_limiter:
+            limiters.append(model_limiter)
+
+        attempt = 0
+        while True:
+            try:
+                async with self._slot(limiters, est_tokens):
+                    for lim in limiters:
+                        lim.counters["calls"] += 1
+                    result = await factory()
+                used = usage_of(result) if usage_of else None
+                if used is not None:
+                    for lim in limiters:
+                        lim.tokens.give_back(est_tokens - used)
+                return result
+            except Exception as e:
+                retryable = is_retryable(e) and (can_retry is None or can_retry())
+                if not retryable or attempt >= settings.API_MAX_RETRIES:
+                    for lim in limiters:
+                        lim.counters["failures"] += 1
+                    raise
+
+                retry_after = _retry_after(e)
+                if _status_of(e) == 429 or "RateLimit" in type(e).__name__:
+                    for lim in limiters:
+                        lim.counters["throttled"] += 1
+                        # 没有 Retry-After 时至少暂停一个基础退避时间
+                        lim.block(retry_after if retry_after is not None else settings.API_RETRY_BASE_DELAY)
+
+                # 指数退避 + 全抖动；服务端给出 Retry-After 时不早于它
+                backoff = random.uniform(0, min(settings.API_RETRY_MAX_DELAY, settings.API_RETRY_BASE_DELAY * 2 ** attempt))
+                delay = max(backoff, retry_after or 0.0)
+                attempt += 1
+                for lim in limiters:
+                    lim.counters["retries"] += 1
+                logger.warning(f"🔁 {provider}/{model} call failed ({e}), retry {attempt}/{settings.API_MAX_RETRIES} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "providers": {k: v.to_dict() for k, v in self.providers.items()},
+            "models": {k: v.to_dict() for k, v in self.models.items()},
+        }
+
+
+# 全局单例
+limits = RateLimiterRegistry()
@@ -0,0 +1,193 @@
+"""
+backend/app/utils/response_cache.py
+外部模型调用的响应缓存 (供 pipe_c_api 使用)
+- 只缓存确定性的调用: LiteLLM 对话 (protocol "litellm") 中 temperature == 0 或固定 seed，
+  或 payload 显式要求 "cache": true。Gemini 原生调用与生图调用不会转发 temperature / seed，不自动缓存
+- 缓存键 = 规范化后的 模型 + 消息 (图片内容只取哈希) + 生成参数，绝不包含 api_key
+- 两级存储: 内存 LRU + 磁盘 JSON (CACHE_DIR/responses)
+- payload 中的缓存控制:
+    "cache": false             -> 完全绕过缓存
+    "cache_control": "no-cache" -> 不读缓存，但写入新结果
+    "cache_control": "no-store" -> 不读也不写
+"""
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Any, Optional
+from config import settings
+
+logger = logging.getLogger("backend.response_cache")
+
+# 参与缓存键计算的生成参数: 所有会转发给模型、并且会改变输出的字段 (见 pipe_c_api 的 *_PARAMS)
+KEY_PARAMS = (
+    "temperature", "max_tokens", "top_p", "stop", "frequency_penalty", "presence_penalty", "seed",
+    "tools", "tool_choice", "response_format", "logit_bias", "reasoning_effort",
+    "n", "size", "quality", "style", "ratio",
+)
+# temperature / seed 会被转发给模型的协议，只有这些调用可以按参数判定为确定性
+DETERMINISTIC_PROTOCOLS = ("litellm",)
+# 结果会保存到项目目录的协议，缓存键需要区分项目
+PROJECT_SCOPED_PROTOCOLS = ("litellm_image", "google_genai")
+# 每写入多少次检查一次磁盘缓存上限
+PRUNE_EVERY = 100
+
+
+def _hash(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def _normalize_image(value: Any) -> Any:
+    """图片 (data URL / URL / Base64) 只保留哈希，避免巨大的键和重复序列化"""
+    if isinstance(value, str) and (value.startswith("data:") or len(value) > 512):
+        return {"sha256": _hash(value)}
+    return value
+
+
+def _normalize_content(content: Any) -> Any:
+    if not isinstance(content, list):
+        return content
+    parts = []
+    for item in content:
+        if isinstance(item, dict) and item.get("type") == "image_url":
+            url = (item.get("image_url") or {}).get("url")
+            parts.append({"type": "image_url", "image": _normalize_image(url)})
+        else:
+            parts.append(item)
+    return parts
+
+
+class ResponseCache:
+    """两级响应缓存 (单例见模块底部的 cache)"""
+
+    def __init__(self, directory: Path, max_entries: int, ttl: float, max_disk_entries: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (created, value)
+        self._writes = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypassed": 0}
+
+    # --- 缓存策略 ---
+    @staticmethod
+    def protocol_of(payload: Dict[str, Any]) -> str:
+        model = str(payload.get("model", "")).lower()
+        if "gemini" in model:
+            return "google_genai"
+        return str(payload.get("protocol", ""))
+
+    def is_cacheable(self, payload: Dict[str, Any]) -> bool:
+        if payload.get("cache") is False or payload.get("cache_control") == "no-store":
+            return False
+        if payload.get("cache") is True:
+            return True
+        if self.protocol_of(payload) not in DETERMINISTIC_PROTOCOLS:
+            return False
+        return payload.get("temperature") == 0 or payload.get("seed") is not None
+
+    def make_key(self, payload: Dict[str, Any]) -> str:
+        protocol = self.protocol_of(payload)
+        normalized = {
+            "protocol": protocol,
+            "model": str(payload.get("model", "")).strip().lower(),
+            "base_url": (payload.get("base_url") or "").rstrip("/"),
+            "messages": [
+                {"role": m.get("role"), "content": _normalize_content(m.get("content"))}
+                for m in payload.get("messages") or [] if isinstance(m, dict)
+            ],
+            "prompt": payload.get("prompt"),
+            "image": _normalize_image(payload.get("image")),
+            "mask": _normalize_image(payload.get("mask")),
+            "params": {k: payload[k] for k in KEY_PARAMS if k in payload},
+        }
+        if protocol in PROJECT_SCOPED_PROTOCOLS:
+            normalized["project_id"] = payload.get("project_id")
+        return _hash(json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str))
+
+    # --- 读写 ---
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, created: float, value: Dict[str, Any]):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        path = self._path(key)
+        try:
+            record = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if time.time() - record.get("created", 0) > self.ttl:
+            path.unlink(missing_ok=True)
+            return None
+        return record["created"], record["value"]
+
+    def _write_disk(self, key: str, created: float, value: Dict[str, Any]):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"created": created, "value": value}, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(path)
+
+    def _prune_disk(self):
+        """磁盘条目超过上限时删除最旧的文件"""
+        files = sorted(self.directory.glob("*/*.json"), key=lambda f: f.stat().st_mtime)
+        for f in files[:max(0, len(files) - self.max_disk_entries)]:
+            f.unlink(missing_ok=True)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._memory.get(key)
+        if entry and time.time() - entry[0] <= self.ttl:
+            self._memory.move_to_end(key)
+            self.counters["memory_hits"] += 1
+            return entry[1]
+
+        entry = await asyncio.to_thread(self._read_disk, key)
+        if entry:
+            self._remember(key, *entry)
+            self.counters["disk_hits"] += 1
+            return entry[1]
+
+        self.counters["misses"] += 1
+        return None
+
+    async def put(self, key: str, value: Dict[str, Any]):
+        created = time.time()
+        self._remember(key, created, value)
+        self.counters["stores"] += 1
+        try:
+            await asyncio.to_thread(self._write_disk, key, created, value)
+            self._writes += 1
+            if self._writes % PRUNE_EVERY == 0:
+                await asyncio.to_thread(self._prune_disk)
+        except OSError as e:
+            logger.warning(f"Response cache write failed: {e}")
+
+    def skip(self):
+        """记录一次不可缓存的调用"""
+        self.counters["bypassed"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        lookups = hits + self.counters["misses"]
+        return {
+            **self.counters,
+            "memory_entries": len(self._memory),
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+# 全局单例
+cache = ResponseCache(
+    settings.CACHE_DIR / "responses",
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=settings.RESPONSE_CACHE_TTL,
+    max_disk_entries=settings.RESPONSE_CACHE_MAX_DISK_ENTRIES,
+)
@@ -6,17 +6,25 @@ backend/app/utils/storage.py
   ├── backend/
   └── workspace/       <-- 我们要读写这里
       ├── inputs/
-      └── generations/
+      └── generations/ <-- [新增] 按文件名哈希分片: generations/{2位十六进制}/{文件名} (见 STORAGE_SHARDED_DIRS)
 """
 import os
 import uuid
-import shutil
+import asyncio
+import functools
 import hashlib # [新增] 用于计算哈希去重
 import logging
 import aiofiles
 from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, unquote
 from fastapi import UploadFile
 from config import settings
+from app.utils.blob_store import blobs, is_blob_ref # [新增] blob:// 句柄
+from app.utils.cas import store as cas_store, fsync_file, fsync_dir # [新增] 工作区内容寻址存储
+from app.utils.thumbnails import mips # [新增] 画布缩略图金字塔
+from app.utils import asset_index # [新增] 素材元数据索引
 
 # --- 1. 定位路径 ---
 WORKSPACE_DIR = settings.WORKSPACE_DIR
@@ -27,13 +35,103 @@ SERVER_BASE_URL = settings.SERVER_BASE_URL
 
 logger = logging.getLogger("backend.storage")
 
+# --- 1.1 [新增] 分片目录布局 ---
+# 单个目录下文件过多 (数万个) 时目录操作明显变慢，分片子目录由文件名的哈希决定:
+# URL 只含文件名，不需要查表就能算出磁盘位置；未迁移的旧文件仍在扁平位置，解析时依次尝试
+SHARD_CHARS = 2
+
+def shard_of(filename: str) -> str:
+    return hashlib.sha1(filename.encode("utf-8")).hexdigest()[:SHARD_CHARS]
+
+def is_sharded(sub_dir: str) -> bool:
+    return sub_dir in settings.STORAGE_SHARDED_DIRS
+
+def asset_path(project_id: str, sub_dir: str, filename: str) -> Path:
+    """新文件的磁盘位置 (分片目录中的文件放在哈希前缀子目录下)"""
+    base = PROJECTS_DIR / project_id / sub_dir
+    return base / shard_of(filename) / filename if is_sharded(sub_dir) else base / filename
+
+def sharded_rel(rel: str) -> Optional[str]:
+    """URL 中的工作区相对路径 {项目}/{子目录}/{文件名} -> 分片后的相对路径 (不属于分片目录时返回 None)"""
+    parts = rel.split("/")
+    if len(parts) != 3 or not is_sharded(parts[1]):
+        return None
+    return f"{parts[0]}/{parts[1]}/{shard_of(parts[2])}/{parts[2]}"
+
+def public_rel(project_rel: str) -> str:
+    """项目内磁盘相对路径 -> URL 中使用的路径 (generations/ab/x.png -> generations/x.png)"""
+    parts = project_rel.split("/")
+    if len(parts) == 3 and is_sharded(parts[0]) and parts[1] == shard_of(parts[2]):
+        return f"{parts[0]}/{parts[2]}"
+    return project_rel
+
+def locate(project_id: str, sub_dir: str, filename: str) -> Path:
+    """已有文件的磁盘位置: 分片位置 -> 旧的扁平位置；都不存在时返回新文件应写入的位置"""
+    path = asset_path(project_id, sub_dir, filename)
+    if path.exists() or not is_sharded(sub_dir):
+        return path
+    legacy = PROJECTS_DIR / project_id / sub_dir / filename
+    return legacy if legacy.exists() else path
+
 # --- 初始化函数 ---
 def init_storage():
     """系统启动时调用：确保存储目录存在"""
     print(f"✅ Storage System Initialized at: {WORKSPACE_DIR}")
     logger.info(f"✅ Storage System Initialized at: {WORKSPACE_DIR}")
 
+# --- 1.2 [新增] 入库: EXIF 方向在写入前转正，写入后建立元数据记录与缩略图 ---
+def _ingest(path: Path, digest: Optional[str] = None):
+    try:
+        asset_index.index.ingest(path, digest)
+    except Exception as e:
+        logger.warning(f"⚠️ Asset metadata indexing failed for {path.name}: {e}")
+
+def _on_stored(path: Path, digest: Optional[str] = None):
+    """[事件循环] 文件入库后在后台生成缩略图与元数据记录，不阻塞返回"""
+    mips.schedule(path)
+    asyncio.get_running_loop().run_in_executor(_io_executor, _ingest, path, digest)
+
+def _store_bytes(data: bytes, path: Path) -> str:
+    """转正后写入内容寻址存储，返回哈希"""
+    return cas_store.put_bytes(asset_index.normalize_bytes(data), path)
+
 # --- 2. 核心功能: 保存上传 (Inputs) - [含去重逻辑] ---
+class UploadTooLarge(ValueError):
+    """[新增] 上传文件超过该目录的大小上限"""
+
+def upload_limit(sub_dir: str) -> int:
+    return settings.UPLOAD_MAX_BYTES.get(sub_dir, settings.UPLOAD_DEFAULT_MAX_BYTES)
+
+def _write_chunk(f, hasher, chunk: bytes):
+    hasher.update(chunk)
+    f.write(chunk)
+
+def _close_spool(f):
+    fsync_file(f)
+    f.close()
+
+async def spool_upload(file: UploadFile, max_bytes: int):
+    """
+    [新增] 分块读取上传内容写入临时文件，同时增量计算 SHA-256，返回 (临时路径, 哈希, 字节数)
+    内存占用只有一个块；超过 max_bytes 时删除临时文件并抛出 UploadTooLarge
+    """
+    tmp = await run_io(cas_store.temp_path)
+    hasher = hashlib.sha256()
+    size = 0
+    f = await run_io(open, tmp, "wb")
+    try:
+        while chunk := await file.read(settings.UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"File exceeds the {max_bytes // (1024 * 1024)}MB upload limit")
+            await run_io(_write_chunk, f, hasher, chunk)
+        await run_io(_close_spool, f)
+    except BaseException:
+        f.close()
+        tmp.unlink(missing_ok=True)
+        raise
+    return tmp, hasher.hexdigest(), size
+
 async def save_upload_file(file: UploadFile, project_id: str = None, type: str = "inputs") -> dict:
     """保存用户上传的原图 (支持存入指定项目)"""
     
@@ -45,44 +143,47 @@ async def save_upload_file(file: UploadFile, project_id: str = None, type: str =
     valid_types = ["inputs", "generations", "ps_exchange"]
     sub_dir = type if type in valid_types else "inputs"
 
-    save_dir = PROJECTS_DIR / project_id / sub_dir
     # URL 映射: /files/{id}/{sub_dir}/... (因为 workspace 挂载在 /files)
     url_prefix = f"/files/{project_id}/{sub_dir}"
 
-    save_dir.mkdir(parents=True, exist_ok=True)
-
-    # 1. 读取文件内容
-    content = await file.read()
-    
-    # 2. 计算 Hash (SHA-256)
-    file_hash = hashlib.sha256(content).hexdigest()
-    
-    # 3. 构造文件名: {原名stem}_{hash前8位}{后缀}
-    original_name = file.filename or "upload.png"
-    name_stem = Path(original_name).stem
-    suffix = Path(original_name).suffix
-    
-    # 使用 hash 前8位作为唯一标识，既防重名又防内容重复
-    new_filename = f"{name_stem}_{file_hash[:8]}{suffix}"
-    save_path = save_dir / new_filename
-    
-    # 构造 URL
-    url_path = f"{url_prefix}/{new_filename}"
-    full_url = f"{SERVER_BASE_URL}{url_path}"
+    # 1+2. [Modified] 流式写入临时文件并增量计算 Hash (SHA-256)，不把整个文件读入内存
+    tmp, file_hash, _ = await spool_upload(file, upload_limit(sub_dir))
+    # [Fix] 之后任何一步失败 (磁盘满 / 权限等) 都要删除临时文件，不能留在 .cas/tmp 中
+    try:
+        # [新增] 带 EXIF 旋转的照片先转正 (文件名中的哈希取转正后的内容)
+        file_hash = await run_io(asset_index.normalize_file, tmp) or file_hash
+        
+        # 3. 构造文件名: {原名stem}_{hash前8位}{后缀}
+        original_name = file.filename or "upload.png"
+        name_stem = Path(original_name).stem
+        suffix = Path(original_name).suffix
+        
+        # 使用 hash 前8位作为唯一标识，既防重名又防内容重复
+        new_filename = f"{name_stem}_{file_hash[:8]}{suffix}"
+        # [Modified] 分片目录布局 (已存在的旧文件可能仍在扁平位置)
+        save_path = await run_io(locate, project_id, sub_dir, new_filename)
+        
+        # 构造 URL
+        url_path = f"{url_prefix}/{new_filename}"
+        full_url = f"{SERVER_BASE_URL}{url_path}"
 
-    # 4. [去重检测] 如果文件已存在，直接返回 URL
-    if save_path.exists():
-        logger.info(f"⚡ File exists (Hash match): {new_filename}")
-        return {
-            "filename": new_filename,
-            "path": str(save_path),
-            "url": full_url,
-            "relative_url": url_path
-        }
-    
-    # 5. 写入文件 (使用 aiofiles 异步写入，避免阻塞)
-    async with aiofiles.open(save_path, "wb") as f:
-        await f.write(content)
+        # 4. [去重检测] 如果文件已存在，直接返回 URL
+        if save_path.exists():
+            tmp.unlink(missing_ok=True)
+            logger.info(f"⚡ File exists (Hash match): {new_filename}")
+            return {
+                "filename": new_filename,
+                "path": str(save_path),
+                "url": full_url,
+                "relative_url": url_path
+            }
+        
+        # 5. [Modified] 写入内容寻址存储并链接到项目目录 (其他项目已有相同内容时不再占用空间)
+        await run_io(cas_store.put_temp, tmp, file_hash, save_path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    _on_stored(save_path, file_hash)
         
     logger.info(f"📂 Saved uploaded file: {new_filename}")
     return {
@@ -93,31 +194,25 @@ async def save_upload_file(file: UploadFile, project_id: str = None, type: str =
     }
 
 # --- 3. 核心功能: 保存生成结果 (Generations) ---
-def save_generated_image(image_bytes: bytes, prefix: str = "gen", ext: str = "png", project_id: str = None) -> dict:
-    """保存生成图 (支持存入指定项目)"""
+def new_generated_file(prefix: str = "gen", ext: str = "png", project_id: str = None) -> dict:
+    """[新增] 为生成结果分配文件名与 URL (只创建目录，不写文件)，返回值与 save_generated_image 相同"""
     
     # [强制] 必须提供 project_id
     if not project_id:
         raise ValueError("❌ Save failed: project_id is required for generated images.")
 
-    save_dir = PROJECTS_DIR / project_id / "generations"
     url_prefix = f"/files/{project_id}/generations"
 
-    save_dir.mkdir(parents=True, exist_ok=True)
-
     # [修改] 使用短 UUID (8位) 防止重复，同时保持文件名简洁
     short_id = uuid.uuid4().hex[:8]
     filename = f"{prefix}_{short_id}.{ext}"
-    save_path = save_dir / filename
-    
-    with open(save_path, "wb") as f:
-        f.write(image_bytes)
+    # [Modified] 磁盘位置按分片布局，URL 不变
+    save_path = asset_path(project_id, "generations", filename)
+    save_path.parent.mkdir(parents=True, exist_ok=True)
         
     # 构造 URL
     url_path = f"{url_prefix}/{filename}"
     full_url = f"{SERVER_BASE_URL}{url_path}"
-    
-    logger.info(f"💾 Saved generated image: {filename}")
 
     return {
         "filename": filename,
@@ -125,4 +220,220 @@ def save_generated_image(image_bytes: bytes, prefix: str = "gen", ext: str = "pn
         "url": full_url,
         "relative_url": url_path,
         "type": "image"
-    }
\ No newline at end of file
+    }
+
+def save_generated_image(image_bytes: bytes, prefix: str = "gen", ext: str = "png", project_id: str = None) -> dict:
+    """
+    保存生成图 (支持存入指定项目)
+    [注意] 同步阻塞版本，只供进程池 / 线程中的调用方使用 (如 pipe_a_rembg)；事件循环中请用 save_generated_image_async
+    """
+    info = new_generated_file(prefix, ext, project_id)
+    
+    # [Modified] 经内容寻址存储写入，相同内容只保存一份
+    digest = _store_bytes(image_bytes, Path(info["path"]))
+    _ingest(Path(info["path"]), digest)
+    
+    logger.info(f"💾 Saved generated image: {info['filename']}")
+    return info
+
+async def save_generated_stream(chunks: AsyncIterator[bytes], prefix: str = "gen", ext: str = "png", project_id: str = None) -> dict:
+    """[新增] 把异步字节流 (如远程下载) 边读边写入生成目录，不在内存中拼出完整文件"""
+    info = await run_io(new_generated_file, prefix, ext, project_id)
+    path = Path(info["path"])
+    # 先写入临时文件，完成后再原子重命名，避免读到半个文件
+    tmp = path.with_name(f".{path.name}.part")
+    try:
+        async with aiofiles.open(tmp, "wb") as f:
+            async for chunk in chunks:
+                await f.write(chunk)
+        digest = await run_io(_commit_stream, tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    _on_stored(path, digest)
+
+    logger.info(f"💾 Saved generated image: {info['filename']}")
+    return info
+
+def import_generated_file(src_path: str, prefix: str = "gen", project_id: str = None) -> dict:
+    """
+    [新增] 把外部服务生成的本地文件登记到生成目录
+    使用 reflink (文件系统支持时不复制数据)，否则复制；源文件属于外部服务，
+    不能与内容寻址存储的对象共享 inode，否则对方原地修改或覆盖会改坏工作区里的文件
+    """
+    src = Path(src_path)
+    ext = src.suffix.lstrip(".").lower() or "png"
+    info = new_generated_file(prefix, ext, project_id)
+    _import_external(src, Path(info["path"]))
+
+    logger.info(f"💾 Imported generated file: {info['filename']}")
+    return info
+
+def _commit_stream(tmp: Path, path: Path) -> str:
+    asset_index.normalize_file(tmp)
+    with open(tmp, "rb+") as f:
+        fsync_file(f)
+    os.replace(tmp, path)
+    fsync_dir(path.parent)
+    return cas_store.adopt(path)
+
+def _import_external(src: Path, dest: Path) -> str:
+    # [Modified] 需要转正时编码到内容存储的临时文件，不在内存中保留整张图片的编码结果
+    tmp = cas_store.temp_path()
+    digest = asset_index.oriented_copy(src, tmp)
+    if digest is not None:
+        return cas_store.put_temp(tmp, digest, dest)
+    return cas_store.put_file(src, dest)
+
+async def import_external_file(src: Path, dest: Path) -> str:
+    """[新增] 把外部文件 (如 Bridge 发来的本地路径) 复制进项目并入库，用户之后修改源文件不影响副本"""
+    digest = await run_io(_import_external, src, dest)
+    _on_stored(dest, digest)
+    return digest
+
+# --- 3.1 [新增] 异步写入接口 (专用 I/O 线程池，不阻塞事件循环) ---
+_io_executor = ThreadPoolExecutor(max_workers=settings.STORAGE_IO_WORKERS, thread_name_prefix="storage-io")
+
+async def run_io(func, *args, **kwargs):
+    """在存储专用线程池中执行阻塞的文件操作"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(func, *args, **kwargs))
+
+class _WriteBehind:
+    """
+    写后回写队列: 先返回 URL，字节在 I/O 线程池中写入
+    排队中的字节数超过 STORAGE_WRITE_BEHIND_MAX_BYTES 时，新的写入等待队列腾出空间 (背压)
+    """
+
+    def __init__(self):
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.pending_bytes = 0
+        self.written = 0
+        self.failed = 0
+        self._drained: Optional[asyncio.Event] = None
+
+    async def submit(self, data: bytes, path: Path):
+        if self._drained is None:
+            self._drained = asyncio.Event()
+        while self.pending and self.pending_bytes + len(data) > settings.STORAGE_WRITE_BEHIND_MAX_BYTES:
+            self._drained.clear()
+            await self._drained.wait()
+
+        size = len(data)
+        self.pending_bytes += size
+        future = asyncio.ensure_future(run_io(_store_bytes, data, path))
+        self.pending[str(path)] = future
+
+        def _done(fut: asyncio.Future):
+            self.pending.pop(str(path), None)
+            self.pending_bytes -= size
+            if fut.cancelled() or fut.exception():
+                self.failed += 1
+                logger.error(f"❌ Write-behind failed for {path.name}: {fut.exception() if not fut.cancelled() else 'cancelled'}")
+            else:
+                self.written += 1
+                _on_stored(path, fut.result())
+            self._drained.set()
+
+        future.add_done_callback(_done)
+
+    async def wait_for(self, path: Path):
+        """等待指定文件写完 (文件仍在队列中时)"""
+        future = self.pending.get(str(path))
+        if future:
+            await asyncio.shield(future)
+
+    async def flush(self):
+        """等待全部排队中的写入完成 (在 lifespan 关闭阶段调用)"""
+        if self.pending:
+            await asyncio.gather(*self.pending.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "pending_bytes": self.pending_bytes,
+            "written": self.written,
+            "failed": self.failed,
+        }
+
+write_behind = _WriteBehind()
+
+async def save_generated_image_async(image_bytes: bytes, prefix: str = "gen", ext: str = "png",
+                                     project_id: str = None, defer: Optional[bool] = None) -> dict:
+    """
+    [新增] 保存生成图的异步版本，返回值与 save_generated_image 相同
+    defer: 是否写后回写 (立即返回 URL)，默认取 settings.STORAGE_WRITE_BEHIND
+    """
+    info = await run_io(new_generated_file, prefix, ext, project_id)
+    if settings.STORAGE_WRITE_BEHIND if defer is None else defer:
+        await write_behind.submit(image_bytes, Path(info["path"]))
+        logger.info(f"💾 Queued generated image: {info['filename']}")
+    else:
+        digest = await run_io(_store_bytes, image_bytes, Path(info["path"]))
+        _on_stored(Path(info["path"]), digest)
+        logger.info(f"💾 Saved generated image: {info['filename']}")
+    return info
+
+async def save_generated_upload(file: UploadFile, prefix: str = "gen", ext: str = "png", project_id: str = None) -> dict:
+    """[新增] 把前端上传的生成图流式存入生成目录 (同 save_upload_file，受 generations 目录的大小上限约束)"""
+    tmp, digest, _ = await spool_upload(file, upload_limit("generations"))
+    try:
+        digest = await run_io(asset_index.normalize_file, tmp) or digest
+        info = await run_io(new_generated_file, prefix, ext, project_id)
+        await run_io(cas_store.put_temp, tmp, digest, Path(info["path"]))
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    _on_stored(Path(info["path"]), digest)
+    logger.info(f"💾 Saved generated image: {info['filename']}")
+    return info
+
+async def import_generated_file_async(src_path: str, prefix: str = "gen", project_id: str = None) -> dict:
+    """[新增] import_generated_file 的异步版本"""
+    info = await run_io(import_generated_file, src_path, prefix=prefix, project_id=project_id)
+    _on_stored(Path(info["path"]))
+    return info
+
+# --- 4. [新增] 工具: 把 /files/... URL 或 workspace 路径解析为本地文件 ---
+def resolve_workspace_path(url_or_path: str) -> Optional[Path]:
+    """
+    支持:
+    - http://host:8020/files/{project_id}/inputs/xxx.png
+    - /files/{project_id}/inputs/xxx.png
+    - workspace 目录内的本地绝对路径
+    - blob://<sha256> (前端以二进制上传的任务输入)
+    文件不存在或不在 workspace 内时返回 None
+    """
+    if not url_or_path or url_or_path.startswith("data:"):
+        return None
+    if is_blob_ref(url_or_path):
+        return blobs.path_of(url_or_path)
+
+    path_str = url_or_path
+    if path_str.startswith("http"):
+        path_str = unquote(urlparse(path_str).path)
+        if not path_str.startswith("/files/"):
+            return None
+
+    if path_str.startswith("/files/"):
+        rel = path_str[len("/files/"):]
+        # [新增] 分片目录中的文件优先按分片位置查找，旧的扁平位置兼容未迁移的项目
+        sharded = sharded_rel(rel)
+        path = WORKSPACE_DIR / rel
+        if sharded and (WORKSPACE_DIR / sharded).is_file():
+            path = WORKSPACE_DIR / sharded
+    else:
+        path = Path(path_str)
+
+    try:
+        path = path.resolve()
+        rel_path = path.relative_to(WORKSPACE_DIR.resolve())
+    except (ValueError, OSError):
+        return None
+    if not path.is_file() and len(rel_path.parts) > 1:
+        # [Fix] 已被回收但仍被引用的文件 (如任务输入): 从回收站放回 (asset_gc 依赖本模块，此处延迟导入)
+        from app.utils.asset_gc import collector as gc_collector
+        restored = gc_collector.restore(rel_path.parts[0], public_rel(Path(*rel_path.parts[1:]).as_posix()))
+        if restored is not None:
+            return restored
+    return path if path.is_file() else None
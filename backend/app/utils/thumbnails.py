@@ -0,0 +1,233 @@
+"""
+backend/app/utils/thumbnails.py
+画布素材的多分辨率缩略图 (Mip 金字塔)
+- 素材入库时在进程池中生成 WebP 缩略图 (默认 256 / 512 / 1024 / 2048 px，只生成小于原图的级别)
+- 缓存位置: {项目}/.thumbs/{子目录}/{文件名}/{尺寸}.webp + manifest.json
+- 画布按缩放级别请求 GET /api/thumbs/{project_id}/{sub_dir}/{filename}?size=N，返回不小于 N 的最小级别
+  (请求尺寸超过最大级别时返回原图)
+- 未预生成的素材 (如进程池中保存的抠图结果) 在第一次请求时生成
+- 进程池中生成时按 TILE_MAX_PIXELS 放宽 PIL 的像素上限 (超大图正是最需要缩略图的素材)，
+  解码后先用 reduce() 整数倍缩小，再做 LANCZOS 重采样
+- 生成失败 (无法解码的格式等) 也写入 manifest 并记录源文件签名，源文件变化前不再重试；
+  失败时只有已知原图不大于请求尺寸才返回原图，否则报错 (ThumbnailUnavailable)，不会把超大原图当缩略图下发
+"""
+import os
+import json
+import asyncio
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from config import settings
+from app.utils.pixel_limit import raised_pixel_limit
+
+logger = logging.getLogger("backend.thumbnails")
+
+THUMBS_DIR_NAME = ".thumbs"
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tif", ".tiff", ".psd"}
+MANIFEST = "manifest.json"
+WEBP_QUALITY = 80
+ORIENTATION = 0x0112
+# EXIF 方向 -> 转正所需的变换 (同 ImageOps.exif_transpose)
+TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# reduce() 之后至少保留最大级别的倍数，留给 LANCZOS 做高质量重采样
+REDUCE_MARGIN = 2
+# reduce() 直接支持的模式，其他模式先转换
+REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA", "I", "F")
+
+
+class ThumbnailUnavailable(Exception):
+    """无法生成缩略图，且原图大于请求尺寸 (不能用原图代替)"""
+
+
+def _save_atomic(image: Image.Image, path: Path, **params):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    image.save(tmp, **params)
+    os.replace(tmp, path)
+
+
+def _reduced(im: Image.Image, target: int) -> Image.Image:
+    """按整数倍缩小到不小于 target * REDUCE_MARGIN (只做块平均，比完整重采样便宜得多)，并转为 RGB / RGBA"""
+    has_alpha = im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info)
+    image = im if im.mode in REDUCIBLE_MODES else im.convert("RGBA" if has_alpha else "RGB")
+    factor = max(image.size) // (target * REDUCE_MARGIN)
+    if factor > 1:
+        image = image.reduce(factor)
+    return image.convert("RGBA" if has_alpha else "RGB")
+
+
+def build_pyramid(src: str, out_dir: str, sizes: Iterable[int],
+                  max_pixels: Optional[int] = None) -> Dict[str, Any]:
+    """
+    [进程池] 生成一张图片的全部缩略图级别并写入 manifest，返回 manifest 内容
+    先 reduce() 到最大级别的 REDUCE_MARGIN 倍以内，再从大到小逐级缩小 (每级以上一级为输入)
+    max_pixels 为打开原图时的像素上限 (见 pixel_limit)
+    """
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    with raised_pixel_limit(max_pixels), Image.open(src) as im:
+        width, height = im.size
+        orientation = im.getexif().get(ORIENTATION, 1)
+        if orientation in (5, 6, 7, 8):  # EXIF 方向为旋转 90° 时宽高互换
+            width, height = height, width
+        # JPEG 可在解码阶段直接降采样，超大图省去大部分解码开销
+        im.draft("RGB", (max(sizes), max(sizes)))
+        image = _reduced(im, max(sizes))
+        # 在缩小后的图上转正 (代价与原图尺寸无关)
+        if orientation in TRANSPOSE:
+            image = image.transpose(TRANSPOSE[orientation])
+
+        levels: List[int] = []
+        for size in sorted(sizes, reverse=True):
+            if size >= max(width, height):
+                continue
+            image.thumbnail((size, size), Image.LANCZOS, reducing_gap=3.0)
+            _save_atomic(image, out / f"{size}.webp", format="WEBP", quality=WEBP_QUALITY, method=4)
+            levels.append(size)
+
+    manifest = {"width": width, "height": height, "levels": sorted(levels)}
+    tmp = out / f".{MANIFEST}.{os.getpid()}.tmp"
+    tmp.write_text(json.dumps(manifest), encoding="utf-8")
+    os.replace(tmp, out / MANIFEST)
+    return manifest
+
+
+def _signature(path: Path) -> Dict[str, int]:
+    st = path.stat()
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def _source_size(src: str) -> Tuple[Optional[int], Optional[int]]:
+    """只读文件头获取原图尺寸；无法识别 (或超出像素上限) 时返回 (None, None)"""
+    try:
+        with Image.open(src) as im:
+            return im.size
+    except Exception:
+        return None, None
+
+
+def build_or_mark_failed(src: str, out_dir: str, sizes: Iterable[int],
+                         max_pixels: Optional[int] = None) -> Dict[str, Any]:
+    """
+    [进程池] build_pyramid 的包装：失败时写入失败 manifest (没有任何级别，附带错误、已知的原图尺寸与源文件签名)
+    并返回它；源文件本身不存在时直接抛出，不留下记录
+    """
+    try:
+        return build_pyramid(src, out_dir, sizes, max_pixels)
+    except Exception as e:
+        signature = _signature(Path(src))
+        width, height = _source_size(src)
+        manifest = {"width": width, "height": height, "levels": [], "error": str(e) or type(e).__name__,
+                    "source": signature}
+        out = Path(out_dir)
+        out.mkdir(parents=True, exist_ok=True)
+        tmp = out / f".{MANIFEST}.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(manifest), encoding="utf-8")
+        os.replace(tmp, out / MANIFEST)
+        return manifest
+
+
+class MipCache:
+    """缩略图缓存与生成调度 (单例见模块底部的 mips)"""
+
+    def __init__(self, workspace: Path, sizes: Iterable[int]):
+        self.workspace = workspace.resolve()
+        self.sizes = sorted(sizes)
+        self._pool = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._tasks: set = set()          # schedule() 创建的后台任务 (保留引用，避免被垃圾回收)
+
+    def bind(self, process_pool):
+        """绑定进程池 (在 lifespan 中调用)；未绑定时退回线程执行"""
+        self._pool = process_pool
+
+    def is_image(self, path: Path) -> bool:
+        return path.suffix.lower() in IMAGE_SUFFIXES
+
+    def cache_dir(self, src: Path) -> Path:
+        """{项目}/.thumbs/{项目内相对路径}"""
+        rel = src.resolve().relative_to(self.workspace)
+        return self.workspace / rel.parts[0] / THUMBS_DIR_NAME / Path(*rel.parts[1:])
+
+    def _read_manifest(self, directory: Path, src: Path) -> Optional[Dict[str, Any]]:
+        """读取缓存的 manifest；失败记录只在源文件未变化时有效"""
+        try:
+            manifest = json.loads((directory / MANIFEST).read_text(encoding="utf-8"))
+            if manifest.get("error") and manifest.get("source") != _signature(src):
+                return None
+            return manifest
+        except (OSError, ValueError):
+            return None
+
+    async def ensure(self, src: Path) -> Dict[str, Any]:
+        """确保缩略图已生成 (同一文件并发请求只生成一次)，返回 manifest (失败时 levels 为空并带 error)"""
+        directory = self.cache_dir(src)
+        manifest = await asyncio.to_thread(self._read_manifest, directory, src)
+        if manifest is not None:
+            return manifest
+
+        key = str(directory)
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if self._pool is not None:
+                future = loop.run_in_executor(self._pool, build_or_mark_failed, str(src), key, self.sizes,
+                                              settings.TILE_MAX_PIXELS)
+            else:
+                # 线程中不能修改进程全局的像素上限，超大图会生成失败
+                future = asyncio.ensure_future(asyncio.to_thread(build_or_mark_failed, str(src), key, self.sizes))
+            self._inflight[key] = future
+
+            def _done(f):
+                self._inflight.pop(key, None)
+                if not f.cancelled() and f.exception() is None and f.result().get("error"):
+                    logger.warning(f"⚠️ Thumbnail generation failed for {src.name}: {f.result()['error']}")
+
+            future.add_done_callback(_done)
+        return await asyncio.shield(future)
+
+    def schedule(self, src: Path):
+        """入库后在后台预生成 (失败会记录在 manifest 中，源文件变化前不再重试)"""
+        if not self.is_image(src):
+            return
+
+        async def _build():
+            try:
+                await self.ensure(src)
+            except Exception as e:
+                logger.warning(f"⚠️ Thumbnail generation failed for {src.name}: {e}")
+
+        task = asyncio.create_task(_build())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def variant(self, src: Path, size: int) -> Path:
+        """
+        返回不小于 size 的最小缩略图；没有合适级别 (请求超过最大级别或原图本身较小) 时返回原图
+        生成失败且原图大于 size (或尺寸未知) 时抛出 ThumbnailUnavailable
+        """
+        if not self.is_image(src):
+            return src
+        manifest = await self.ensure(src)
+        for level in manifest["levels"]:
+            if level >= size:
+                return self.cache_dir(src) / f"{level}.webp"
+        if manifest.get("error"):
+            width, height = manifest.get("width"), manifest.get("height")
+            if width is None or height is None or max(width, height) > size:
+                raise ThumbnailUnavailable(manifest["error"])
+        return src
+
+
+# 全局单例
+mips = MipCache(settings.WORKSPACE_DIR, settings.THUMBNAIL_SIZES)
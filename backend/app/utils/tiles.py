@@ -0,0 +1,327 @@
+"""
+backend/app/utils/tiles.py
+超大图 (高倍放大 / 拼接全景等) 的 Deep Zoom (DZI) 瓦片服务
+- 第一次请求时在进程池中切出整个瓦片金字塔 (level 0 = 1x1 ... max_level = 原图)
+- 所有瓦片写入一个紧凑的 pack 文件，配合定长二进制索引 (按 mmap 随机读取)，不产生成千上万个小文件
+- 缓存位置: {项目}/.tiles/{子目录}/{文件名}/ (tiles.pack + tiles.idx + info.json)
+- 切片失败 (无法解码 / 超出像素上限) 写入 failed.json 并记录源文件签名 (大小 + 修改时间)，
+  源文件变化前直接报错 (TileBuildFailed)，不会每个请求都在进程池中重新完整解码
+- 只在进程池中按 TILE_MAX_PIXELS 放宽 PIL 的像素上限 (见 pixel_limit)；未绑定进程池时保持默认上限
+- 热点瓦片放在按字节数限制的内存 LRU 中
+- 打开的 pack 只在事件循环线程中登记 / 淘汰；读取在线程中进行，被淘汰的 pack 等最后一个读取结束后才关闭
+- 接口遵循 DZI 约定，前端只请求视口内的瓦片:
+    GET /api/tiles/{project_id}/{sub_dir}/{filename}.dzi
+    GET /api/tiles/{project_id}/{sub_dir}/{filename}_files/{level}/{col}_{row}.webp
+"""
+import io
+import os
+import json
+import math
+import mmap
+import struct
+import asyncio
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from config import settings
+from app.utils.pixel_limit import raised_pixel_limit
+
+logger = logging.getLogger("backend.tiles")
+
+TILES_DIR_NAME = ".tiles"
+TILE_FORMAT = "webp"
+TILE_QUALITY = 80
+INFO = "info.json"
+PACK = "tiles.pack"
+INDEX = "tiles.idx"
+FAILED = "failed.json"
+# 索引文件: 头部 [魔数 4B][版本 uint32][瓦片数 uint32]，之后每个瓦片 [偏移 uint64][长度 uint32]
+INDEX_MAGIC = b"TIDX"
+INDEX_HEADER = struct.Struct("<4sII")
+INDEX_ENTRY = struct.Struct("<QI")
+
+
+class TileBuildFailed(Exception):
+    """切片失败 (已记录，源文件变化前不再重试)"""
+
+
+def level_layout(width: int, height: int, tile_size: int) -> List[Dict[str, int]]:
+    """DZI 各级尺寸与瓦片行列数 (下标即 level)"""
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    layout = []
+    offset = 0
+    for level in range(max_level + 1):
+        scale = 2 ** (max_level - level)
+        w, h = math.ceil(width / scale), math.ceil(height / scale)
+        cols, rows = math.ceil(w / tile_size), math.ceil(h / tile_size)
+        layout.append({"width": w, "height": h, "cols": cols, "rows": rows, "offset": offset})
+        offset += cols * rows
+    return layout
+
+
+def _signature(path: Path) -> Dict[str, int]:
+    st = path.stat()
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def build_tiles(src: str, out_dir: str, tile_size: int, max_pixels: Optional[int] = None) -> Dict[str, Any]:
+    """
+    [进程池] 切出整个瓦片金字塔并写入 pack + 索引，最后写 info.json (存在即表示完整)
+    从原图开始逐级 reduce(2)，内存中同时只保留一级
+    max_pixels 为打开原图时的像素上限 (只能在进程池中放宽，见 pixel_limit)
+    """
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    suffix = f".{os.getpid()}.tmp"
+
+    with raised_pixel_limit(max_pixels), Image.open(src) as im:
+        image = ImageOps.exif_transpose(im)
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    width, height = image.size
+    layout = level_layout(width, height, tile_size)
+    total = layout[-1]["offset"] + layout[-1]["cols"] * layout[-1]["rows"]
+    entries: List[Tuple[int, int]] = [(0, 0)] * total
+
+    pack_tmp = out / (PACK + suffix)
+    with open(pack_tmp, "wb") as pack:
+        for level in range(len(layout) - 1, -1, -1):
+            spec = layout[level]
+            for row in range(spec["rows"]):
+                for col in range(spec["cols"]):
+                    box = (col * tile_size, row * tile_size,
+                           min((col + 1) * tile_size, spec["width"]), min((row + 1) * tile_size, spec["height"]))
+                    buf = io.BytesIO()
+                    image.crop(box).save(buf, format="WEBP", quality=TILE_QUALITY, method=2)
+                    data = buf.getvalue()
+                    entries[spec["offset"] + row * spec["cols"] + col] = (pack.tell(), len(data))
+                    pack.write(data)
+            if level:
+                image = image.reduce(2)
+
+    index_tmp = out / (INDEX + suffix)
+    with open(index_tmp, "wb") as index:
+        index.write(INDEX_HEADER.pack(INDEX_MAGIC, 1, total))
+        for offset, length in entries:
+            index.write(INDEX_ENTRY.pack(offset, length))
+
+    info = {"width": width, "height": height, "tile_size": tile_size, "format": TILE_FORMAT, "tiles": total}
+    os.replace(pack_tmp, out / PACK)
+    os.replace(index_tmp, out / INDEX)
+    info_tmp = out / (INFO + suffix)
+    info_tmp.write_text(json.dumps(info), encoding="utf-8")
+    os.replace(info_tmp, out / INFO)
+    return info
+
+
+def build_or_mark_failed(src: str, out_dir: str, tile_size: int, max_pixels: Optional[int] = None) -> Dict[str, Any]:
+    """
+    [进程池] build_tiles 的包装：失败时写入 failed.json (错误 + 源文件签名) 并返回 {"error": ...}
+    源文件本身不存在时直接抛出，不留下记录
+    """
+    try:
+        return build_tiles(src, out_dir, tile_size, max_pixels)
+    except Exception as e:
+        record = {"error": str(e) or type(e).__name__, "source": _signature(Path(src))}
+        out = Path(out_dir)
+        out.mkdir(parents=True, exist_ok=True)
+        tmp = out / f".{FAILED}.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(record), encoding="utf-8")
+        os.replace(tmp, out / FAILED)
+        return record
+
+
+def read_failure(directory: Path, src: Path) -> Optional[str]:
+    """[线程] 源文件未变化时返回记录的切片错误，否则返回 None"""
+    try:
+        record = json.loads((directory / FAILED).read_text(encoding="utf-8"))
+        return record["error"] if record.get("source") == _signature(src) else None
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class TilePack:
+    """
+    一个已切好的瓦片金字塔 (pack 与索引均为只读 mmap)
+    users / evicted 只在事件循环线程中读写：有读取进行中时淘汰只做标记，最后一个读取结束后再关闭
+    """
+
+    def __init__(self, directory: Path):
+        self.users = 0
+        self.evicted = False
+        self.info = json.loads((directory / INFO).read_text(encoding="utf-8"))
+        self.layout = level_layout(self.info["width"], self.info["height"], self.info["tile_size"])
+        with open(directory / PACK, "rb") as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(directory / INDEX, "rb") as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, count = INDEX_HEADER.unpack_from(self._index, 0)
+        if magic != INDEX_MAGIC or count != self.info["tiles"]:
+            self.close()
+            raise ValueError(f"Corrupt tile index in {directory}")
+
+    @property
+    def max_level(self) -> int:
+        return len(self.layout) - 1
+
+    def tile(self, level: int, col: int, row: int) -> Optional[bytes]:
+        if not 0 <= level <= self.max_level:
+            return None
+        spec = self.layout[level]
+        if not (0 <= col < spec["cols"] and 0 <= row < spec["rows"]):
+            return None
+        ordinal = spec["offset"] + row * spec["cols"] + col
+        offset, length = INDEX_ENTRY.unpack_from(self._index, INDEX_HEADER.size + ordinal * INDEX_ENTRY.size)
+        return self._pack[offset:offset + length]
+
+    def dzi(self) -> str:
+        info = self.info
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{info["tile_size"]}" '
+            f'Overlap="0" Format="{info["format"]}"><Size Width="{info["width"]}" Height="{info["height"]}"/></Image>'
+        )
+
+    def close(self):
+        self._pack.close()
+        self._index.close()
+
+    def retire(self):
+        """[事件循环线程] 从打开列表中淘汰：没有读取进行中时立即关闭，否则由最后一个读取者关闭"""
+        self.evicted = True
+        if self.users == 0:
+            self.close()
+
+
+class TileService:
+    """瓦片生成调度、打开的 pack 与热点瓦片缓存 (单例见模块底部的 tiles)"""
+
+    def __init__(self, workspace: Path, tile_size: int, cache_bytes: int, max_open: int):
+        self.workspace = workspace.resolve()
+        self.tile_size = tile_size
+        self.cache_bytes = cache_bytes
+        self.max_open = max_open
+        self._pool = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._packs: "OrderedDict[str, TilePack]" = OrderedDict()
+        self._cache: "OrderedDict[Tuple[str, int, int, int], bytes]" = OrderedDict()
+        self._cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, process_pool):
+        """绑定进程池 (在 lifespan 中调用)；未绑定时退回线程执行"""
+        self._pool = process_pool
+
+    def cache_dir(self, src: Path) -> Path:
+        """{项目}/.tiles/{项目内相对路径}"""
+        rel = src.resolve().relative_to(self.workspace)
+        return self.workspace / rel.parts[0] / TILES_DIR_NAME / Path(*rel.parts[1:])
+
+    @staticmethod
+    def _load(directory: Path) -> Optional[TilePack]:
+        """[线程] 打开已切好的 pack (尚未切好时返回 None)"""
+        if not (directory / INFO).exists():
+            return None
+        return TilePack(directory)
+
+    async def _open(self, directory: Path) -> Optional[TilePack]:
+        """打开的 pack 表只在事件循环线程中修改，文件打开与 mmap 在线程中进行"""
+        key = str(directory)
+        pack = self._packs.get(key)
+        if pack is not None:
+            self._packs.move_to_end(key)
+            return pack
+        pack = await asyncio.to_thread(self._load, directory)
+        if pack is None:
+            return None
+        existing = self._packs.get(key)
+        if existing is not None:
+            # 等待期间其他请求已经打开了同一个 pack
+            pack.close()
+            return existing
+        self._packs[key] = pack
+        while len(self._packs) > self.max_open:
+            self._packs.popitem(last=False)[1].retire()
+        return pack
+
+    async def ensure(self, src: Path) -> TilePack:
+        """确保瓦片已切好 (同一文件并发请求只切一次)，返回打开的 pack；切片失败时抛出 TileBuildFailed"""
+        directory = self.cache_dir(src)
+        pack = await self._open(directory)
+        if pack is not None:
+            return pack
+        error = await asyncio.to_thread(read_failure, directory, src)
+        if error is not None:
+            raise TileBuildFailed(error)
+
+        key = str(directory)
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if self._pool is not None:
+                future = loop.run_in_executor(self._pool, build_or_mark_failed, str(src), key, self.tile_size,
+                                              settings.TILE_MAX_PIXELS)
+            else:
+                # 线程中不能修改进程全局的像素上限，超大图会切片失败
+                future = asyncio.ensure_future(asyncio.to_thread(build_or_mark_failed, str(src), key, self.tile_size))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            logger.info(f"🧩 Building deep-zoom tiles for {src.name}")
+        result = await asyncio.shield(future)
+        if result.get("error"):
+            raise TileBuildFailed(result["error"])
+        return await self._open(directory)
+
+    async def dzi(self, src: Path) -> str:
+        return (await self.ensure(src)).dzi()
+
+    async def tile(self, src: Path, level: int, col: int, row: int) -> Optional[bytes]:
+        key = (str(src), level, col, row)
+        data = self._cache.get(key)
+        if data is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        pack = await self.ensure(src)
+        pack.users += 1
+        try:
+            data = await asyncio.to_thread(pack.tile, level, col, row)
+        finally:
+            pack.users -= 1
+            if pack.evicted and pack.users == 0:
+                pack.close()
+        if data is not None:
+            self._cache[key] = data
+            self._cached_bytes += len(data)
+            while self._cached_bytes > self.cache_bytes and self._cache:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+        return data
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "open_packs": len(self._packs),
+            "cached_tiles": len(self._cache),
+            "cached_bytes": self._cached_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+# 全局单例
+tiles = TileService(
+    settings.WORKSPACE_DIR,
+    tile_size=settings.TILE_SIZE,
+    cache_bytes=settings.TILE_CACHE_MB * 1024 * 1024,
+    max_open=settings.TILE_MAX_OPEN_PACKS,
+)
@@ -0,0 +1,218 @@
+"""
+backend/app/utils/variants.py
+素材按需转码 (格式 / 尺寸 / 质量) 与副本磁盘缓存
+- 请求: GET /files/{project}/{path}?format=webp&max=1024&q=80 (参数均可选，至少提供一个)
+  画布用 WebP、Photoshop 导入用 PNG、视觉模型用小尺寸 JPEG，同一素材按需生成
+  未指定 format 时沿用源格式；源格式不能作为输出 (psd / gif / bmp / tif 等) 时输出 PNG
+- 缓存键在转码前即可算出，条件请求命中 ETag 时直接返回 304，不触发转码
+- 在进程池中转码；同一副本的并发请求只转码一次 (single-flight)
+  进程池中按 TILE_MAX_PIXELS 放宽 PIL 的像素上限，缩小时先 draft / reduce() 再重采样，内存占用有界
+- 缓存键 = 源文件内容哈希 (内容寻址存储中的 SHA-256，未纳入时退回 inode + 大小 + 修改时间) + 参数
+- 缓存目录 CACHE_DIR/variants 按总字节数限制，超出时淘汰最久未访问的副本
+"""
+import os
+import hashlib
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from config import settings
+from app.utils.cas import store as cas_store
+from app.utils.pixel_limit import raised_pixel_limit
+from app.utils.thumbnails import ORIENTATION, REDUCIBLE_MODES, TRANSPOSE
+
+logger = logging.getLogger("backend.variants")
+
+FORMATS = {"webp": "WEBP", "png": "PNG", "jpeg": "JPEG", "jpg": "JPEG"}
+MEDIA_TYPES = {"WEBP": "image/webp", "PNG": "image/png", "JPEG": "image/jpeg"}
+VARIANT_PARAMS = ("format", "max", "q")
+# 未指定 format 且源格式不能作为输出时使用的格式 (无损且保留透明)
+FALLBACK_FORMAT = "png"
+MAX_SIDE_LIMIT = 16384
+DEFAULT_QUALITY = 80
+
+
+class VariantParamError(ValueError):
+    """转码参数不合法"""
+
+
+def parse_params(query: Dict[str, str], source_suffix: str) -> Optional[Tuple[str, int, int]]:
+    """从查询参数解析 (格式, 最长边, 质量)；没有任何转码参数时返回 None"""
+    if not any(k in query for k in VARIANT_PARAMS):
+        return None
+    fmt = query.get("format")
+    if not fmt:
+        fmt = source_suffix.lstrip(".").lower()
+        if fmt not in FORMATS:
+            fmt = FALLBACK_FORMAT
+    if fmt not in FORMATS:
+        raise VariantParamError(f"Unsupported format: {fmt}")
+    try:
+        max_side = int(query.get("max") or 0)
+        quality = int(query.get("q") or DEFAULT_QUALITY)
+    except ValueError:
+        raise VariantParamError("max and q must be integers")
+    if not 0 <= max_side <= MAX_SIDE_LIMIT or not 1 <= quality <= 100:
+        raise VariantParamError(f"max must be 0-{MAX_SIDE_LIMIT} and q must be 1-100")
+    return FORMATS[fmt], max_side, quality
+
+
+def transcode(src: str, dest: str, fmt: str, max_side: int, quality: int,
+              max_pixels: Optional[int] = None) -> int:
+    """[进程池] 转码一张图片并原子写入 dest，返回字节数；max_pixels 为打开原图时的像素上限 (见 pixel_limit)"""
+    with raised_pixel_limit(max_pixels), Image.open(src) as im:
+        if max_side:
+            im.draft("RGB", (max_side, max_side))
+        factor = max(im.size) // (max_side * 2) if max_side else 0
+        if factor > 1 and im.mode in REDUCIBLE_MODES:
+            # 先整数倍缩小 (块平均)，在缩小后的图上转正
+            orientation = im.getexif().get(ORIENTATION, 1)
+            image = im.reduce(factor)
+            if orientation in TRANSPOSE:
+                image = image.transpose(TRANSPOSE[orientation])
+        else:
+            image = ImageOps.exif_transpose(im)
+        if max_side and max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=3.0)
+
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+        if fmt == "JPEG":
+            if has_alpha:
+                # JPEG 不支持透明，铺白底
+                rgba = image.convert("RGBA")
+                background = Image.new("RGB", rgba.size, (255, 255, 255))
+                background.paste(rgba, mask=rgba.getchannel("A"))
+                image = background
+            else:
+                image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA" if has_alpha else "RGB")
+
+        params: Dict[str, Any] = {"format": fmt}
+        if fmt == "JPEG":
+            params.update(quality=quality, optimize=True, progressive=True)
+        elif fmt == "WEBP":
+            params.update(quality=quality, method=4)
+        else:
+            params.update(optimize=quality < 100, compress_level=6)
+
+        out = Path(dest)
+        tmp = out.with_name(f".{out.name}.{os.getpid()}.tmp")
+        image.save(tmp, **params)
+    os.replace(tmp, out)
+    return out.stat().st_size
+
+
+class VariantCache:
+    """转码副本缓存 (单例见模块底部的 cache)"""
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._pool = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._total: Optional[int] = None
+        self._prune_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, process_pool):
+        """绑定进程池 (在 lifespan 中调用)；未绑定时退回线程执行"""
+        self._pool = process_pool
+
+    def _key(self, src: Path, fmt: str, max_side: int, quality: int) -> str:
+        source = cas_store.hash_of(src)
+        if source is None:
+            st = src.stat()
+            source = f"{src.resolve()}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+        return hashlib.sha256(f"{source}|{fmt}|{max_side}|{quality}".encode()).hexdigest()
+
+    async def key_for(self, src: Path, fmt: str, max_side: int, quality: int) -> str:
+        """只计算缓存键 (用于 ETag 协商)，不转码"""
+        return await asyncio.to_thread(self._key, src, fmt, max_side, quality)
+
+    def _lookup(self, src: Path, fmt: str, max_side: int, quality: int,
+                key: Optional[str] = None) -> Tuple[str, Path, bool]:
+        key = key or self._key(src, fmt, max_side, quality)
+        path = self.directory / key[:2] / f"{key}.{fmt.lower()}"
+        if path.exists():
+            os.utime(path)  # 记录访问时间，供 LRU 淘汰
+            return key, path, True
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return key, path, False
+
+    def _files(self):
+        return [f for f in self.directory.glob("*/*") if not f.name.startswith(".")]
+
+    def _prune(self, added: int):
+        """超出容量时按最近访问时间淘汰"""
+        with self._prune_lock:
+            self._prune_locked(added)
+
+    def _prune_locked(self, added: int):
+        if self._total is None:
+            self._total = sum(f.stat().st_size for f in self._files())
+        else:
+            self._total += added
+        if self._total <= self.max_bytes:
+            return
+        entries = []
+        for f in self._files():
+            try:
+                st = f.stat()
+                entries.append((st.st_mtime, st.st_size, f))
+            except OSError:
+                pass
+        entries.sort()
+        for _, size, f in entries:
+            if self._total <= self.max_bytes * 0.9:
+                break
+            f.unlink(missing_ok=True)
+            self._total -= size
+
+    async def get(self, src: Path, fmt: str, max_side: int, quality: int,
+                  key: Optional[str] = None) -> Tuple[str, Path]:
+        """返回 (缓存键, 副本路径)，不存在时转码生成；key 为 key_for() 已算出的缓存键"""
+        key, path, hit = await asyncio.to_thread(self._lookup, src, fmt, max_side, quality, key)
+        if hit:
+            self.hits += 1
+            return key, path
+
+        self.misses += 1
+        future = self._inflight.get(key)
+        if future is None:
+            args = (transcode, str(src), str(path), fmt, max_side, quality)
+            loop = asyncio.get_running_loop()
+            if self._pool is not None:
+                future = loop.run_in_executor(self._pool, *args, settings.TILE_MAX_PIXELS)
+            else:
+                # 线程中不能修改进程全局的像素上限，超大图转码失败 (415)
+                future = asyncio.ensure_future(asyncio.to_thread(*args))
+            self._inflight[key] = future
+
+            def _done(fut: asyncio.Future):
+                self._inflight.pop(key, None)
+                if not fut.cancelled() and fut.exception() is None:
+                    loop.run_in_executor(None, self._prune, fut.result())
+
+            future.add_done_callback(_done)
+        await asyncio.shield(future)
+        return key, path
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "bytes": self._total,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+# 全局单例
+cache = VariantCache(settings.CACHE_DIR / "variants", max_bytes=settings.VARIANT_CACHE_MB * 1024 * 1024)
@@ -0,0 +1,182 @@
+"""
+backend/app/utils/workflow_registry.py
+工作流模板注册表：服务端缓存 workspace/workflow 下的工作流
+- 每个文件只解析一次，按 mtime 失效重载
+- 预先索引参数槽位 (图片加载、提示词、种子、输出节点)
+- 客户端只需提交 {template, params}，由服务端把参数应用到缓存副本上
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+from config import settings
+
+logger = logging.getLogger("backend.workflow_registry")
+
+WORKFLOWS_DIR = settings.WORKSPACE_DIR / "workflow"
+
+# 参数槽位识别规则
+PROMPT_FIELDS = ("text", "prompt", "positive", "negative", "text_g", "text_l")
+SEED_FIELDS = ("seed", "noise_seed")
+OUTPUT_CLASS_KEYWORDS = ("SaveImage", "PreviewImage", "ShowText", "SaveText", "PreviewText")
+
+
+class WorkflowTemplate:
+    """一个已解析的工作流模板 (只读，不要直接修改 graph)"""
+
+    def __init__(self, name: str, mtime: float, content: Any):
+        self.name = name
+        self.mtime = mtime
+        self.content = content          # 文件原始内容 (供 GET /api/workflows/{name} 返回)
+        self.graph = self._extract_graph(content)
+        self.slots: Dict[str, Dict[str, str]] = {}   # 槽位名 -> {"node_id", "field", "kind"}
+        self.outputs: List[str] = []                 # 输出节点 ID
+        self._index()
+
+    @staticmethod
+    def _extract_graph(content: Any) -> Dict[str, Any]:
+        """兼容两种保存格式：纯 API 格式，或前端包装格式 {"json": "...", "mappings": [...]}"""
+        if isinstance(content, dict) and "json" in content:
+            raw = content["json"]
+            return json.loads(raw) if isinstance(raw, str) else raw
+        if isinstance(content, dict) and isinstance(content.get("workflow"), dict):
+            return content["workflow"]
+        return {k: v for k, v in content.items() if isinstance(v, dict) and "class_type" in v}
+
+    def _add_slot(self, name: str, node_id: str, field: str, kind: str):
+        if name not in self.slots:
+            self.slots[name] = {"node_id": node_id, "field": field, "kind": kind}
+
+    def _index(self):
+        counters = {"image": 0, "prompt": 0, "seed": 0}
+
+        # 1. 前端配置的命名映射优先 (与 WorkflowConfigModal 的 mappings 一致)
+        if isinstance(self.content, dict):
+            for m in self.content.get("mappings") or []:
+                slot_name = "image" if m.get("slot_name") == "base_image" else m.get("slot_name")
+                if slot_name and m.get("node_id") and m.get("field_name"):
+                    self._add_slot(slot_name, str(m["node_id"]), m["field_name"], "mapping")
+            for n in self.content.get("outputNodes") or []:
+                if n.get("nodeId"):
+                    self.outputs.append(str(n["nodeId"]))
+
+        # 2. 按节点 ID 顺序自动识别
+        def _order(node_id: str):
+            return (0, int(node_id)) if node_id.isdigit() else (1, node_id)
+
+        auto_outputs = []
+        for node_id in sorted(self.graph, key=_order):
+            node = self.graph[node_id]
+            class_type = str(node.get("class_type", ""))
+            inputs = node.get("inputs") or {}
+            title = (node.get("_meta") or {}).get("title")
+
+            for field, value in inputs.items():
+                kind = None
+                # 连线输入 (["节点ID", 输出序号]) 不是参数
+                if isinstance(value, list):
+                    continue
+                if "LoadImage" in class_type and field == "image":
+                    kind = "image"
+                elif field in PROMPT_FIELDS and isinstance(value, str):
+                    kind = "prompt"
+                elif field in SEED_FIELDS and isinstance(value, int):
+                    kind = "seed"
+                if not kind:
+                    continue
+
+                counters[kind] += 1
+                alias = kind if counters[kind] == 1 else f"{kind}_{counters[kind]}"
+                self._add_slot(alias, node_id, field, kind)
+                self._add_slot(f"{node_id}.{field}", node_id, field, kind)
+                if title:
+                    self._add_slot(title, node_id, field, kind)
+                    self._add_slot(f"{title}.{field}", node_id, field, kind)
+
+            if any(k in class_type for k in OUTPUT_CLASS_KEYWORDS):
+                auto_outputs.append(node_id)
+
+        if not self.outputs:
+            self.outputs = auto_outputs
+
+    def describe(self) -> Dict[str, Any]:
+        return {"name": self.name, "slots": self.slots, "outputs": self.outputs}
+
+    def compile(self, params: Dict[str, Any], extra_inputs: Optional[Dict[str, Dict[str, Any]]] = None) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+        """
+        把参数应用到模板上
+        extra_inputs: 额外的按节点 ID 指定的输入 (与旧版 "inputs" 字段同格式)
+        返回 (workflow, inputs):
+        - workflow: 模板的浅拷贝，被参数命中的节点单独复制，缓存本身不会被修改
+        - inputs: 与 pipe_b_comfyui 的 "inputs" 字段同格式，图片上传等预处理沿用原有流程
+        """
+        inputs: Dict[str, Dict[str, Any]] = {}
+        for key, value in (params or {}).items():
+            slot = self.slots.get(key)
+            if slot is None:
+                # 允许直接使用 "节点ID.字段" 指定未被索引的参数
+                node_id, _, field = key.partition(".")
+                if not field or node_id not in self.graph:
+                    raise KeyError(f"Unknown parameter '{key}' for workflow {self.name}")
+                slot = {"node_id": node_id, "field": field}
+            inputs.setdefault(slot["node_id"], {})[slot["field"]] = value
+
+        for node_id, fields in (extra_inputs or {}).items():
+            if node_id in self.graph:
+                inputs.setdefault(node_id, {}).update(fields)
+
+        workflow = dict(self.graph)
+        for node_id in inputs:
+            node = self.graph[node_id]
+            workflow[node_id] = {**node, "inputs": dict(node.get("inputs") or {})}
+        return workflow, inputs
+
+
+class WorkflowRegistry:
+    """工作流模板缓存 (全局单例见模块底部的 registry)"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._cache: Dict[str, WorkflowTemplate] = {}
+
+    def _path(self, name: str) -> Path:
+        path = (self.directory / name).resolve()
+        if path.parent != self.directory.resolve():
+            raise FileNotFoundError(f"Invalid workflow name: {name}")
+        return path
+
+    def list_names(self) -> List[str]:
+        return [f.name for f in self.directory.glob("*.json")]
+
+    def get(self, name: str) -> WorkflowTemplate:
+        """读取模板，文件 mtime 变化时自动重新解析"""
+        path = self._path(name)
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            self._cache.pop(name, None)
+            raise FileNotFoundError(f"Workflow not found: {name}")
+
+        template = self._cache.get(name)
+        if template is None or template.mtime != mtime:
+            content = json.loads(path.read_text(encoding="utf-8"))
+            template = WorkflowTemplate(name, mtime, content)
+            self._cache[name] = template
+            logger.info(f"📑 Workflow template loaded: {name} ({len(template.slots)} slots)")
+        return template
+
+    def save(self, name: str, content: Dict[str, Any]):
+        path = self._path(name)
+        path.write_text(json.dumps(content, indent=2, ensure_ascii=False), encoding="utf-8")
+        self._cache.pop(name, None)
+
+    def compile(self, name: str, params: Dict[str, Any], extra_inputs: Optional[Dict[str, Dict[str, Any]]] = None) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]], List[str]]:
+        """返回 (workflow, inputs, 默认输出节点列表)"""
+        template = self.get(name)
+        workflow, inputs = template.compile(params, extra_inputs)
+        return workflow, inputs, list(template.outputs)
+
+
+# 全局单例
+WORKFLOWS_DIR.mkdir(parents=True, exist_ok=True)
+registry = WorkflowRegistry(WORKFLOWS_DIR)
@@ -9,11 +9,40 @@ from pathlib import Path
 class Settings(BaseSettings):
     # ComfyUI 地址 (默认本地)
     COMFY_URL: str = "http://127.0.0.1:8188"
+
+    # [新增] ComfyUI 后端池 (多台 GPU 节点负载均衡)，为空时只使用 COMFY_URL
+    # 例: COMFY_URLS='["http://10.0.0.2:8188", "http://10.0.0.3:8188"]'
+    COMFY_URLS: list[str] = []
+    # 后端健康检查间隔 (秒)
+    COMFY_HEALTH_INTERVAL: float = 10.0
+    # 连续失败多少次后熔断该节点，以及熔断冷却时间 (秒)
+    COMFY_FAILURE_THRESHOLD: int = 3
+    COMFY_CIRCUIT_COOLDOWN: float = 30.0
+    # WebSocket 断开后，从 /history 找回结果的最长等待时间 (秒)
+    COMFY_RECOVERY_TIMEOUT: float = 600.0
+
+    # [新增] ComfyUI 输入图片传递方式: "auto" (本机/共享卷时直接放入 input 目录) 或 "upload" (总是 HTTP 上传)
+    COMFY_INPUT_MODE: str = "auto"
+    # 本机 ComfyUI 的 input 目录 (仅对 localhost 节点生效)
+    COMFY_INPUT_DIR: Optional[Path] = None
+    # 挂载了共享卷的远程节点: 节点地址 -> 该节点 input 目录在本机上的路径
+    COMFY_SHARED_INPUT_DIRS: dict[str, Path] = {}
     
     # OpenAI API Key (从环境变量或 .env 文件读取)
     OPENAI_API_KEY: Optional[str] = None
     GEMINI_API_KEY: Optional[str] = None
     GEMINI_LOCAL_URL: str = "http://127.0.0.1:8021"
+    # [新增] 8021 队列的会话亲和: 后续消息最多连续插队的次数 (之后先执行排在队首的其他任务)
+    GEMINI_LOCAL_MAX_AFFINITY: int = 3
+    # [新增] 外部后端熔断与健康探测 (见 app/utils/health.py；ComfyUI 节点使用上面的 COMFY_* 配置)
+    BREAKER_FAILURE_THRESHOLD: int = 3
+    BREAKER_COOLDOWN: float = 30.0
+    HEALTH_PROBE_INTERVAL: float = 15.0
+    # [新增] Gemini 客户端池大小 (按 API Key) 与专用线程池大小
+    GENAI_CLIENT_POOL_SIZE: int = 8
+    GENAI_EXECUTOR_WORKERS: int = 4
+    # Gemini 会话级图片 Part 缓存的总大小 (MB，所有会话共享)
+    GENAI_PART_CACHE_MB: int = 256
 
     # [新增] 服务基础地址 (用于生成图片 URL, 结尾不带 /)
     SERVER_BASE_URL: str = "http://localhost:8020"
@@ -22,6 +51,74 @@ class Settings(BaseSettings):
     # backend/config.py -> backend/ -> code3-10/ -> workspace
     WORKSPACE_DIR: Path = Path(__file__).resolve().parent.parent / "workspace"
 
+    # [新增] 存储写入: 专用 I/O 线程数 / fsync 策略 ("none" 不同步, "file" 同步文件内容, "full" 同时同步目录)
+    STORAGE_IO_WORKERS: int = 4
+    STORAGE_FSYNC: str = "file"
+    # 写后回写 (write-behind): 开启后立即返回 URL，字节在后台写入；排队中的字节数超过上限时调用方等待
+    STORAGE_WRITE_BEHIND: bool = False
+    STORAGE_WRITE_BEHIND_MAX_BYTES: int = 256 * 1024 * 1024
+    # [新增] 按文件名哈希前缀分片存放的子目录: {项目}/generations/{2位十六进制}/{文件名}
+    # URL 保持不变 (/files/{项目}/generations/{文件名})；旧项目可用 python -m app.utils.layout_migration 迁移
+    STORAGE_SHARDED_DIRS: list[str] = ["generations"]
+
+    # [新增] 上传大小上限 (字节，按存储目录区分；未列出的目录使用默认值) 与流式读取块大小
+    UPLOAD_MAX_BYTES: dict[str, int] = {
+        "inputs": 1024 * 1024 * 1024,
+        "generations": 512 * 1024 * 1024,
+        "ps_exchange": 2048 * 1024 * 1024,
+    }
+    UPLOAD_DEFAULT_MAX_BYTES: int = 512 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+    # [新增] 入库时按 EXIF 方向转正的最大像素数 (更大的图片不重新编码，只在素材索引中记录方向)
+    ORIENT_NORMALIZE_MAX_PIXELS: int = 64 * 1024 * 1024
+
+    # [新增] 画布缩略图 (Mip 金字塔) 的尺寸级别 (长边像素)
+    THUMBNAIL_SIZES: list[int] = [256, 512, 1024, 2048]
+    # [新增] 超大图 Deep Zoom 瓦片: 瓦片边长 / 热点瓦片内存缓存 (MB) / 同时打开的 pack 数 / 允许解码的最大像素数
+    TILE_SIZE: int = 256
+    TILE_CACHE_MB: int = 64
+    TILE_MAX_OPEN_PACKS: int = 32
+    TILE_MAX_PIXELS: int = 1024 * 1024 * 1024
+
+    # [新增] /files 素材服务: 提供 .br / .gz 预压缩副本的文件类型与最小体积
+    ASSET_PRECOMPRESS_SUFFIXES: list[str] = [".json", ".svg", ".txt", ".csv"]
+    ASSET_PRECOMPRESS_MIN_BYTES: int = 1024
+    # [新增] /files/...?format=&max=&q= 转码副本的磁盘缓存上限 (MB)
+    VARIANT_CACHE_MB: int = 512
+    # [新增] 素材垃圾回收 (见 app/utils/asset_gc.py): 回收的子目录 / 运行间隔 / 宽限期 / 回收站保留期 (秒)
+    GC_ENABLED: bool = True
+    GC_DIRS: list[str] = ["generations", "ps_exchange"]
+    GC_INTERVAL: float = 3600
+    GC_GRACE_PERIOD: float = 24 * 3600
+    GC_TRASH_RETENTION: float = 7 * 24 * 3600
+
+    # [新增] 后端缓存目录 (响应缓存等，不对外暴露)
+    CACHE_DIR: Path = Path(__file__).resolve().parent / "temp" / "cache"
+    # 外部模型响应缓存: 内存条目数 / 有效期 (秒) / 磁盘条目上限
+    RESPONSE_CACHE_MAX_ENTRIES: int = 256
+    RESPONSE_CACHE_TTL: float = 7 * 24 * 3600
+    RESPONSE_CACHE_MAX_DISK_ENTRIES: int = 5000
+    # [新增] 任务输入 Blob (blob://<sha256>) 的单个大小上限与保留时间 (秒)
+    BLOB_MAX_BYTES: int = 256 * 1024 * 1024
+    BLOB_TTL: float = 24 * 3600
+    # [新增] 发送给外部模型的图片预算 (未在 image_budget.MODEL_BUDGETS 中列出的模型使用) 与预处理缓存大小
+    IMAGE_BUDGET_MAX_PIXELS: int = 2048 * 2048
+    IMAGE_BUDGET_MAX_BYTES: int = 4 * 1024 * 1024
+    IMAGE_PREP_CACHE_MB: int = 128
+    # 同一请求中并发加载 / 预处理的图片数量上限
+    IMAGE_LOAD_CONCURRENCY: int = 4
+    # [新增] 外部模型 API 限流 (见 app/utils/rate_limiter.py)
+    # 按提供商 / 模型覆盖: {"openai": {"concurrency": 8, "rpm": 500, "tpm": 200000}}，rpm / tpm 为 0 表示不限制
+    PROVIDER_LIMITS: dict[str, dict[str, int]] = {}
+    MODEL_LIMITS: dict[str, dict[str, int]] = {}
+    PROVIDER_DEFAULT_CONCURRENCY: int = 8
+    PROVIDER_DEFAULT_RPM: int = 0
+    PROVIDER_DEFAULT_TPM: int = 0
+    # 可重试错误 (429 / 5xx / 超时) 的最大重试次数与退避时间 (秒)
+    API_MAX_RETRIES: int = 4
+    API_RETRY_BASE_DELAY: float = 1.0
+    API_RETRY_MAX_DELAY: float = 60.0
+
     # 允许的跨域来源
     CORS_ORIGINS: list[str] = ["*"]
 
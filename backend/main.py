@@ -10,8 +10,7 @@ from pathlib import Path
 from typing import List
 
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, UploadFile, File, Form, HTTPException
-from fastapi.responses import StreamingResponse
-from fastapi.staticfiles import StaticFiles # [新增] 用于挂载图片目录
+from fastapi.responses import StreamingResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
@@ -21,8 +20,24 @@ from app import dispatcher
 from app.websocket_manager import manager
 from app.utils import storage # [新增] 引入存储管理器
 from app.utils import project_manager # [新增] 引入项目管理器
+from app.utils import comfy_pool # [新增] ComfyUI 多后端负载均衡
+from app.utils import workflow_registry # [新增] 工作流模板缓存
+from app.utils import comfy_stats # [新增] ComfyUI 耗时统计
+from app.utils import response_cache # [新增] 外部模型响应缓存
+from app.utils import image_budget # [新增] 图片预算预处理缓存
+from app.utils import rate_limiter # [新增] 外部模型 API 限流
+from app.utils import health # [新增] 外部后端熔断与健康探测
+from app.utils import blob_store # [新增] 任务输入 Blob (blob://)
+from app.utils import cas # [新增] 工作区内容寻址存储
+from app.utils import thumbnails # [新增] 画布缩略图金字塔
+from app.utils import tiles # [新增] 超大图 Deep Zoom 瓦片
+from app.utils.asset_server import AssetFiles # [新增] 带强缓存 / 预压缩的素材服务
+from app.utils import variants # [新增] 素材按需转码
+from app.utils import asset_gc # [新增] 素材垃圾回收
+from app.utils import asset_index # [新增] 素材元数据索引
 from app.pipelines import pipe_a_rembg # [新增] 引入 RemBg 管道
 from app.pipelines import pipe_b_comfyui # [新增] 引入 ComfyUI 管道
+from app.pipelines import pipe_d_gemini_local # [新增] 本地 Gemini 服务 (单并发队列)
 from config import settings
 
 # 配置日志
@@ -32,10 +47,6 @@ logger = logging.getLogger("backend")
 # 核心配置：预留一个 CPU 核给系统/API，其余给计算任务
 MAX_WORKERS = max(1, multiprocessing.cpu_count() - 1)
 
-# [新增] 配置工作流存储路径 (相对于项目根目录: workspace/workflow)
-WORKFLOWS_DIR = settings.WORKSPACE_DIR / "workflow"
-WORKFLOWS_DIR.mkdir(parents=True, exist_ok=True)
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
@@ -52,10 +63,27 @@ async def lifespan(app: FastAPI):
     logger.info(f"⚙️ Initializing ProcessPool with {MAX_WORKERS} workers.")
     process_pool = ProcessPoolExecutor(max_workers=MAX_WORKERS)
     app.state.process_pool = process_pool
+    # [新增] 缩略图生成使用同一个进程池
+    thumbnails.mips.bind(process_pool)
+    tiles.tiles.bind(process_pool)
+    variants.cache.bind(process_pool)
+
+    # [新增] 启动 ComfyUI 后端池健康检查
+    comfy_pool.pool.start()
+    # [新增] 启动外部后端 (8021 / 自定义 LiteLLM 服务) 健康探测
+    health.registry.start()
+    # [新增] 启动素材垃圾回收
+    asset_gc.collector.start()
     
     yield # 应用运行中...
     
     # --- 关闭阶段 (Shutdown) ---
+    await comfy_pool.pool.stop()
+    # [新增] 等待写后回写队列中的文件落盘
+    await storage.write_behind.flush()
+    await health.registry.stop()
+    await asset_gc.collector.stop()
+    await pipe_d_gemini_local.close()
     logger.info("🛑 Backend Shutting down... Closing ProcessPool.")
     process_pool.shutdown(wait=True)
     logger.info("✅ ProcessPool closed.")
@@ -75,12 +103,43 @@ app.add_middleware(
 # [新增] 2. 挂载静态文件服务
 # 这样前端访问 http://localhost:8020/files/inputs/xxx.png 就能看到图
 # storage.WORKSPACE_DIR 指向的是项目根目录下的 workspace
-app.mount("/files", StaticFiles(directory=str(settings.WORKSPACE_DIR)), name="files")
+# [Modified] AssetFiles: 强 ETag / immutable 缓存 / Range / JSON 预压缩，且不暴露 .cas 等内部目录
+app.mount("/files", AssetFiles(directory=str(settings.WORKSPACE_DIR), precompressed_dir=settings.CACHE_DIR / "precompressed"), name="files")
 
 @app.get("/api/health")
 async def root():
     """健康检查接口"""
-    return {"message": "AI Workflow Backend is Running", "status": "active"}
+    return {
+        "message": "AI Workflow Backend is Running",
+        "status": "active",
+        "comfy_backends": comfy_pool.pool.status(),
+        # [新增] 所有外部后端的熔断器状态 (closed / open / half_open)
+        "backends": health.registry.status()
+    }
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """[新增] 运行指标 (缓存命中率等)"""
+    return {
+        "response_cache": response_cache.cache.stats(),
+        "image_prep_cache": image_budget.prepared.stats(),
+        "rate_limits": rate_limiter.limits.snapshot(),
+        "gemini_local_queue": pipe_d_gemini_local.session_queue.status(),
+        "content_store": cas.store.stats(),
+        "write_behind": storage.write_behind.stats(),
+        "tiles": tiles.tiles.stats(),
+        "variants": variants.cache.stats(),
+        "asset_gc": asset_gc.collector.stats(),
+    }
+
+@app.get("/api/comfy/stats")
+async def get_comfy_stats():
+    """[新增] ComfyUI 执行耗时统计 (按工作流 / 节点 / 后端)"""
+    return {
+        "backends": comfy_pool.pool.status(),
+        "stats": comfy_stats.stats.snapshot(),
+        "active_prompts": pipe_b_comfyui.active_prompts,
+    }
 
 # [新增] ComfyUI 直接执行接口 (适配前端 App.jsx 的 fetch 调用)
 @app.post("/api/run")
@@ -108,24 +167,26 @@ async def upload_file(file: UploadFile = File(...), project_id: str = Form(...),
     """
     logger.info(f"📂 Receiving upload: {file.filename} (Project: {project_id}, Type: {type})")
     
-    if type == "generation":
-        # AI 生成的图片，存入 generations 目录
-        # save_generated_image 需要 bytes, 所以我们先 read()
-        content = await file.read()
-        # 从文件名中提取前缀和后缀
-        original_name = Path(file.filename or "generated.png")
-        prefix = original_name.stem
-        ext = original_name.suffix.lstrip('.') or "png"
-        
-        result = storage.save_generated_image(
-            image_bytes=content,
-            prefix=prefix,
-            ext=ext,
-            project_id=project_id
-        )
-    else:
-        # 用户上传的原图，存入 inputs 目录 (默认行为)
-        result = await storage.save_upload_file(file, project_id, type=type)
+    try:
+        if type == "generation":
+            # AI 生成的图片，存入 generations 目录
+            # [Modified] 流式写入，不再 read() 整个文件
+            # 从文件名中提取前缀和后缀
+            original_name = Path(file.filename or "generated.png")
+            prefix = original_name.stem
+            ext = original_name.suffix.lstrip('.') or "png"
+
+            result = await storage.save_generated_upload(
+                file,
+                prefix=prefix,
+                ext=ext,
+                project_id=project_id
+            )
+        else:
+            # 用户上传的原图，存入 inputs 目录 (默认行为)
+            result = await storage.save_upload_file(file, project_id, type=type)
+    except storage.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     
     logger.info(f"✅ Saved to: {result['path']}")
     return {
@@ -133,6 +194,127 @@ async def upload_file(file: UploadFile = File(...), project_id: str = Form(...),
         "file": result # 包含 filename, path, url
     }
 
+# [新增] 任务输入 Blob 上传接口
+@app.post("/api/blobs")
+async def upload_blob(request: Request):
+    """
+    上传原始图片字节，返回 blob:// 句柄供任务 payload 引用 (替代 Base64 data URL)
+    - 请求体直接为原始字节 (application/octet-stream，可分块传输)，边接收边写盘
+    - 也兼容 multipart/form-data 的 file 字段
+    """
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None:
+                raise HTTPException(status_code=400, detail="Missing 'file' field")
+
+            async def _chunks():
+                while chunk := await upload.read(1024 * 1024):
+                    yield chunk
+            handle, size = await blob_store.blobs.put_stream(_chunks())
+        else:
+            handle, size = await blob_store.blobs.put_stream(request.stream())
+        return {"status": "success", "handle": handle, "size": size}
+    except blob_store.BlobTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+# [新增] 画布缩略图接口 (Mip 金字塔)
+@app.get("/api/thumbs/{project_id}/{sub_dir}/{filename}")
+async def get_thumbnail(project_id: str, sub_dir: str, filename: str, size: int = 512):
+    """
+    返回 /files/{project_id}/{sub_dir}/{filename} 的缩略图，画布按显示尺寸 (长边像素) 请求
+    size 不超过最大级别时返回不小于 size 的最小 WebP 级别，否则返回原图
+    无法生成缩略图且原图大于 size 时返回 415 (不下发超大原图)
+    """
+    # 写后回写队列中的文件先等待写完
+    await storage.write_behind.wait_for(storage.asset_path(project_id, sub_dir, filename))
+    src = storage.resolve_workspace_path(f"/files/{project_id}/{sub_dir}/{filename}")
+    if src is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        path = await thumbnails.mips.variant(src, size)
+    except thumbnails.ThumbnailUnavailable as e:
+        raise HTTPException(status_code=415, detail=f"Thumbnail unavailable: {e}")
+    except Exception as e:
+        logger.warning(f"⚠️ Thumbnail unavailable for {filename}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    # 素材文件名唯一且只写一次，缩略图可长期缓存
+    return FileResponse(path, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+# [新增] 超大图 Deep Zoom 瓦片接口 (DZI 约定，第一次请求时切片)
+def _tile_source(project_id: str, sub_dir: str, filename: str) -> Path:
+    src = storage.resolve_workspace_path(f"/files/{project_id}/{sub_dir}/{filename}")
+    if src is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return src
+
+@app.get("/api/tiles/{project_id}/{sub_dir}/{filename}.dzi")
+async def get_tile_descriptor(project_id: str, sub_dir: str, filename: str):
+    """DZI 描述文件 (尺寸、瓦片大小与格式)"""
+    src = _tile_source(project_id, sub_dir, filename)
+    try:
+        xml = await tiles.tiles.dzi(src)
+    except tiles.TileBuildFailed as e:
+        raise HTTPException(status_code=415, detail=f"Tiles unavailable: {e}")
+    except Exception as e:
+        logger.error(f"❌ Tile build failed for {filename}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return Response(xml, media_type="application/xml", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@app.get("/api/tiles/{project_id}/{sub_dir}/{filename}_files/{level}/{tile}")
+async def get_tile(project_id: str, sub_dir: str, filename: str, level: int, tile: str):
+    """单个瓦片: {col}_{row}.webp"""
+    try:
+        col, row = (int(v) for v in tile.rsplit(".", 1)[0].split("_"))
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Tile not found")
+    src = _tile_source(project_id, sub_dir, filename)
+    try:
+        data = await tiles.tiles.tile(src, level, col, row)
+    except tiles.TileBuildFailed as e:
+        raise HTTPException(status_code=415, detail=f"Tiles unavailable: {e}")
+    except Exception as e:
+        logger.error(f"❌ Tile build failed for {filename}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if data is None:
+        raise HTTPException(status_code=404, detail="Tile not found")
+    return Response(data, media_type=f"image/{tiles.TILE_FORMAT}", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+# [新增] 素材元数据查询接口 (尺寸 / 透明区域 / 感知哈希等，画布与管道无需再探测文件)
+def _asset_view(project_id: str, record: dict) -> dict:
+    return {**record, "url": f"/files/{project_id}/{storage.public_rel(record['path'])}"}
+
+@app.get("/api/assets/{project_id}")
+async def list_assets(project_id: str, sub_dir: str = None, has_alpha: bool = None,
+                      min_width: int = None, min_height: int = None):
+    """按条件列出项目中已入库素材的元数据"""
+    if not (settings.WORKSPACE_DIR / project_id / "project.json").exists():
+        raise HTTPException(status_code=404, detail="Project not found")
+    records = await storage.run_io(
+        asset_index.index.query, project_id, prefix=f"{sub_dir}/" if sub_dir else None,
+        has_alpha=has_alpha, min_width=min_width, min_height=min_height,
+    )
+    return {"assets": [_asset_view(project_id, r) for r in records]}
+
+@app.get("/api/assets/{project_id}/{sub_dir}/{filename}")
+async def get_asset_meta(project_id: str, sub_dir: str, filename: str):
+    """单个素材的元数据 (未入库的旧文件当场探测并补录)"""
+    src = storage.resolve_workspace_path(f"/files/{project_id}/{sub_dir}/{filename}")
+    record = await storage.run_io(asset_index.index.get, src) if src else None
+    if record is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return _asset_view(project_id, record)
+
+@app.get("/api/assets/{project_id}/{sub_dir}/{filename}/similar")
+async def get_similar_assets(project_id: str, sub_dir: str, filename: str, max_distance: int = 8):
+    """同一项目中与该素材感知哈希接近的素材 (按距离排序)"""
+    src = storage.resolve_workspace_path(f"/files/{project_id}/{sub_dir}/{filename}")
+    if src is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    records = await storage.run_io(asset_index.index.similar, src, max_distance)
+    return {"assets": [_asset_view(project_id, r) for r in records]}
+
 # --- [新增] 项目管理接口 ---
 class CreateProjectRequest(BaseModel):
     name: str
@@ -193,38 +375,64 @@ async def delete_project_api(project_id: str):
 class UpdateProjectRequest(BaseModel):
     id: str
     data: dict
+    # [新增] 前端撤销历史中引用的图片 (不写入 project.json，只用于垃圾回收的引用追踪)
+    history_refs: List[str] = []
 
 @app.post("/api/projects/save")
 async def save_project_api(req: UpdateProjectRequest):
     """保存项目 (覆盖 project.json)"""
     try:
         project_manager.update_project(req.id, req.data)
+        asset_gc.collector.touch(req.history_refs, project_id=req.id)
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# [新增] 素材垃圾回收
+@app.get("/api/gc")
+async def get_gc_status():
+    """回收统计与回收站当前占用"""
+    return {**asset_gc.collector.stats(), "trash_bytes": await asyncio.to_thread(asset_gc.collector.trash_bytes)}
+
+@app.post("/api/gc/run")
+async def run_gc(project_id: str = None):
+    """立即执行一轮回收 (可指定项目)，返回本轮报告 (移入回收站 / 彻底删除 / 实际释放的字节数)"""
+    if project_id and not (settings.WORKSPACE_DIR / project_id / "project.json").exists():
+        raise HTTPException(status_code=404, detail="Project not found")
+    return await asset_gc.collector.run(project_id)
+
 # [新增] 工作流管理接口
 @app.get("/api/workflows")
 async def list_workflows():
     """扫描目录，返回所有 .json 工作流文件"""
     try:
-        files = [f.name for f in WORKFLOWS_DIR.glob("*.json")]
+        files = workflow_registry.registry.list_names()
         return {"workflows": files}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/workflows/{name}")
 async def get_workflow(name: str):
-    """读取指定工作流文件的内容"""
-    file_path = WORKFLOWS_DIR / name
-    if not file_path.exists():
+    """读取指定工作流文件的内容 (命中缓存时不再重复解析)"""
+    try:
+        template = workflow_registry.registry.get(name)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Workflow not found")
-    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading file: {str(e)}")
+
+    content = template.content
+    if isinstance(content, dict) and 'name' not in content:
+        content = {**content, 'name': name}
+    return content
+
+@app.get("/api/workflows/{name}/slots")
+async def get_workflow_slots(name: str):
+    """[新增] 返回工作流的参数槽位，供模板模式 {template, params} 使用"""
     try:
-        content = json.loads(file_path.read_text(encoding='utf-8'))
-        if isinstance(content, dict) and 'name' not in content:
-            content['name'] = name
-        return content
+        return workflow_registry.registry.get(name).describe()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Workflow not found")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error reading file: {str(e)}")
 
@@ -236,9 +444,8 @@ class SaveWorkflowRequest(BaseModel):
 async def save_workflow(req: SaveWorkflowRequest):
     """保存工作流到指定目录"""
     name = req.name if req.name.endswith('.json') else f"{req.name}.json"
-    file_path = WORKFLOWS_DIR / name
     try:
-        file_path.write_text(json.dumps(req.content, indent=2, ensure_ascii=False), encoding='utf-8')
+        workflow_registry.registry.save(name, req.content)
         return {"status": "success", "message": f"Saved to {name}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -264,9 +471,9 @@ async def bridge_import_files(req: BridgeImportRequest):
             if not src_path.exists():
                 continue
                 
-            # 1. 复制文件
-            dest_path = inputs_dir / src_path.name
-            shutil.copy2(src_path, dest_path)
+            # 1. [Modified] 入库: EXIF 转正 + 存入内容寻址存储 (reflink / 复制一次) + 元数据索引
+            dest_path = storage.asset_path(req.project_id, "inputs", src_path.name)
+            await storage.import_external_file(src_path, dest_path)
             
             # 2. 生成 URL
             # [Fix] 不要使用 quote 编码文件名。保持原始中文文件名，避免 rembg 等后续流程将编码后的字符串误认为是文件名。
@@ -321,7 +528,23 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
     try:
         while True:
             # 1. 等待接收前端消息
-            data = await websocket.receive_text()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+            # [新增] 二进制帧: 任务输入 Blob，保存后回执 blob:// 句柄
+            # 保存完成后才读取下一条消息，因此紧随其后的任务可以直接引用该句柄
+            # 失败时同样以 type="blob" 回执 {"ref", "error"}，前端据 ref 拒绝对应的 sendBlob
+            if message.get("bytes") is not None:
+                try:
+                    receipt = await blob_store.blobs.put_frame(message["bytes"])
+                except Exception as e:
+                    logger.error(f"Failed to store WS blob: {e}")
+                    receipt = {"ref": getattr(e, "ref", None), "error": f"Blob upload failed: {e}"}
+                await manager.send_to_client(client_id, schemas.WSMessage(type="blob", data=receipt))
+                continue
+
+            data = message.get("text") or ""
             
             try:
                 # 2. 解析 JSON
@@ -0,0 +1,72 @@
+"""
+backend/tests/conftest.py
+测试公共配置: 使用临时 workspace，提供假的 ComfyUI 服务与图片处理进程池
+"""
+import os
+import sys
+import socket
+import tempfile
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+# 必须在导入 config 之前设置，避免测试写入真实的 workspace
+os.environ.setdefault("WORKSPACE_DIR", tempfile.mkdtemp(prefix="workspace_test_"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def fake_comfy():
+    """在后台线程中启动一个假的 ComfyUI 节点，返回其 base_url"""
+    import uvicorn
+    from tests.fake_comfy import app
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("fake ComfyUI server did not start")
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join(timeout=5)
+
+
+@pytest.fixture
+def dead_url() -> str:
+    """没有服务监听的地址 (连接被拒绝)"""
+    return f"http://127.0.0.1:{free_port()}"
+
+
+# 子进程中 PIL 的默认像素上限 (调低以模拟超大图)
+TEST_PIXEL_LIMIT = 1000
+
+
+def _set_pixel_limit(limit: int):
+    Image.MAX_IMAGE_PIXELS = limit
+
+
+@pytest.fixture
+def image_pool():
+    """
+    单进程的图片处理进程池，子进程的默认像素上限为 TEST_PIXEL_LIMIT
+    使用 spawn: 测试进程中已有其他线程 (存储 IO 线程池等)，fork 出的子进程可能死锁
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context,
+                             initializer=_set_pixel_limit, initargs=(TEST_PIXEL_LIMIT,)) as pool:
+        yield pool
@@ -0,0 +1,92 @@
+"""
+backend/tests/fake_comfy.py
+最小化的假 ComfyUI 节点: /prompt 提交后通过 WebSocket 推送 executing / executed 事件，
+/view 返回一张 8x8 PNG，/history 可查询已完成的结果
+behavior["drop"] 为 True 时执行前关闭 WebSocket，且 history 中不包含任何输出
+behavior["images"] 为每个 SaveImage 节点输出的图片数
+"""
+import io
+import json
+import uuid
+import asyncio
+from typing import Dict
+
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import Response
+from PIL import Image
+
+app = FastAPI()
+clients: Dict[str, WebSocket] = {}
+history: Dict[str, dict] = {}
+submitted = []
+behavior = {"drop": False, "images": 1}
+
+
+def _png() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), "red").save(buf, "PNG")
+    return buf.getvalue()
+
+
+@app.get("/prompt")
+async def queue_info():
+    return {"exec_info": {"queue_remaining": 0}}
+
+
+@app.get("/queue")
+async def queue():
+    return {"queue_running": [], "queue_pending": []}
+
+
+@app.get("/history/{prompt_id}")
+async def get_history(prompt_id: str):
+    return {prompt_id: history[prompt_id]} if prompt_id in history else {}
+
+
+@app.get("/view")
+async def view(filename: str, subfolder: str = "", type: str = "output"):
+    return Response(_png(), media_type="image/png")
+
+
+@app.post("/prompt")
+async def submit(request: Request):
+    body = await request.json()
+    prompt_id = str(uuid.uuid4())
+    submitted.append(prompt_id)
+    ws = clients.get(body["client_id"])
+    workflow = body["prompt"]
+
+    async def execute():
+        await asyncio.sleep(0.05)
+        if behavior["drop"]:
+            await ws.close()
+            history[prompt_id] = {"outputs": {}, "status": {"completed": True, "status_str": "success"}}
+            return
+        outputs = {
+            node_id: {"images": [{"filename": f"out_{node_id}_{i}.png", "subfolder": "", "type": "output"}
+                                 for i in range(behavior["images"])]}
+            for node_id, node in workflow.items() if node.get("class_type") == "SaveImage"
+        }
+        history[prompt_id] = {"outputs": outputs, "status": {"completed": True, "status_str": "success"}}
+        for node_id in workflow:
+            await ws.send_text(json.dumps({"type": "executing", "data": {"node": node_id, "prompt_id": prompt_id}}))
+            if node_id in outputs:
+                await ws.send_text(json.dumps({
+                    "type": "executed",
+                    "data": {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id},
+                }))
+        await ws.send_text(json.dumps({"type": "executing", "data": {"node": None, "prompt_id": prompt_id}}))
+
+    asyncio.create_task(execute())
+    return {"prompt_id": prompt_id}
+
+
+@app.websocket("/ws")
+async def websocket(ws: WebSocket, clientId: str):
+    await ws.accept()
+    clients[clientId] = ws
+    try:
+        while True:
+            await ws.receive_text()
+    except WebSocketDisconnect:
+        clients.pop(clientId, None)
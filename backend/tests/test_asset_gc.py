@@ -0,0 +1,59 @@
+"""
+backend/tests/test_asset_gc.py
+素材垃圾回收: 跨项目引用表每轮只读一次，仍被引用的回收文件按需恢复
+"""
+import json
+
+import pytest
+
+from app.utils import storage
+from app.utils.asset_gc import AssetCollector
+from config import settings
+
+
+def make_project(root, pid, refs=()):
+    (root / pid / "generations").mkdir(parents=True)
+    (root / pid / "project.json").write_text(json.dumps({"layers": list(refs)}), encoding="utf-8")
+
+
+def sharded_file(root, pid, name):
+    path = root / pid / "generations" / storage.shard_of(name) / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"data")
+    return path
+
+
+@pytest.fixture
+def collector(tmp_path, monkeypatch):
+    # 宽限期为负: 所有未被引用的文件都立即可回收
+    monkeypatch.setattr(settings, "GC_GRACE_PERIOD", -10)
+    return AssetCollector(tmp_path, ["generations"])
+
+
+def test_cross_project_reference_is_kept_and_map_read_once(tmp_path, collector, monkeypatch):
+    make_project(tmp_path, "a", ["/files/b/generations/kept.png"])
+    make_project(tmp_path, "b")
+    kept = sharded_file(tmp_path, "b", "kept.png")
+    dropped = sharded_file(tmp_path, "b", "dropped.png")
+
+    calls = []
+    original = collector._reference_map
+    monkeypatch.setattr(collector, "_reference_map", lambda: calls.append(1) or original())
+    summary = collector.run_once()
+
+    assert len(calls) == 1
+    assert kept.exists()
+    assert not dropped.exists()
+    assert summary["trashed_files"] == 1
+
+
+def test_trashed_file_is_restored_on_request(tmp_path, collector):
+    make_project(tmp_path, "p")
+    path = sharded_file(tmp_path, "p", "undo.png")
+    collector.run_once("p")
+    assert not path.exists()
+
+    assert collector.restore("p", "generations/undo.png") == path
+    assert path.read_bytes() == b"data"
+    assert collector.restore("p", "generations/missing.png") is None
+    assert collector.restore("..", "generations/undo.png") is None
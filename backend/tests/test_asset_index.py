@@ -0,0 +1,88 @@
+"""
+backend/tests/test_asset_index.py
+素材元数据索引: 连接不常驻，EXIF 转正保留原图的编码参数与元数据
+"""
+import io
+import os
+import shutil
+import hashlib
+from pathlib import Path
+
+from PIL import Image, PngImagePlugin
+
+from app.utils import asset_index
+from app.utils.asset_index import AssetIndex
+
+
+def rotated(fmt, **params):
+    exif = Image.Exif()
+    exif[asset_index.ORIENTATION] = 6
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 32), "blue").save(buf, fmt, exif=exif.tobytes(), **params)
+    return buf.getvalue()
+
+
+def test_index_does_not_keep_connections_open(tmp_path):
+    project = tmp_path / "p"
+    (project / "inputs").mkdir(parents=True)
+    f = project / "inputs" / "a.png"
+    Image.new("RGBA", (8, 8)).save(f)
+
+    idx = AssetIndex(tmp_path)
+    assert idx.get(f)["width"] == 8
+    assert idx.query("p")[0]["path"] == "inputs/a.png"
+    # 没有残留的 WAL / 共享内存文件 (连接全部关闭后才会清理)，整个项目可以直接删除
+    assert sorted(os.listdir(project / ".meta")) == ["index.db"]
+    shutil.rmtree(project)
+
+
+def test_jpeg_transpose_keeps_quantization_tables():
+    data = rotated("JPEG", quality=60)
+    fixed = asset_index.normalize_bytes(data)
+    with Image.open(io.BytesIO(data)) as src, Image.open(io.BytesIO(fixed)) as out:
+        assert out.size == (32, 64)
+        assert out.getexif().get(asset_index.ORIENTATION, 1) == 1
+        assert out.quantization == src.quantization
+
+
+def test_png_transpose_keeps_text_chunks():
+    info = PngImagePlugin.PngInfo()
+    info.add_text("parameters", "prompt: a cat")
+    fixed = asset_index.normalize_bytes(rotated("PNG", pnginfo=info))
+    with Image.open(io.BytesIO(fixed)) as out:
+        assert out.size == (32, 64)
+        assert out.text["parameters"] == "prompt: a cat"
+
+
+def test_normalize_file_streams_to_disk(tmp_path, monkeypatch):
+    part = tmp_path / "upload.part"
+    part.write_bytes(rotated("PNG"))
+
+    targets = []
+    save = Image.Image.save
+
+    def recording_save(self, fp, *args, **kwargs):
+        targets.append(fp)
+        return save(self, fp, *args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, "save", recording_save)
+    digest = asset_index.normalize_file(part)
+    # 编码结果直接写入同目录的临时文件，而不是内存缓冲区
+    assert [Path(t).parent for t in targets] == [tmp_path]
+    assert digest == hashlib.sha256(part.read_bytes()).hexdigest()
+    assert os.listdir(tmp_path) == ["upload.part"]
+    with Image.open(part) as out:
+        assert out.size == (32, 64)
+
+
+def test_large_image_keeps_original_and_records_orientation(tmp_path, monkeypatch):
+    monkeypatch.setattr(asset_index.settings, "ORIENT_NORMALIZE_MAX_PIXELS", 64 * 32 - 1)
+    data = rotated("JPEG")
+    assert asset_index.normalize_bytes(data) == data
+
+    f = tmp_path / "p" / "inputs" / "big.jpg"
+    f.parent.mkdir(parents=True)
+    f.write_bytes(data)
+    assert asset_index.normalize_file(f) is None
+    assert f.read_bytes() == data
+    assert AssetIndex(tmp_path).get(f)["orientation"] == 6
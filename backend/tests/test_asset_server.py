@@ -0,0 +1,69 @@
+"""
+backend/tests/test_asset_server.py
+/files 素材服务: 预压缩副本的清理与写后回写队列
+"""
+import asyncio
+import json
+import os
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.utils import asset_server
+from app.utils.asset_server import AssetFiles
+from config import settings
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    root = tmp_path / "ws"
+    (root / "p").mkdir(parents=True)
+    monkeypatch.setattr(settings, "ASSET_PRECOMPRESS_MIN_BYTES", 16)
+    app = FastAPI()
+    app.mount("/files", AssetFiles(directory=str(root), precompressed_dir=tmp_path / "pre"), name="files")
+    return root, tmp_path / "pre", TestClient(app)
+
+
+def wait_for_files(directory, pattern, count, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        found = list(directory.glob(pattern)) if directory.exists() else []
+        if len(found) == count:
+            return found
+        time.sleep(0.02)
+    raise AssertionError(f"expected {count} files matching {pattern}, found {found}")
+
+
+def test_previous_precompressed_variant_is_removed(files):
+    root, pre, client = files
+    project = root / "p" / "project.json"
+    headers = {"accept-encoding": "gzip"}
+    for version in range(3):
+        project.write_text(json.dumps({"layers": ["x" * 200], "version": version}))
+        os.utime(project, ns=(version * 10**9, version * 10**9))
+        client.get("/files/p/project.json", headers=headers)
+        wait_for_files(pre, "*-*.gz", 1)
+    response = client.get("/files/p/project.json", headers=headers)
+    assert response.headers.get("content-encoding") == "gzip"
+    assert response.json()["version"] == 2
+
+
+def test_waits_for_pending_write_behind(files, monkeypatch):
+    root, _, client = files
+    target = root / "p" / "late.txt"
+
+    class Pending:
+        def __init__(self):
+            self.pending = {str(target): True}
+
+        async def wait_for(self, path):
+            if str(path) == str(target):
+                await asyncio.sleep(0.05)
+                target.write_text("written late")
+
+    monkeypatch.setattr(asset_server, "write_behind", Pending())
+    response = client.get("/files/p/late.txt")
+    assert response.status_code == 200
+    assert response.text == "written late"
@@ -0,0 +1,49 @@
+"""
+backend/tests/test_blob_store.py
+WebSocket 二进制帧形式的 Blob 上传
+"""
+import asyncio
+import hashlib
+import json
+import struct
+
+import pytest
+
+from app.utils.blob_store import BlobStore, BlobRejected
+
+
+def frame(body: bytes, **header) -> bytes:
+    raw = json.dumps(header).encode("utf-8")
+    return struct.pack(">I", len(raw)) + raw + body
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(tmp_path, max_bytes=1024, ttl=3600)
+
+
+def test_put_frame_returns_receipt(store):
+    body = b"image bytes"
+    digest = hashlib.sha256(body).hexdigest()
+    receipt = asyncio.run(store.put_frame(frame(body, ref="r1", sha256=digest)))
+    assert receipt == {"handle": f"blob://{digest}", "size": len(body), "ref": "r1"}
+    assert store.read_bytes(receipt["handle"]) == body
+
+
+def test_hash_mismatch_is_rejected_before_write(store, tmp_path):
+    with pytest.raises(BlobRejected) as info:
+        asyncio.run(store.put_frame(frame(b"corrupted", ref="r2", sha256="0" * 64)))
+    assert info.value.ref == "r2"
+    assert not [p for p in tmp_path.rglob("*") if p.is_file()]
+
+
+def test_oversized_frame_is_rejected_with_ref(store):
+    with pytest.raises(BlobRejected) as info:
+        asyncio.run(store.put_frame(frame(b"x" * 2048, ref="r3")))
+    assert info.value.ref == "r3"
+
+
+def test_malformed_frame_is_rejected(store):
+    with pytest.raises(BlobRejected) as info:
+        asyncio.run(store.put_frame(b"\x00\x00"))
+    assert info.value.ref is None
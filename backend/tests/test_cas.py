@@ -0,0 +1,66 @@
+"""
+backend/tests/test_cas.py
+内容寻址存储: 写入与并发释放之间的引用计数
+"""
+import pytest
+
+from app.utils.cas import ContentStore
+
+
+def make_store(tmp_path) -> ContentStore:
+    return ContentStore(tmp_path / ".cas", tmp_path)
+
+
+def refcount(store, digest):
+    row = store._conn().execute("SELECT refcount FROM objects WHERE hash = ?", (digest,)).fetchone()
+    return row[0] if row else None
+
+
+def test_release_during_put_does_not_remove_linked_object(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    a, b = tmp_path / "p" / "a.png", tmp_path / "p" / "b.png"
+    digest = store.put_bytes(b"same content", a)
+
+    # 模拟并发: 在 b 检查到对象存在之后、链接之前，唯一的另一个引用 a 被释放
+    original = store._link
+
+    def racing_link(obj, dest):
+        if dest == b:
+            store.release(a)
+        return original(obj, dest)
+
+    monkeypatch.setattr(store, "_link", racing_link)
+    assert store.put_bytes(b"same content", b) == digest
+    assert b.read_bytes() == b"same content"
+    assert store.object_path(digest).exists()
+    assert refcount(store, digest) == 1
+
+
+def test_remove_object_rechecks_refcount(tmp_path):
+    store = make_store(tmp_path)
+    a, b = tmp_path / "p" / "a.png", tmp_path / "p" / "b.png"
+    digest = store.put_bytes(b"data", a)
+    # 引用数归零后、删除对象前又被重新引用
+    store._register(b, digest, 4)
+    store._remove_object(digest)
+    assert store.object_path(digest).exists()
+
+    store.release(a)
+    store.release(b)
+    assert not store.object_path(digest).exists()
+    assert refcount(store, digest) is None
+
+
+def test_failed_link_rolls_back_reference(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    dest = tmp_path / "p" / "c.png"
+
+    def broken_link(obj, dest):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "_link", broken_link)
+    with pytest.raises(OSError):
+        store.put_bytes(b"payload", dest)
+    assert store.hash_of(dest) is None
+    assert store.stats()["objects"] == 0
+    assert not [p for p in store.objects.rglob("*") if p.is_file()]
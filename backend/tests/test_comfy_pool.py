@@ -0,0 +1,220 @@
+"""
+backend/tests/test_comfy_pool.py
+ComfyUI 后端池: 节点选择、熔断状态转换、入队前失败时的换节点重试
+"""
+import asyncio
+import time
+
+import pytest
+
+from app.utils import comfy_pool
+from app.utils.comfy_pool import ComfyPool, STICKY_TOLERANCE, workflow_signature
+from app.utils.health import CircuitBreaker
+from app.pipelines import pipe_b_comfyui
+
+WORKFLOW = {
+    "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sdxl.safetensors"}},
+    "9": {"class_type": "SaveImage", "inputs": {}},
+}
+
+
+def make_pool(*urls) -> ComfyPool:
+    return ComfyPool(list(urls) or ["http://a:8188", "http://b:8188"])
+
+
+def trip(breaker: CircuitBreaker):
+    for _ in range(breaker.threshold):
+        breaker.record_failure("boom")
+
+
+def expire(breaker: CircuitBreaker):
+    """跳过冷却时间，进入半开状态"""
+    breaker.open_until = time.monotonic() - 1
+
+
+# --- 熔断器状态转换 ---
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker("t", threshold=2, cooldown=60)
+    breaker.record_failure("e1")
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure("e2")
+    assert breaker.state == "open"
+    assert not breaker.allow() and not breaker.ready()
+
+
+def test_breaker_half_open_allows_single_trial():
+    breaker = CircuitBreaker("t", threshold=1, cooldown=60)
+    trip(breaker)
+    expire(breaker)
+    assert breaker.state == "half_open"
+    assert breaker.ready()
+    assert breaker.allow()
+    # 试探进行中：不再放行，也不是候选
+    assert not breaker.allow()
+    assert not breaker.ready()
+
+
+def test_breaker_trial_success_closes():
+    breaker = CircuitBreaker("t", threshold=1, cooldown=60)
+    trip(breaker)
+    expire(breaker)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_breaker_trial_failure_reopens():
+    breaker = CircuitBreaker("t", threshold=1, cooldown=60)
+    trip(breaker)
+    expire(breaker)
+    assert breaker.allow()
+    breaker.record_failure("still down")
+    assert breaker.state == "open"
+    assert breaker.last_error == "still down"
+
+
+def test_breaker_end_trial_returns_slot():
+    breaker = CircuitBreaker("t", threshold=1, cooldown=60)
+    trip(breaker)
+    expire(breaker)
+    assert breaker.allow()
+    breaker.end_trial()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+# --- 节点选择 ---
+
+def test_select_prefers_lowest_load():
+    pool = make_pool()
+    a, b = pool.backends
+    a.queue_remaining = 3
+    assert pool.select() is b
+    b.inflight = 5
+    assert pool.select() is a
+
+
+def test_select_skips_open_and_excluded():
+    pool = make_pool()
+    a, b = pool.backends
+    trip(a)
+    assert pool.select() is b
+    with pytest.raises(RuntimeError):
+        pool.select(exclude=[b])
+
+
+def test_select_sticky_to_warm_backend():
+    pool = make_pool()
+    a, b = pool.backends
+    b.loaded.append(workflow_signature(WORKFLOW))
+    # b 稍忙但在容忍度以内：复用已加载模型的节点
+    a.queue_remaining = 2
+    b.queue_remaining = 3
+    assert b.load_score() <= a.load_score() * STICKY_TOLERANCE
+    assert pool.select(WORKFLOW) is b
+    # 负载差距过大时回到最空闲的节点
+    b.queue_remaining = 10
+    assert pool.select(WORKFLOW) is a
+
+
+def test_half_open_backend_gets_one_trial_only():
+    pool = make_pool()
+    a, b = pool.backends
+    trip(a)
+    expire(a)
+    b.queue_remaining = 10          # 让 a 成为负载最低的候选
+    first = pool.acquire()
+    assert first is a
+    # 试探进行中，其余任务全部派发到 b
+    assert pool.acquire() is b
+    assert pool.acquire() is b
+    pool.release(first)
+    assert a.ready()
+
+
+def test_release_keeps_trial_while_other_tasks_running():
+    pool = make_pool()
+    a, _ = pool.backends
+    a.inflight = 1                  # 熔断前已派发的任务
+    trip(a)
+    expire(a)
+    a.allow()
+    a.inflight += 1
+    pool.release(a)                 # 旧任务结束，试探仍在进行
+    assert not a.ready()
+    pool.release(a)
+    assert a.ready()
+
+
+# --- 换节点重试 ---
+
+def test_run_fails_over_to_next_backend(monkeypatch):
+    pool = make_pool()
+    a, b = pool.backends
+    monkeypatch.setattr(comfy_pool, "pool", pool)
+    attempts = []
+
+    async def fake_run(backend, *args, **kwargs):
+        attempts.append(backend)
+        if backend is a:
+            raise pipe_b_comfyui.BackendUnavailable("connect refused")
+        return {"status": "success", "data": []}
+
+    monkeypatch.setattr(pipe_b_comfyui, "_run_on_backend", fake_run)
+    result = asyncio.run(pipe_b_comfyui.run({"workflow": dict(WORKFLOW), "output_node_id": "9"}))
+    assert result["status"] == "success"
+    assert attempts == [a, b]
+    assert a.failures == 1 and a.inflight == 0 and b.inflight == 0
+
+
+def test_run_reports_error_when_all_backends_fail(monkeypatch):
+    pool = make_pool()
+    monkeypatch.setattr(comfy_pool, "pool", pool)
+
+    async def fake_run(backend, *args, **kwargs):
+        raise pipe_b_comfyui.BackendUnavailable("connect refused")
+
+    monkeypatch.setattr(pipe_b_comfyui, "_run_on_backend", fake_run)
+    result = asyncio.run(pipe_b_comfyui.run({"workflow": dict(WORKFLOW), "output_node_id": "9"}))
+    assert result["status"] == "error"
+    assert "No healthy ComfyUI backend" in result["message"]
+
+
+def test_run_against_fake_comfy_with_dead_backend(monkeypatch, fake_comfy, dead_url):
+    pool = make_pool(dead_url, fake_comfy)
+    dead, live = pool.backends
+    monkeypatch.setattr(comfy_pool, "pool", pool)
+    payload = {"workflow": dict(WORKFLOW), "output_nodes": [{"nodeId": "9"}], "project_id": "pool_test"}
+    result = asyncio.run(pipe_b_comfyui.run(payload))
+    assert result["status"] == "success", result
+    assert len(result["data"]) == 1
+    assert dead.failures == 1 and live.failures == 0
+    assert workflow_signature(WORKFLOW) in live.loaded
+
+
+def test_probe_updates_queue_and_recovers(fake_comfy, dead_url):
+    pool = make_pool(dead_url, fake_comfy)
+    dead, live = pool.backends
+    trip(live)
+    live.queue_remaining = 7
+    asyncio.run(pool.probe_all())
+    assert live.state == "closed" and live.queue_remaining == 0
+    assert dead.failures == 1 and dead.last_error.startswith("Health check failed")
+
+
+def test_local_read_error_is_task_error(monkeypatch):
+    pool = make_pool()
+    monkeypatch.setattr(comfy_pool, "pool", pool)
+
+    async def broken_input(value, backend_url):
+        raise PermissionError("permission denied: a.png")
+
+    monkeypatch.setattr(pipe_b_comfyui, "_prepare_image_input", broken_input)
+    payload = {"workflow": dict(WORKFLOW), "output_node_id": "9", "inputs": {"1": {"image": "/files/p/inputs/a.png"}}}
+    result = asyncio.run(pipe_b_comfyui.run(payload))
+    assert result["status"] == "error"
+    assert "permission denied" in result["message"]
+    # 本地 I/O 错误不计入节点故障
+    assert all(b.failures == 0 for b in pool.backends)
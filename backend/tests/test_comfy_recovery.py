@@ -0,0 +1,84 @@
+"""
+backend/tests/test_comfy_recovery.py
+WebSocket 断开 / 下载输出失败后从 ComfyUI /history 恢复结果
+"""
+import asyncio
+
+import httpx
+import pytest
+
+from app.utils import comfy_pool
+from app.utils.comfy_pool import ComfyPool
+from app.pipelines import pipe_b_comfyui
+from config import settings
+from tests.fake_comfy import behavior
+
+WORKFLOW = {
+    "1": {"class_type": "EmptyLatentImage", "inputs": {}},
+    "9": {"class_type": "SaveImage", "inputs": {}},
+}
+PAYLOAD = {"output_nodes": [{"nodeId": "9"}], "project_id": "recovery_test"}
+
+
+@pytest.fixture
+def live_pool(monkeypatch, fake_comfy):
+    pool = ComfyPool([fake_comfy])
+    monkeypatch.setattr(comfy_pool, "pool", pool)
+    monkeypatch.setattr(settings, "COMFY_RECOVERY_TIMEOUT", 5.0)
+    yield pool
+    behavior.update(drop=False, images=1)
+
+
+def test_output_fetch_error_recovers_from_history(monkeypatch, live_pool):
+    original = pipe_b_comfyui._collect_node_output
+    calls = []
+
+    async def flaky(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise httpx.ConnectError("connection reset")
+        return await original(*args, **kwargs)
+
+    monkeypatch.setattr(pipe_b_comfyui, "_collect_node_output", flaky)
+    result = asyncio.run(pipe_b_comfyui.run({**PAYLOAD, "workflow": dict(WORKFLOW)}, task_id="t1"))
+    assert result["status"] == "success", result
+    assert len(result["data"]) == 1
+    assert "warning" not in result
+    assert len(calls) == 2
+    assert "t1" not in pipe_b_comfyui.active_prompts
+
+
+def test_drop_without_outputs_is_error(live_pool):
+    behavior["drop"] = True
+    result = asyncio.run(pipe_b_comfyui.run({**PAYLOAD, "workflow": dict(WORKFLOW)}))
+    assert result["status"] == "error"
+    assert "without output" in result["message"]
+
+
+def test_partial_node_download_is_not_saved_twice(monkeypatch, live_pool):
+    behavior["images"] = 3
+    saves = []
+    original_save = pipe_b_comfyui.storage.save_generated_image_async
+
+    async def counting_save(*args, **kwargs):
+        result = await original_save(*args, **kwargs)
+        saves.append(result["url"])
+        return result
+
+    # 第二张图第一次下载时连接断开 (第一张已保存)
+    original_get = httpx.AsyncClient.get
+    failed = []
+
+    async def flaky_get(self, url, *args, **kwargs):
+        if "out_9_1.png" in str(url) and not failed:
+            failed.append(url)
+            raise httpx.ReadError("connection reset")
+        return await original_get(self, url, *args, **kwargs)
+
+    monkeypatch.setattr(pipe_b_comfyui.storage, "save_generated_image_async", counting_save)
+    monkeypatch.setattr(httpx.AsyncClient, "get", flaky_get)
+    result = asyncio.run(pipe_b_comfyui.run({**PAYLOAD, "workflow": dict(WORKFLOW)}, task_id="t2"))
+    assert result["status"] == "success", result
+    assert failed
+    assert len(saves) == 3
+    assert [r["value"] for r in result["data"]] == saves
@@ -0,0 +1,75 @@
+"""
+backend/tests/test_gemini_local_queue.py
+8021 单并发队列: 先进先出、会话亲和 (有上限) 与排队位置推送
+"""
+import asyncio
+
+import pytest
+
+from app.pipelines import pipe_d_gemini_local
+from app.pipelines.pipe_d_gemini_local import _SessionQueue
+from config import settings
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    order, positions = [], {}
+
+    async def fake_call(job, active_conversation):
+        order.append(job.task_id)
+        await asyncio.sleep(0.01)
+        return {"status": "success", "task": job.task_id}
+
+    async def fake_send(client_id, message):
+        positions.setdefault(message.task_id, []).append(message.data["queue_position"])
+
+    monkeypatch.setattr(pipe_d_gemini_local, "_call_service", fake_call)
+    monkeypatch.setattr(pipe_d_gemini_local.manager, "send_to_client", fake_send)
+    monkeypatch.setattr(pipe_d_gemini_local._breaker, "is_available", lambda: True)
+    monkeypatch.setattr(settings, "GEMINI_LOCAL_MAX_AFFINITY", 2)
+    return _SessionQueue(), order, positions
+
+
+def job(client, task, new_chat):
+    return {"conversation_id": client, "new_chat": new_chat}, task, client
+
+
+async def submit_all(q, jobs):
+    tasks = []
+    for payload, task_id, client_id in jobs:
+        tasks.append(asyncio.create_task(q.submit(payload, task_id, client_id)))
+        await asyncio.sleep(0)  # 按顺序入队
+    return await asyncio.gather(*tasks)
+
+
+def test_fifo_without_affinity(queue):
+    q, order, _ = queue
+    results = asyncio.run(submit_all(q, [job("a", "a1", True), job("b", "b1", True), job("c", "c1", True)]))
+    assert order == ["a1", "b1", "c1"]
+    assert [r["task"] for r in results] == ["a1", "b1", "c1"]
+
+
+def test_follow_ups_jump_the_queue_up_to_the_cap(queue):
+    q, order, _ = queue
+    jobs = [job("a", "a1", True), job("b", "b1", True)] + [job("a", f"a{i}", False) for i in range(2, 6)]
+    asyncio.run(submit_all(q, jobs))
+    # a 的后续消息最多连续插队 2 次，之后先执行等待中的 b1
+    assert order == ["a1", "a2", "a3", "b1", "a4", "a5"]
+
+
+def test_follow_up_of_displaced_conversation_waits_its_turn(queue):
+    q, order, _ = queue
+    jobs = [job("a", "a1", True), job("b", "b1", True), job("c", "c1", True), job("b", "b2", False)]
+    asyncio.run(submit_all(q, jobs))
+    # b1 执行后 b 成为当前对话，b2 插到 c1 之前
+    assert order == ["a1", "b1", "b2", "c1"]
+
+
+def test_queue_positions_are_pushed(queue):
+    q, _, positions = queue
+    asyncio.run(submit_all(q, [job("a", "a1", True), job("b", "b1", True), job("c", "c1", True)]))
+    # 入队时的位置，之后随着前面的任务完成递减到 0 (处理中)
+    assert positions["c1"][0] == 2
+    assert positions["c1"][-1] == 0
+    assert positions["b1"][0] == 1
+    assert all(x >= y for x, y in zip(positions["c1"], positions["c1"][1:]))
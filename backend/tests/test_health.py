@@ -0,0 +1,77 @@
+"""
+backend/tests/test_health.py
+健康注册表: 熔断保护下的调用与后台探测范围
+"""
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from app.utils.health import CircuitBreaker, CircuitOpenError, HealthRegistry
+
+
+def half_open(breaker: CircuitBreaker):
+    for _ in range(breaker.threshold):
+        breaker.record_failure("down")
+    breaker.open_until = time.monotonic() - 1
+
+
+def test_cancelled_trial_returns_slot():
+    registry = HealthRegistry()
+    breaker = registry.register("svc")
+    half_open(breaker)
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(10)
+
+        task = asyncio.create_task(registry.call(breaker, slow))
+        await started.wait()
+        with pytest.raises(CircuitOpenError):
+            await registry.call(breaker, slow)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_connection_errors_trip_and_business_errors_do_not():
+    registry = HealthRegistry()
+    breaker = registry.register("svc2")
+
+    async def refused():
+        raise httpx.ConnectError("refused")
+
+    async def bad_request():
+        raise ValueError("invalid prompt")
+
+    async def scenario():
+        with pytest.raises(ValueError):
+            await registry.call(breaker, bad_request)
+        for _ in range(breaker.threshold):
+            with pytest.raises(httpx.ConnectError):
+                await registry.call(breaker, refused)
+
+    asyncio.run(scenario())
+    assert breaker.state == "open"
+
+
+def test_only_used_backends_are_probed(fake_comfy, dead_url):
+    registry = HealthRegistry()
+    unused = registry.register("unused", probe_url=dead_url)
+    used = registry.register("used", probe_url=fake_comfy + "/prompt")
+
+    async def ok():
+        return "ok"
+
+    asyncio.run(registry.call(used, ok))
+    asyncio.run(registry.probe_all())
+    assert unused.last_probe == 0 and unused.failures == 0
+    assert used.last_probe > 0 and used.state == "closed"
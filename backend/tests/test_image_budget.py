@@ -0,0 +1,59 @@
+"""
+backend/tests/test_image_budget.py
+发送给外部模型前的图片预算处理
+"""
+import io
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from app.utils.image_budget import fit, PreparedImageCache
+
+
+def jpeg(size, orientation=1) -> bytes:
+    img = Image.new("RGB", size, "blue")
+    exif = Image.Exif()
+    if orientation != 1:
+        exif[0x0112] = orientation
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", exif=exif)
+    return buf.getvalue()
+
+
+def test_within_budget_passes_through():
+    data = jpeg((300, 200))
+    out, mime = fit(data, 1000 * 1000, 10 * 1024 * 1024)
+    assert out is data and mime == "image/jpeg"
+
+
+def test_rotated_source_is_uprighted_even_within_budget():
+    out, _ = fit(jpeg((300, 200), orientation=6), 1000 * 1000, 10 * 1024 * 1024)
+    img = Image.open(io.BytesIO(out))
+    assert img.size == (200, 300)
+    assert img.getexif().get(0x0112, 1) == 1
+
+
+def test_resized_output_keeps_orientation():
+    out, _ = fit(jpeg((1600, 1200), orientation=6), 400 * 300, 10 * 1024 * 1024)
+    img = Image.open(io.BytesIO(out))
+    assert img.width < img.height
+    assert img.width * img.height <= 400 * 300
+
+
+def test_get_or_fit_uses_given_executor():
+    used = []
+
+    class Recording(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            used.append(fn)
+            return super().submit(fn, *args, **kwargs)
+
+    cache = PreparedImageCache(10 * 1024 * 1024)
+    data = jpeg((1600, 1200))
+    with Recording(max_workers=1) as executor:
+        first = asyncio.run(cache.get_or_fit(data, 400 * 300, 1024 * 1024, executor=executor))
+        second = asyncio.run(cache.get_or_fit(data, 400 * 300, 1024 * 1024, executor=executor))
+    assert first == second
+    assert fit in used
+    assert cache.hits == 1 and cache.misses == 1
@@ -0,0 +1,17 @@
+"""
+backend/tests/test_photoshop_paths.py
+导出到 Photoshop 时图层 URL 的本地路径解析 (分片目录)
+"""
+from app.pipelines.pipe_e_photoshop import _resolve_path
+from app.utils import storage
+
+
+def test_sharded_generation_url_resolves_to_file():
+    path = storage.asset_path("ps_paths", "generations", "layer.png")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"png")
+
+    for url in ("/files/ps_paths/generations/layer.png",
+                "http://127.0.0.1:8020/files/ps_paths/generations/layer.png"):
+        assert _resolve_path(url) == str(path.resolve())
+    assert _resolve_path("/files/ps_paths/generations/missing.png") == ""
@@ -0,0 +1,28 @@
+"""
+backend/tests/test_rate_limiter.py
+可重试错误的判定
+"""
+import asyncio
+
+import httpx
+
+from app.utils.rate_limiter import is_retryable
+
+
+def status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://api.example.com/v1/chat")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, request=request))
+
+
+def test_transport_errors_are_retryable():
+    assert is_retryable(httpx.ConnectError("refused"))
+    assert is_retryable(httpx.ReadTimeout("slow"))
+    assert is_retryable(httpx.RemoteProtocolError("reset"))
+    assert is_retryable(asyncio.TimeoutError())
+
+
+def test_status_codes():
+    for status in (408, 429, 500, 502, 503, 504, 529):
+        assert is_retryable(status_error(status)), status
+    for status in (400, 401, 403, 404, 409, 422):
+        assert not is_retryable(status_error(status)), status
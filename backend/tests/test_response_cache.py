@@ -0,0 +1,30 @@
+"""
+backend/tests/test_response_cache.py
+响应缓存: 确定性判定与缓存键
+"""
+from app.utils.response_cache import cache, KEY_PARAMS
+from app.pipelines.pipe_c_api import CHAT_PARAMS, IMAGE_PARAMS
+
+
+def test_forwarded_params_are_part_of_key():
+    assert set(CHAT_PARAMS) | set(IMAGE_PARAMS) <= set(KEY_PARAMS)
+
+
+def test_litellm_temperature_zero_or_seed_is_cacheable():
+    assert cache.is_cacheable({"protocol": "litellm", "model": "gpt-4o", "temperature": 0})
+    assert cache.is_cacheable({"protocol": "litellm", "model": "gpt-4o", "seed": 7})
+    assert not cache.is_cacheable({"protocol": "litellm", "model": "gpt-4o", "temperature": 0.7})
+
+
+def test_gemini_and_image_calls_need_explicit_opt_in():
+    assert not cache.is_cacheable({"model": "gemini-2.0-flash", "temperature": 0, "seed": 1})
+    assert not cache.is_cacheable({"protocol": "litellm_image", "model": "dall-e-3", "seed": 1})
+    assert cache.is_cacheable({"model": "gemini-2.0-flash", "cache": True})
+    assert not cache.is_cacheable({"protocol": "litellm", "temperature": 0, "cache_control": "no-store"})
+
+
+def test_tools_change_the_key():
+    base = {"protocol": "litellm", "model": "gpt-4o", "temperature": 0, "messages": [{"role": "user", "content": "hi"}]}
+    with_tools = {**base, "tools": [{"type": "function", "function": {"name": "lookup"}}]}
+    assert cache.make_key(base) != cache.make_key(with_tools)
+    assert cache.make_key(base) == cache.make_key({**base, "api_key": "sk-secret"})
@@ -0,0 +1,25 @@
+"""
+backend/tests/test_storage_import.py
+外部服务生成文件的导入: 副本独立于源文件
+"""
+import io
+
+from PIL import Image
+
+from app.utils import storage
+
+
+def test_import_generated_file_does_not_share_inode(tmp_path):
+    src = tmp_path / "external.png"
+    Image.new("RGB", (4, 4), "green").save(src, "PNG")
+    original = src.read_bytes()
+
+    info = storage.import_generated_file(str(src), prefix="ext", project_id="import_test")
+    assert src.stat().st_nlink == 1
+
+    # 外部服务覆盖源文件不影响工作区里的副本
+    buf = io.BytesIO()
+    Image.new("RGB", (4, 4), "red").save(buf, "PNG")
+    with open(src, "r+b") as f:
+        f.write(buf.getvalue())
+    assert open(info["path"], "rb").read() == original
@@ -0,0 +1,108 @@
+"""
+backend/tests/test_thumbnails.py
+缩略图金字塔: 生成、失败记录与后台任务
+"""
+import asyncio
+import os
+
+import pytest
+from PIL import Image
+
+from app.utils import thumbnails
+from app.utils.thumbnails import MipCache
+from tests.conftest import TEST_PIXEL_LIMIT
+
+
+def make_cache(tmp_path) -> MipCache:
+    return MipCache(tmp_path, [64, 128])
+
+
+def test_builds_levels_smaller_than_source(tmp_path):
+    cache = make_cache(tmp_path)
+    src = tmp_path / "p" / "generations" / "a.png"
+    src.parent.mkdir(parents=True)
+    Image.new("RGB", (100, 50), "red").save(src)
+    manifest = asyncio.run(cache.ensure(src))
+    assert manifest["levels"] == [64]
+    assert asyncio.run(cache.variant(src, 32)) == cache.cache_dir(src) / "64.webp"
+    assert asyncio.run(cache.variant(src, 100)) == src
+
+
+def test_failure_is_recorded_until_source_changes(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    src = tmp_path / "p" / "generations" / "broken.png"
+    src.parent.mkdir(parents=True)
+    src.write_bytes(b"not an image")
+    calls = []
+    original = thumbnails.build_pyramid
+
+    def counting(*args):
+        calls.append(args)
+        return original(*args)
+
+    monkeypatch.setattr(thumbnails, "build_pyramid", counting)
+    manifest = asyncio.run(cache.ensure(src))
+    assert manifest["levels"] == [] and manifest["error"]
+    # 尺寸未知: 不能用原图代替缩略图
+    with pytest.raises(thumbnails.ThumbnailUnavailable):
+        asyncio.run(cache.variant(src, 64))
+    assert len(calls) == 1
+
+    # 源文件被替换为有效图片后重新生成
+    Image.new("RGB", (200, 200), "blue").save(src, "PNG")
+    manifest = asyncio.run(cache.ensure(src))
+    assert manifest["levels"] == [64, 128]
+    assert len(calls) == 2
+
+
+def test_schedule_keeps_task_reference(tmp_path):
+    cache = make_cache(tmp_path)
+    src = tmp_path / "p" / "generations" / "b.png"
+    src.parent.mkdir(parents=True)
+    Image.new("RGB", (300, 300), "green").save(src)
+
+    async def scenario():
+        cache.schedule(src)
+        assert len(cache._tasks) == 1
+        await asyncio.gather(*cache._tasks)
+        assert not cache._tasks
+
+    asyncio.run(scenario())
+    assert (cache.cache_dir(src) / "manifest.json").exists()
+
+
+def test_image_over_default_pixel_limit_builds_in_process_pool(tmp_path, monkeypatch, image_pool):
+    # 把 PIL 的默认上限调低来模拟超大图 (进程池子进程中同样调低)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", TEST_PIXEL_LIMIT)
+    src = tmp_path / "p" / "generations" / "huge.png"
+    src.parent.mkdir(parents=True)
+    Image.new("RGB", (600, 300), "red").save(src)
+
+    # 线程中保持默认上限: 生成失败，且原图大于请求尺寸，不能返回原图
+    cache = make_cache(tmp_path)
+    with pytest.raises(thumbnails.ThumbnailUnavailable):
+        asyncio.run(cache.variant(src, 64))
+
+    # 源文件签名变化后重新生成
+    os.utime(src, ns=(src.stat().st_atime_ns, src.stat().st_mtime_ns + 1_000_000))
+    cache.bind(image_pool)
+    manifest = asyncio.run(cache.ensure(src))
+    assert manifest["levels"] == [64, 128]
+    assert manifest["width"] == 600
+    assert Image.MAX_IMAGE_PIXELS == TEST_PIXEL_LIMIT
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", None)
+    with Image.open(cache.cache_dir(src) / "128.webp") as thumb:
+        assert thumb.size == (128, 64)
+
+
+def test_exif_rotated_source_is_transposed_after_reduce(tmp_path):
+    cache = make_cache(tmp_path)
+    src = tmp_path / "p" / "generations" / "rotated.jpg"
+    src.parent.mkdir(parents=True)
+    exif = Image.Exif()
+    exif[thumbnails.ORIENTATION] = 6
+    Image.new("RGB", (1200, 600), "blue").save(src, exif=exif.tobytes())
+    manifest = asyncio.run(cache.ensure(src))
+    assert (manifest["width"], manifest["height"]) == (600, 1200)
+    with Image.open(cache.cache_dir(src) / "128.webp") as thumb:
+        assert thumb.size == (64, 128)
@@ -0,0 +1,92 @@
+"""
+backend/tests/test_tiles.py
+Deep Zoom 瓦片: 切片、打开的 pack 淘汰、解压炸弹限制与失败记录
+"""
+import asyncio
+import os
+
+import pytest
+from PIL import Image
+
+from app.utils import tiles
+from app.utils.tiles import TileService, TileBuildFailed, build_tiles
+
+
+def image(tmp_path, name, size=(600, 400)):
+    path = tmp_path / "p" / "generations" / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new("RGB", size, "purple").save(path)
+    return path
+
+
+def test_tiles_and_dzi(tmp_path):
+    service = TileService(tmp_path, tile_size=256, cache_bytes=1 << 20, max_open=4)
+    src = image(tmp_path, "a.png")
+
+    async def scenario():
+        xml = await service.dzi(src)
+        top = await service.tile(src, 10, 2, 1)
+        missing = await service.tile(src, 10, 9, 9)
+        return xml, top, missing
+
+    xml, top, missing = asyncio.run(scenario())
+    assert 'Width="600"' in xml and 'Height="400"' in xml
+    assert top[:4] == b"RIFF"
+    assert missing is None
+
+
+def test_evicted_pack_closes_after_last_reader(tmp_path):
+    service = TileService(tmp_path, tile_size=256, cache_bytes=0, max_open=1)
+    sources = [image(tmp_path, f"{i}.png") for i in range(3)]
+
+    async def scenario():
+        for src in sources:
+            await service.ensure(src)
+        # 多张图并发读取，打开上限为 1，读取中的 pack 被淘汰时不能被关闭
+        reads = [service.tile(src, 9, col, 0) for src in sources for col in range(2)] * 5
+        return await asyncio.gather(*reads)
+
+    results = asyncio.run(scenario())
+    assert all(r is not None for r in results)
+    assert len(service._packs) == 1
+
+
+def test_pixel_limit_is_restored(tmp_path):
+    src = image(tmp_path, "b.png", size=(300, 300))
+    before = Image.MAX_IMAGE_PIXELS
+    build_tiles(str(src), str(tmp_path / "out"), 256, 10 ** 9)
+    assert Image.MAX_IMAGE_PIXELS == before
+
+
+def test_build_failure_is_recorded_until_source_changes(tmp_path, monkeypatch):
+    service = TileService(tmp_path, tile_size=256, cache_bytes=0, max_open=1)
+    src = tmp_path / "p" / "generations" / "broken.png"
+    src.parent.mkdir(parents=True)
+    src.write_bytes(b"garbage")
+    calls = []
+    original = tiles.build_tiles
+    monkeypatch.setattr(tiles, "build_tiles", lambda *args: calls.append(args) or original(*args))
+
+    for _ in range(3):
+        with pytest.raises(TileBuildFailed):
+            asyncio.run(service.tile(src, 0, 0, 0))
+    assert len(calls) == 1
+
+    Image.new("RGB", (300, 300), "blue").save(src, "PNG")
+    st = src.stat()
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert asyncio.run(service.tile(src, 0, 0, 0)) is not None
+    assert len(calls) == 2
+
+
+def test_thread_fallback_keeps_default_pixel_limit(tmp_path, monkeypatch):
+    # 未绑定进程池时不修改进程全局的像素上限，超限的图记录为失败
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    service = TileService(tmp_path, tile_size=256, cache_bytes=0, max_open=1)
+    src = image(tmp_path, "big.png", size=(300, 300))
+    seen = []
+    original = tiles.build_tiles
+    monkeypatch.setattr(tiles, "build_tiles", lambda *args: seen.append(Image.MAX_IMAGE_PIXELS) or original(*args))
+    with pytest.raises(TileBuildFailed):
+        asyncio.run(service.dzi(src))
+    assert seen == [1000]
@@ -0,0 +1,54 @@
+"""
+backend/tests/test_uploads.py
+上传: 按目录的大小上限 (413) 与失败时清理 .cas/tmp 中的临时文件
+"""
+import asyncio
+import io
+
+import pytest
+from fastapi import UploadFile
+from fastapi.testclient import TestClient
+
+import main
+from app.utils import storage
+from app.utils.cas import store as cas_store
+from config import settings
+
+
+def spooled_files():
+    tmp_dir = cas_store.root / "tmp"
+    return list(tmp_dir.glob("*.part")) if tmp_dir.exists() else []
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_MAX_BYTES", {"inputs": 64, "ps_exchange": 4096})
+    monkeypatch.setattr(settings, "UPLOAD_DEFAULT_MAX_BYTES", 64)
+    monkeypatch.setattr(settings, "UPLOAD_CHUNK_SIZE", 16)
+    return TestClient(main.app)
+
+
+def upload(client, sub_dir, size):
+    return client.post("/upload", data={"project_id": "upload_test", "type": sub_dir},
+                       files={"file": ("data.bin", b"x" * size, "application/octet-stream")})
+
+
+def test_per_directory_upload_limit(client):
+    assert upload(client, "inputs", 100).status_code == 413
+    # generations 不在 UPLOAD_MAX_BYTES 中，使用默认上限
+    assert upload(client, "generation", 100).status_code == 413
+    r = upload(client, "ps_exchange", 100)
+    assert r.status_code == 200, r.text
+    assert "/ps_exchange/" in r.json()["file"]["relative_url"]
+    assert spooled_files() == []
+
+
+def test_failed_save_removes_spooled_file(monkeypatch):
+    def broken_locate(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(storage, "locate", broken_locate)
+    file = UploadFile(io.BytesIO(b"payload"), filename="a.bin")
+    with pytest.raises(OSError):
+        asyncio.run(storage.save_upload_file(file, "upload_test", type="inputs"))
+    assert spooled_files() == []
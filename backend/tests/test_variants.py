@@ -0,0 +1,65 @@
+"""
+backend/tests/test_variants.py
+/files 按需转码: 源格式不能输出时的默认格式，ETag 协商先于转码
+"""
+import io
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app.utils import variants
+from app.utils.asset_server import AssetFiles
+from tests.conftest import TEST_PIXEL_LIMIT
+
+
+def test_unsupported_source_format_falls_back_to_png():
+    assert variants.parse_params({"max": "64"}, ".gif")[0] == "PNG"
+    assert variants.parse_params({"max": "64"}, ".psd")[0] == "PNG"
+    assert variants.parse_params({"max": "64"}, ".webp")[0] == "WEBP"
+    with pytest.raises(variants.VariantParamError):
+        variants.parse_params({"format": "psd"}, ".png")
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    root = tmp_path / "ws"
+    (root / "p").mkdir(parents=True)
+    Image.new("RGB", (256, 128), "red").save(root / "p" / "a.gif")
+    monkeypatch.setattr(variants, "cache", variants.VariantCache(tmp_path / "variants", max_bytes=1 << 20))
+    app = FastAPI()
+    app.mount("/files", AssetFiles(directory=str(root), precompressed_dir=tmp_path / "pre"), name="files")
+    return TestClient(app)
+
+
+def test_gif_with_max_only_is_served_as_png(client):
+    r = client.get("/files/p/a.gif?max=64")
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/png"
+
+
+def test_conditional_request_skips_transcoding(client, monkeypatch):
+    etag = client.get("/files/p/a.gif?max=64").headers["etag"]
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("transcoded on a conditional hit")
+
+    monkeypatch.setattr(variants.cache, "get", fail)
+    r = client.get("/files/p/a.gif?max=64", headers={"if-none-match": etag})
+    assert r.status_code == 304
+    assert r.headers["etag"] == etag
+
+
+def test_image_over_pixel_limit(client, monkeypatch, image_pool):
+    # 把 PIL 的默认上限调低来模拟超大图 (进程池子进程中同样调低)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", TEST_PIXEL_LIMIT)
+    # 线程中保持默认上限: 返回 415 而不是 500
+    assert client.get("/files/p/a.gif?format=webp&max=64").status_code == 415
+
+    variants.cache.bind(image_pool)
+    r = client.get("/files/p/a.gif?format=webp&max=64&q=70")
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/webp"
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", None)
+    assert Image.open(io.BytesIO(r.content)).size == (64, 32)
@@ -0,0 +1,164 @@
+"""
+backend/tests/test_write_behind.py
+写后回写队列 (_WriteBehind) 与原子写入 / fsync 策略
+"""
+import asyncio
+import io
+import os
+import threading
+from pathlib import Path
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from PIL import Image
+
+from app.utils import asset_server, cas, storage
+from app.utils.asset_server import AssetFiles
+from config import settings
+
+
+def png_bytes(color="red") -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    """每个测试一个新队列 (队列中的事件绑定到创建它的事件循环)"""
+    wb = storage._WriteBehind()
+    monkeypatch.setattr(storage, "write_behind", wb)
+    monkeypatch.setattr(asset_server, "write_behind", wb)
+    return wb
+
+
+@pytest.fixture
+def gate(monkeypatch):
+    """写入线程在 gate 打开之前阻塞，模拟慢速磁盘"""
+    event = threading.Event()
+    store_bytes = storage._store_bytes
+
+    def slow_store(data, path):
+        assert event.wait(5)
+        return store_bytes(data, path)
+
+    monkeypatch.setattr(storage, "_store_bytes", slow_store)
+    return event
+
+
+def files_client() -> httpx.AsyncClient:
+    app = FastAPI()
+    app.mount("/files", AssetFiles(directory=str(settings.WORKSPACE_DIR),
+                                   precompressed_dir=settings.CACHE_DIR / "test_precompressed"), name="files")
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+
+def test_url_is_returned_before_bytes_land(queue, gate):
+    data = png_bytes()
+
+    async def scenario():
+        info = await storage.save_generated_image_async(data, prefix="wb", project_id="wb_test", defer=True)
+        path = Path(info["path"])
+        assert info["relative_url"].startswith("/files/wb_test/generations/")
+        assert not path.exists()
+        assert queue.stats()["pending"] == 1
+        assert queue.stats()["pending_bytes"] == len(data)
+
+        gate.set()
+        await queue.flush()
+        assert path.read_bytes() == data
+        assert queue.stats() == {"pending": 0, "pending_bytes": 0, "written": 1, "failed": 0}
+
+    asyncio.run(scenario())
+
+
+def test_files_request_waits_for_pending_write(queue, gate):
+    data = png_bytes("blue")
+
+    async def scenario():
+        info = await storage.save_generated_image_async(data, prefix="wb", project_id="wb_test", defer=True)
+        async with files_client() as client:
+            request = asyncio.ensure_future(client.get(info["relative_url"]))
+            await asyncio.sleep(0.1)
+            # 字节落盘之前请求一直挂起，而不是返回 404
+            assert not request.done()
+            gate.set()
+            response = await request
+        assert response.status_code == 200
+        assert response.content == data
+
+    asyncio.run(scenario())
+
+
+def test_failed_write_is_served_as_missing(queue, monkeypatch):
+    def failing_store(data, path):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(storage, "_store_bytes", failing_store)
+
+    async def scenario():
+        info = await storage.save_generated_image_async(png_bytes(), prefix="wb", project_id="wb_test", defer=True)
+        async with files_client() as client:
+            response = await client.get(info["relative_url"])
+        assert response.status_code == 404
+        assert not Path(info["path"]).exists()
+        assert queue.stats()["failed"] == 1
+        assert queue.stats()["pending_bytes"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_byte_cap_applies_backpressure(queue, gate, monkeypatch):
+    first, second = png_bytes("red"), png_bytes("green")
+    monkeypatch.setattr(settings, "STORAGE_WRITE_BEHIND_MAX_BYTES", len(first) + len(second) - 1)
+
+    async def scenario():
+        await storage.save_generated_image_async(first, prefix="wb", project_id="wb_test", defer=True)
+        blocked = asyncio.ensure_future(
+            storage.save_generated_image_async(second, prefix="wb", project_id="wb_test", defer=True))
+        await asyncio.sleep(0.1)
+        # 第二个写入超过上限: 调用方等待，队列中仍只有第一个
+        assert not blocked.done()
+        assert queue.stats()["pending"] == 1
+
+        gate.set()
+        info = await blocked
+        await queue.flush()
+        assert Path(info["path"]).read_bytes() == second
+        assert queue.stats()["written"] == 2
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("policy, synced", [("none", 0), ("file", 1), ("full", 2 if os.name == "posix" else 1)])
+def test_write_atomic_follows_fsync_policy(tmp_path, monkeypatch, policy, synced):
+    calls = []
+    fsync = os.fsync
+
+    def recording_fsync(fd):
+        calls.append(fd)
+        fsync(fd)
+
+    monkeypatch.setattr(settings, "STORAGE_FSYNC", policy)
+    monkeypatch.setattr(cas.os, "fsync", recording_fsync)
+    target = tmp_path / "out" / "a.bin"
+    cas.write_atomic(target, b"payload")
+    assert target.read_bytes() == b"payload"
+    assert len(calls) == synced
+    # 临时文件已被重命名，不残留
+    assert os.listdir(target.parent) == ["a.bin"]
+
+
+def test_write_atomic_keeps_previous_file_on_failure(tmp_path, monkeypatch):
+    target = tmp_path / "a.bin"
+    target.write_bytes(b"old")
+
+    def failing_replace(src, dst):
+        raise OSError("rename failed")
+
+    monkeypatch.setattr(cas.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        cas.write_atomic(target, b"new")
+    assert target.read_bytes() == b"old"
+    assert os.listdir(tmp_path) == ["a.bin"]
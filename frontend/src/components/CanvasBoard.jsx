@@ -1,9 +1,10 @@
 // frontend/src/components/CanvasBoard.jsx
 import React, { useState, useRef, useEffect, useMemo } from 'react';
 import FloatingToolbar from './FloatingToolbar';
-import { LinksLayer, ResizeHandles, ContextMenu } from './CanvasSubComponents';
+import { LinksLayer, ResizeHandles, ContextMenu, TiledImage } from './CanvasSubComponents';
 import { renderPath, labelStyle, selectionBorderStyle, getCanvasCoordinates } from './canvasUtils';
 import { handleCanvasMouseMove } from './canvasInteraction';
+import { mipSrc, TILE_MIN_PIXELS } from '../utils/imageHelpers';
 
 const CanvasBoard = ({ 
     images, setImages, selectedId, onSelect, activeTool, 
@@ -760,6 +761,13 @@ const CanvasBoard = ({
         {images.map((img, index) => {
           const isNodeHighlighted = highlightedNodes.has(img.id);
           const isImgSelected = isSelected(img.id);
+          // [新增] 布局确定后按缩放级别加载缩略图；首次加载与裁切时仍用原图 (handleImageLoad 需要原始尺寸)
+          const displaySrc = img.type === 'image' && img.contentWidth && croppingId !== img.id
+              ? mipSrc(img.src, Math.max(img.contentWidth, img.contentHeight || 0) * zoom)
+              : img.src;
+          // [新增] 超大图放大到超过最大缩略图级别时改用视口内瓦片，而不是解码整张原图
+          const useTiles = img.type === 'image' && img.contentWidth && croppingId !== img.id && displaySrc === img.src
+              && (img.naturalWidth || 0) * (img.naturalHeight || 0) >= TILE_MIN_PIXELS;
           const zIndex = img.type === 'frame' ? 0 : (isImgSelected ? 20 : 10);
           return(
           <div key={img.id} 
@@ -791,7 +799,8 @@ const CanvasBoard = ({
             {img.type === 'image' && ( <>
                {croppingId === img.id && <div style={{ position: 'absolute', top: 0, left: 0, overflow: 'visible', pointerEvents: 'none', width: '100%', height: '100%', zIndex: 0 }}><img src={img.src} crossOrigin="anonymous" style={{ position: 'absolute', top: img.contentY || 0, left: img.contentX || 0, width: img.contentWidth || '100%', height: img.contentHeight || '100%', opacity: 0.3, maxWidth: 'none', maxHeight: 'none' }} alt="" /></div>}
                <div style={{ width: '100%', height: '100%', overflow: 'hidden', position: 'relative', pointerEvents: 'none', zIndex: 1, opacity: img.opacity ?? 1, background: img.fill || 'transparent' }}>
-                  <img src={img.src} crossOrigin="anonymous" onLoad={(e) => handleImageLoad(img.id, e)} alt={img.id} style={{ position: 'absolute', top: 0, left: 0, width: img.contentWidth || '100%', height: img.contentHeight || '100%', transform: `translate(${img.contentX || 0}px, ${img.contentY || 0}px)`, maxWidth: 'none', maxHeight: 'none', objectFit: 'fill' }} />
+                  {useTiles ? <TiledImage img={img} zoom={zoom} offset={offset} viewport={{ width: containerRef.current?.clientWidth || window.innerWidth, height: containerRef.current?.clientHeight || window.innerHeight }} /> :
+                  <img src={displaySrc} crossOrigin="anonymous" onLoad={displaySrc === img.src ? (e) => handleImageLoad(img.id, e) : undefined} alt={img.id} style={{ position: 'absolute', top: 0, left: 0, width: img.contentWidth || '100%', height: img.contentHeight || '100%', transform: `translate(${img.contentX || 0}px, ${img.contentY || 0}px)`, maxWidth: 'none', maxHeight: 'none', objectFit: 'fill' }} /> }
                </div>
             </> )}
             {img.type === 'draw' && ( <svg style={{ width: '100%', height: '100%', overflow: 'visible', opacity: img.opacity ?? 1 }}> <path d={renderPath(img.points, img.width, img.height, img.originalWidth, img.originalHeight, false)} stroke={img.stroke} strokeWidth={img.strokeWidth} fill="none" strokeLinecap="round" strokeLinejoin="round" style={{ filter: img.blur ? `blur(${img.blur}px)` : 'none' }} /> </svg> )}
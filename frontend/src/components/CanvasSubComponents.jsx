@@ -6,6 +6,7 @@ import {
   Download, FileText, Image as LucideImage, Check, LayoutGrid, Palette
 } from 'lucide-react';
 import { getBezierPath } from './canvasUtils';
+import { thumbSrc, tileSourceUrl, parseDzi, MIP_LEVELS } from '../utils/imageHelpers';
 
 // 1. 连线层
 export const LinksLayer = React.memo(({ images, highlightedLinks }) => {
@@ -194,4 +195,65 @@ function generateBindingItems(menuItems, activeWorkflow, itemType) {
             menuItems.push({ label: '设为：提示词 (Prompt)', icon: TypeIcon, action: 'bind_prompt' });
         }
     }
-}
\ No newline at end of file
+}
+
+// [新增] 超大图瓦片层: 只加载视口内、清晰度与当前缩放匹配的 Deep Zoom 瓦片
+export const TiledImage = React.memo(({ img, zoom, offset, viewport }) => {
+    const [info, setInfo] = React.useState(null);
+    const dziUrl = tileSourceUrl(img.src);
+
+    React.useEffect(() => {
+        let alive = true;
+        setInfo(null);
+        fetch(dziUrl)
+            .then(r => (r.ok ? r.text() : Promise.reject(r.status)))
+            .then(xml => { if (alive) setInfo(parseDzi(xml)); })
+            .catch(() => { if (alive) setInfo(false); });
+        return () => { alive = false; };
+    }, [dziUrl]);
+
+    const boxStyle = { position: 'absolute', top: 0, left: 0, width: img.contentWidth, height: img.contentHeight, transform: `translate(${img.contentX || 0}px, ${img.contentY || 0}px)`, overflow: 'hidden' };
+    const fillStyle = { position: 'absolute', top: 0, left: 0, width: '100%', height: '100%', maxWidth: 'none', maxHeight: 'none', objectFit: 'fill' };
+    // 最大一级缩略图垫底: 描述文件加载中 / 瓦片未到达时不留空白
+    // 缩略图生成失败时后端返回错误而不是原图 (不会把整张超大原图当预览下载)，此时隐藏预览，避免显示破图图标
+    const preview = <img src={thumbSrc(img.src, MIP_LEVELS[MIP_LEVELS.length - 1])} crossOrigin="anonymous" alt={img.id} style={fillStyle}
+                         onError={(e) => { e.currentTarget.style.visibility = 'hidden'; }} />;
+    if (!info) return <div style={boxStyle}>{preview}</div>;
+
+    const { width, height, tileSize, format } = info;
+    const maxLevel = Math.ceil(Math.log2(Math.max(width, height)));
+    // 选择屏幕上每个瓦片像素不小于一个设备像素的最小级别
+    const needed = (img.contentWidth * zoom * (window.devicePixelRatio || 1)) / width;
+    const level = Math.max(0, Math.min(maxLevel, maxLevel + Math.ceil(Math.log2(needed))));
+    const scale = Math.pow(2, maxLevel - level);
+    const levelW = Math.ceil(width / scale), levelH = Math.ceil(height / scale);
+    const kx = img.contentWidth / levelW, ky = img.contentHeight / levelH;
+    const cols = Math.ceil(levelW / tileSize), rows = Math.ceil(levelH / tileSize);
+
+    // 视口 (画布坐标) 换算到图片内容坐标，只保留相交的瓦片；旋转的图层不做裁剪
+    let [c0, c1, r0, r1] = [0, cols - 1, 0, rows - 1];
+    if (!img.rotation) {
+        const left = -offset.x / zoom - img.x - (img.contentX || 0);
+        const top = -offset.y / zoom - img.y - (img.contentY || 0);
+        c0 = Math.max(0, Math.floor(left / (tileSize * kx)));
+        c1 = Math.min(cols - 1, Math.floor((left + viewport.width / zoom) / (tileSize * kx)));
+        r0 = Math.max(0, Math.floor(top / (tileSize * ky)));
+        r1 = Math.min(rows - 1, Math.floor((top + viewport.height / zoom) / (tileSize * ky)));
+    }
+
+    const base = dziUrl.replace(/\.dzi$/, '_files');
+    const seam = 0.5 / zoom; // 相邻瓦片略微重叠，避免亚像素缝隙
+    const tiles = [];
+    for (let row = r0; row <= r1; row++) {
+        for (let col = c0; col <= c1; col++) {
+            tiles.push(
+                <img key={`${level}/${col}_${row}`} src={`${base}/${level}/${col}_${row}.${format}`} crossOrigin="anonymous" alt=""
+                     style={{ position: 'absolute', left: col * tileSize * kx, top: row * tileSize * ky,
+                              width: Math.min(tileSize, levelW - col * tileSize) * kx + seam,
+                              height: Math.min(tileSize, levelH - row * tileSize) * ky + seam,
+                              maxWidth: 'none', maxHeight: 'none' }} />
+            );
+        }
+    }
+    return <div style={boxStyle}>{preview}{tiles}</div>;
+});
@@ -19,7 +19,7 @@ export function useCanvasState() {
   const [viewMode, setViewMode] = useState('canvas'); 
 
   // --- 2. 历史记录 ---
-  const { takeSnapshot, undo, redo, canUndo, canRedo } = useHistory(images);
+  const { takeSnapshot, undo, redo, canUndo, canRedo, historySources } = useHistory(images);
 
   // 统一更新 helper
   const updateImages = useCallback((newImages, shouldSnapshot = true) => {
@@ -150,7 +150,7 @@ export function useCanvasState() {
       zoom, setZoom, offset, setOffset,
       drawSettings, setDrawSettings,
       viewMode, setViewMode,
-      takeSnapshot, undo, redo, canUndo, canRedo,
+      takeSnapshot, undo, redo, canUndo, canRedo, historySources,
       deleteObject, handleAddObject, handleSplineComplete, handleDrawComplete, handleLayerAction
   };
 }
\ No newline at end of file
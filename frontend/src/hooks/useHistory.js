@@ -50,10 +50,20 @@ export const useHistory = (initialState) => {
     return null;
   }, []);
 
+  // [新增] 历史栈中所有图片的 src (保存时上报给后端，避免可撤销回来的图片被垃圾回收)
+  const historySources = useCallback(() => {
+    const sources = new Set();
+    historyRef.current.forEach(state => {
+      (state || []).forEach(item => { if (item && item.src) sources.add(item.src); });
+    });
+    return [...sources];
+  }, []);
+
   return {
     takeSnapshot,
     undo,
     redo,
+    historySources,
     canUndo: pointerRef.current > 0,
     canRedo: pointerRef.current < historyRef.current.length - 1
   };
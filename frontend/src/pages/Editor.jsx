@@ -287,7 +287,7 @@ export default function Editor() {
           await fetch(`${API_BASE_URL}/api/projects/save`, {
               method: 'POST',
               headers: { 'Content-Type': 'application/json' },
-              body: JSON.stringify({ id: projectId, data: projectData })
+              body: JSON.stringify({ id: projectId, data: projectData, history_refs: canvas.historySources() })
           });
           setSaveStatus('Synced');
       } catch (e) {
@@ -1,6 +1,7 @@
 /**
  * src/utils/imageHelpers.js
  */
+import { API_BASE_URL } from '../config';
 
 // 生成短 ID (用于文件名后缀)
 export const shortId = () => Math.random().toString(36).substr(2, 4);
@@ -42,6 +43,49 @@ export const readImageFile = (file) => {
     });
 };
   
+// [新增] 画布缩略图: 按屏幕显示尺寸 (长边像素) 选择 Mip 级别，与后端 THUMBNAIL_SIZES 一致
+export const MIP_LEVELS = [256, 512, 1024, 2048];
+// [新增] 超过该像素数的图片在显示尺寸超过最大 Mip 级别时改用 Deep Zoom 瓦片
+export const TILE_MIN_PIXELS = 4096 * 4096;
+
+// 只处理 /files/{project_id}/{sub_dir}/{filename} 形式的工作区素材，返回 [后端地址, 项目内路径]
+const workspaceAsset = (src) => {
+    const match = src?.match(/^(https?:\/\/[^/]+)?\/files\/([^/]+\/[^/]+\/[^/?#]+)$/);
+    return match ? [match[1] || API_BASE_URL, match[2]] : null;
+};
+
+export const thumbSrc = (src, level) => {
+    const asset = workspaceAsset(src);
+    return asset ? `${asset[0]}/api/thumbs/${asset[1]}?size=${level}` : src;
+};
+
+export const mipSrc = (src, displayPx) => {
+    if (!src || !displayPx) return src;
+    const needed = displayPx * (window.devicePixelRatio || 1);
+    const level = MIP_LEVELS.find(l => l >= needed);
+    // 显示尺寸超过最大级别时直接加载原图
+    return level ? thumbSrc(src, level) : src;
+};
+
+// [新增] Deep Zoom 描述文件地址 (瓦片地址为同名 _files/{level}/{col}_{row}.{format})
+export const tileSourceUrl = (src) => {
+    const asset = workspaceAsset(src);
+    return asset ? `${asset[0]}/api/tiles/${asset[1]}.dzi` : null;
+};
+
+export const parseDzi = (xml) => {
+    const doc = new DOMParser().parseFromString(xml, 'application/xml');
+    const image = doc.getElementsByTagName('Image')[0];
+    const size = doc.getElementsByTagName('Size')[0];
+    if (!image || !size) return null;
+    return {
+        tileSize: Number(image.getAttribute('TileSize')),
+        format: image.getAttribute('Format'),
+        width: Number(size.getAttribute('Width')),
+        height: Number(size.getAttribute('Height')),
+    };
+};
+
 // 自适应尺寸计算 (防止大图撑爆画布)
 export const calculateFitSize = (natW, natH, maxSize = 1000) => {
     let w = natW;
@@ -7,6 +7,7 @@ class WebSocketClient {
     this.clientId = crypto.randomUUID(); 
     this.callbacks = new Map(); 
     this.listeners = new Set(); // [新增] 广播监听器集合
+    this.pendingBlobs = new Map(); // [新增] 等待回执的 Blob 上传 (ref -> {resolve, reject})
     this.isConnected = false;
     this.url = 'ws://localhost:8020/ws';
   }
@@ -39,6 +40,20 @@ class WebSocketClient {
             return; // 广播消息处理完毕，不再走下面的 task 匹配
         }
 
+        // [新增] 二进制 Blob 上传回执 (成功带 handle，失败带 error)
+        if (msg.type === 'blob') {
+            const pending = this.pendingBlobs.get(msg.data?.ref);
+            if (msg.data?.error) {
+                console.error(`❌ [WS] Blob 保存失败: ${msg.data.error}`);
+                if (pending) pending.reject(new Error(msg.data.error));
+            } else {
+                console.log(`📦 [WS] Blob 已保存: ${msg.data?.handle} (${msg.data?.size} bytes)`);
+                if (pending) pending.resolve(msg.data.handle);
+            }
+            this.pendingBlobs.delete(msg.data?.ref);
+            return;
+        }
+
         // --- [调试核心] 打印当前状态 ---
         console.log(`🔍 [WS] 正在核对任务 ID: ${incomingId}`);
         console.log("📋 [WS] 当前等待中的任务列表:", Array.from(this.callbacks.keys()));
@@ -56,6 +71,11 @@ class WebSocketClient {
             this.callbacks.delete(incomingId);
           } else if (msg.type === 'status') {
             console.log(`⏳ [WS] 进度更新: ${msg.data?.message}`);
+          } else if (msg.type === 'progress') {
+            // [新增] 流式输出的增量内容 (如 LiteLLM stream 模式)
+            if (cb.onProgress) {
+              try { cb.onProgress(msg.data); } catch(err) { console.error("Progress handler error:", err); }
+            }
           }
         } else {
             console.warn(`⚠️ [WS] 收到消息但找不到对应任务！(ID: ${incomingId}) 可能原因：超时被清理、ID不匹配、或页面刷新丢失状态`);
@@ -68,10 +88,14 @@ class WebSocketClient {
     this.ws.onclose = () => {
       console.log('❌ [WS] 连接断开');
       this.isConnected = false;
+      // 断开后不会再收到回执
+      this.pendingBlobs.forEach(({ reject }) => reject(new Error("连接断开，Blob 上传未完成")));
+      this.pendingBlobs.clear();
     };
   }
 
-  async sendTask(taskType, payload) {
+  // [新增] options.onProgress: 接收 progress 消息 (流式增量) 的回调
+  async sendTask(taskType, payload, options = {}) {
     if (!this.isConnected) {
       console.warn("[WS] 未连接，尝试重连...");
       this.connect(this.url);
@@ -92,7 +116,7 @@ class WebSocketClient {
 
     return new Promise((resolve, reject) => {
       // 1. 先记录到本子上
-      this.callbacks.set(taskId, { resolve, reject });
+      this.callbacks.set(taskId, { resolve, reject, onProgress: options.onProgress });
       console.log("📝 [WS] 已将 ID 加入等待列表:", taskId);
       
       try {
@@ -114,6 +138,43 @@ class WebSocketClient {
     });
   }
 
+  // [新增] 以二进制帧上传图片等任务输入，返回 blob://<sha256> 句柄
+  // 句柄可直接放进 payload 替代 Base64 data URL；等到后端回执 (已校验哈希并落盘) 后才返回，失败时抛出异常
+  // 帧格式: [4 字节头部长度][JSON 头部][原始字节]
+  async sendBlob(data) {
+    if (!this.isConnected) {
+      throw new Error("WebSocket 未连接，无法上传 Blob");
+    }
+    const buffer = data instanceof Blob ? await data.arrayBuffer() : data;
+    const digest = await crypto.subtle.digest('SHA-256', buffer);
+    const sha256 = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    const ref = crypto.randomUUID();
+    const header = new TextEncoder().encode(JSON.stringify({ ref, sha256 }));
+
+    const frame = new Uint8Array(4 + header.length + buffer.byteLength);
+    new DataView(frame.buffer).setUint32(0, header.length);
+    frame.set(header, 4);
+    frame.set(new Uint8Array(buffer), 4 + header.length);
+
+    return new Promise((resolve, reject) => {
+      this.pendingBlobs.set(ref, { resolve, reject });
+      try {
+        this.ws.send(frame);
+      } catch (e) {
+        this.pendingBlobs.delete(ref);
+        reject(e);
+        return;
+      }
+      // 超时保护 (30秒)，与 sendTask 一致
+      setTimeout(() => {
+        if (this.pendingBlobs.has(ref)) {
+          this.pendingBlobs.delete(ref);
+          reject(new Error("Blob 上传超时，后端没有回执 (30s)"));
+        }
+      }, 30000);
+    });
+  }
+
   // [新增] 注册全局事件监听 (供 App.jsx 使用)
   addListener(callback) {
     this.listeners.add(callback);